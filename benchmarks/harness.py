@@ -0,0 +1,121 @@
+"""Sets up an offline benchmark environment: a cohort of phantom sessions (phantoms.py), the stand-in tools first on PATH
+(stub_tools.py), the stand-in models (stub_models.py) and phantom templates, staged to a template cache in the work folder.
+Call setup_environment before importing the pipeline, the models and templates folders are read when the pipeline modules are imported
+"""
+import os
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from phantoms import make_dicom_session, make_nifti_session, make_template
+from stub_tools import install_stub_tools
+
+class BenchmarkEnvironment(NamedTuple):
+    work_folder: str
+    bin_folder: str
+    models_folder: str
+    templates_folder: str
+
+def setup_environment(work_folder: str, scale: float = 1.0, tool_delay: float = 0.0, seed: int = 0) -> BenchmarkEnvironment:
+    """Installs the stand-in tools, models and templates in a folder and points the pipeline (and the processes it starts) to them
+
+    Args:
+        work_folder (str): The folder (created)
+        scale (float, optional): In-plane size factor of the templates, see phantoms.get_geometry. Defaults to 1.0.
+        tool_delay (float, optional): Seconds every stand-in tool sleeps, see stub_tools.py. Defaults to 0.0.
+        seed (int, optional): Seed of the template noise. Defaults to 0.
+
+    Returns:
+        BenchmarkEnvironment: The folders
+    """
+    os.environ.setdefault('KERAS_BACKEND', 'jax')
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+
+    # keras is only imported now, after the backend is set
+    from stub_models import make_stub_models
+
+    bin_folder = install_stub_tools(os.path.join(work_folder, 'bin'))
+    models_folder = make_stub_models(os.path.join(work_folder, 'models'))
+
+    templates_folder = os.path.join(work_folder, 'templates')
+    os.makedirs(templates_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for sequence in ['T1', 'T2']:
+        nib.save(make_template(sequence, rng, scale), os.path.join(templates_folder, f'template_{sequence.lower()}.nii.gz'))
+
+    os.environ['PATH'] = bin_folder + os.pathsep + os.environ['PATH']
+    os.environ['PIPELINE_MODELS_FOLDER'] = models_folder
+    os.environ['PIPELINE_TEMPLATES_FOLDER'] = templates_folder
+    os.environ['PIPELINE_TEMPLATE_CACHE_FOLDER'] = os.path.join(work_folder, 'template_cache')
+    os.environ['STUB_TOOL_DELAY'] = str(tool_delay)
+
+    return BenchmarkEnvironment(work_folder, bin_folder, models_folder, templates_folder)
+
+def make_cohort(root_folder: str, num_sessions: int, scale: float = 1.0, dicom: bool = True, dwi_volumes: int = 1, seed: int = 0) -> List[str]:
+    """Writes a root folder of single session subjects (SUBJ001, SUBJ002, ...), like the root given to run.py
+
+    Args:
+        root_folder (str): The root folder (created)
+        num_sessions (int): Number of subjects
+        scale (float, optional): See phantoms.get_geometry. Defaults to 1.0.
+        dicom (bool, optional): Write dicom series (the input of dcm2nii), otherwise the niftis dcm2nii writes. Defaults to True.
+        dwi_volumes (int, optional): Number of volumes of the dwi niftis (dicom dwis are 3d). Defaults to 1.
+        seed (int, optional): Seed of the noise. Defaults to 0.
+
+    Returns:
+        List[str]: The subjects
+    """
+    rng = np.random.default_rng(seed)
+    subjects = [f'SUBJ{i + 1:03d}' for i in range(num_sessions)]
+    for subject in subjects:
+        session_folder = os.path.join(root_folder, subject)
+        if dicom:
+            make_dicom_session(session_folder, subject, rng, scale=scale)
+        else:
+            make_nifti_session(session_folder, subject, rng, scale=scale, dwi_volumes=dwi_volumes)
+    return subjects
+
+def get_session_infos(root_folder: str, output_folder: str) -> List[Dict]:
+    """Finds the sessions of a root folder the way run.py does
+
+    Args:
+        root_folder (str): The root folder
+        output_folder (str): The output folder
+
+    Returns:
+        List[Dict]: The session infos, with force set so the step cache never skips a step
+    """
+    from utils.base import find_all_sessions_for_subjects, get_all_subjects, get_dicom_index
+
+    os.makedirs(output_folder, exist_ok=True)
+    dicom_index = get_dicom_index(output_folder)
+    dicom_index.refresh(root_folder)
+
+    session_infos = []
+    for subject, session_folders in find_all_sessions_for_subjects(root_folder, get_all_subjects(root_folder), dicom_index).items():
+        for session_folder in session_folders:
+            session_name = os.path.basename(session_folder)
+            output_session_folder = os.path.join(output_folder, subject) if subject == session_name else os.path.join(output_folder, subject, session_name)
+            os.makedirs(output_session_folder, exist_ok=True)
+            session_infos.append({
+                'subject': subject,
+                'session': session_name,
+                'session_folder': session_folder,
+                'output_folder': output_session_folder,
+                'output_root': output_folder,
+                'force': True,
+            })
+    return session_infos
+
+def time_call(fn: Callable, *args) -> Tuple[float, object]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def summarize(timings: List[float]) -> str:
+    return f'mean {np.mean(timings):7.3f}s, min {np.min(timings):7.3f}s, max {np.max(timings):7.3f}s'
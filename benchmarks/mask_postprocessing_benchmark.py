@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.ndimage
+from skimage import morphology
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils.registration.mask_postprocessing import postprocess_mask
+
+IMG_SIZE = 128
+MIN_SIZE = IMG_SIZE*IMG_SIZE*0.01
+
+parser = argparse.ArgumentParser(
+    prog='Mask Post Processing Benchmark',
+    description='Compares slice by slice mask post processing with the volumetric implementation on synthetic masks'
+)
+
+parser.add_argument('-s', '--size', type=int, default=256, help='Edge length of the synthetic cubic mask')
+parser.add_argument('-n', '--repeats', type=int, default=3)
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+def make_synthetic_mask(size, rng):
+    """Ellipsoidal brain with internal holes and stray blobs around it"""
+    grid = np.indices((size, size, size), dtype=np.float32) / size - 0.5
+    mask = (grid[0] / 0.35) ** 2 + (grid[1] / 0.4) ** 2 + (grid[2] / 0.3) ** 2 < 1
+
+    noise = scipy.ndimage.gaussian_filter(rng.random((size, size, size), dtype=np.float32), 2)
+    mask &= noise > np.quantile(noise, 0.02)
+    mask |= noise > np.quantile(noise, 0.995)
+    return mask.astype(float)
+
+def legacy_postprocess(resized_prediction):
+    resized_prediction = resized_prediction.copy()
+    for slice in range(resized_prediction.shape[2]):
+        resized_prediction[:, :, slice] = scipy.ndimage.binary_fill_holes(resized_prediction[:, :, slice])
+        resized_prediction[:,:, slice] = morphology.remove_small_objects(resized_prediction[:,:, slice].astype(bool), MIN_SIZE).astype(int)
+
+    for slice in range(resized_prediction.shape[0]):
+        resized_prediction[slice, :, :] = scipy.ndimage.binary_fill_holes(resized_prediction[slice, :, :])
+        resized_prediction[slice, :, :] = morphology.remove_small_objects(resized_prediction[slice, :, :].astype(bool), MIN_SIZE).astype(int)
+
+    for slice in range(resized_prediction.shape[1]):
+        resized_prediction[:, slice, :] = scipy.ndimage.binary_fill_holes(resized_prediction[:, slice, :])
+        resized_prediction[:, slice, :] = morphology.remove_small_objects(resized_prediction[:, slice, :].astype(bool), MIN_SIZE).astype(int)
+    return resized_prediction
+
+def time_it(fn, mask):
+    timings = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        result = fn(mask)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+mask = make_synthetic_mask(args.size, np.random.default_rng(args.seed))
+
+legacy_time, legacy_result = time_it(legacy_postprocess, mask)
+exact_time, exact_result = time_it(lambda m: postprocess_mask(m, MIN_SIZE, exact=True), mask)
+volumetric_time, volumetric_result = time_it(lambda m: postprocess_mask(m, MIN_SIZE, exact=False), mask)
+
+print(f'{args.size}^3 mask, best of {args.repeats}')
+print(f'slice by slice: {legacy_time:.3f}s')
+print(f'exact:          {exact_time:.3f}s ({legacy_time / exact_time:.1f}x), identical: {np.array_equal(legacy_result != 0, exact_result)}')
+print(f'volumetric:     {volumetric_time:.3f}s ({legacy_time / volumetric_time:.1f}x), differing voxels: {np.count_nonzero((legacy_result != 0) != volumetric_result)}')
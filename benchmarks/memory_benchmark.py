@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import setup_environment, make_cohort, get_session_infos
+
+parser = argparse.ArgumentParser(
+    prog='Memory Benchmark',
+    description='Measures the peak resident memory of each workflow step on phantom sessions. Every step of every session runs in its own '
+                'python process (the tools it starts are not counted); the peak of a process that only imports the pipeline is subtracted'
+)
+
+parser.add_argument('-n', '--sessions', type=int, default=2, help='Number of phantom sessions')
+parser.add_argument('-s', '--steps', nargs='+', help='Steps to measure, in workflow order. Defaults to all workflow steps (dcm2nii is skipped with --nifti)')
+parser.add_argument('--scale', type=float, default=1.0, help='In-plane matrix size factor of the phantoms, e.g. 2 for 256x256 images')
+parser.add_argument('--nifti', action='store_true', help='Start from the niftis dcm2nii writes instead of dicom series')
+parser.add_argument('--dwi-volumes', type=int, default=1, help='Number of volumes of the dwi niftis (with --nifti), more than 1 makes them 4d')
+parser.add_argument('--max-mib', type=float, help='Exit with 1 if a step takes more memory than this (MiB above the baseline), to catch regressions')
+parser.add_argument('--work-dir', help='Folder for the phantoms and outputs, kept after the run. Defaults to a temporary folder')
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+work_folder = args.work_dir or tempfile.mkdtemp(prefix='memory_benchmark_')
+setup_environment(work_folder, args.scale, seed=args.seed)
+
+from processor.workflow import WORKFLOW_STEPS
+
+# run by each process: imports the pipeline (the baseline), runs the steps given as arguments and writes the peak resident memory
+# of the process (VmHWM, unlike ru_maxrss not inherited from the benchmark process it was forked from) to the file given as argument
+STEP_SCRIPT = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+from processor.workflow import run_workflow
+steps, session_info = json.loads(sys.argv[2]), json.loads(sys.argv[3])
+succeeded = not steps or run_workflow(steps, session_info)
+with open('/proc/self/status') as status, open(sys.argv[4], 'w') as peak:
+    peak.write(next(line.split()[1] for line in status if line.startswith('VmHWM:')))
+sys.exit(0 if succeeded else 1)
+'''
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+PEAK_PATH = os.path.join(work_folder, 'peak')
+
+def run_measured(steps: Optional[List[str]] = None, session_info: Optional[Dict] = None) -> Tuple[bool, float]:
+    """Runs steps for a session in a new python process (the environment of the harness is inherited)
+
+    Args:
+        steps (List[str], optional): The steps, none only imports the pipeline. Defaults to None.
+        session_info (Dict, optional): The session. Defaults to None.
+
+    Returns:
+        Tuple[bool, float]: Whether the steps succeeded and the peak resident memory of the process in MiB
+    """
+    code = subprocess.call([sys.executable, '-c', STEP_SCRIPT, SRC_FOLDER, json.dumps(steps or []), json.dumps(session_info or {}), PEAK_PATH])
+    with open(PEAK_PATH, 'r') as f:
+        # VmHWM is in KiB
+        return code == 0, int(f.read()) / 2 ** 10
+
+steps = args.steps or [step for step in WORKFLOW_STEPS if not (args.nifti and step == 'dcm2nii')]
+
+root_folder = os.path.join(work_folder, 'root')
+shutil.rmtree(root_folder, ignore_errors=True)
+make_cohort(root_folder, args.sessions, args.scale, not args.nifti, args.dwi_volumes, args.seed)
+
+output_folder = os.path.join(work_folder, 'output')
+shutil.rmtree(output_folder, ignore_errors=True)
+session_infos = get_session_infos(root_folder, output_folder)
+if args.nifti:
+    for session_info in session_infos:
+        session_info['session_folder'] = session_info['output_folder']
+        shutil.copytree(os.path.join(root_folder, session_info['subject']), session_info['output_folder'], dirs_exist_ok=True)
+
+baseline = np.median([run_measured()[1] for _ in range(3)])
+
+peaks = {step: [] for step in steps}
+failed = {step: 0 for step in steps}
+for step in steps:
+    for session_info in session_infos:
+        succeeded, peak = run_measured([step], session_info)
+        peaks[step].append(peak - baseline)
+        failed[step] += 0 if succeeded else 1
+
+        # the niftis dcm2nii writes are read from the output folder by the next steps, see run_workflow
+        if step == 'dcm2nii':
+            session_info['session_folder'] = session_info['output_folder']
+
+print(f'\n{args.sessions} sessions, scale {args.scale}, {"nifti" if args.nifti else "dicom"} input, baseline {baseline:.1f} MiB, work folder {work_folder}')
+over_limit = []
+for step in steps:
+    print(f'{step:20s} peak mean {np.mean(peaks[step]):7.1f} MiB, max {np.max(peaks[step]):7.1f} MiB above the baseline' + (f', {failed[step]} failed' if failed[step] > 0 else ''))
+    if args.max_mib is not None and np.max(peaks[step]) > args.max_mib:
+        over_limit.append(step)
+
+if not args.work_dir:
+    shutil.rmtree(work_folder)
+
+if over_limit:
+    print(f'Steps over {args.max_mib} MiB: {", ".join(over_limit)}')
+    sys.exit(1)
@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils.registration.model_cache import get_cached_model, clear_model_cache
+
+parser = argparse.ArgumentParser(
+    prog='Model Cache Benchmark',
+    description='Compares per-session inference latency with a cold and a warm model cache'
+)
+
+parser.add_argument('-m', '--model', required=True, help='Path to a .keras model, e.g. models/3d/t1_brain_extraction.keras')
+parser.add_argument('-n', '--sessions', type=int, default=5, help='Number of simulated sessions')
+parser.add_argument('-b', '--batch', type=int, default=1, help='Number of samples per session (e.g. number of slices for 2d models)')
+
+args = parser.parse_args()
+
+def get_session_input(model, batch):
+    input_shape = model.input_shape[0] if isinstance(model.input_shape, list) else model.input_shape
+    shape = [batch] + [128 if dim is None else dim for dim in input_shape[1:]]
+    return np.random.rand(*shape).astype(np.float32)
+
+def run_session():
+    start = time.perf_counter()
+    cached_model = get_cached_model(args.model)
+    cached_model.predict(get_session_input(cached_model.model, args.batch))
+    return time.perf_counter() - start
+
+cold = []
+for _ in range(args.sessions):
+    clear_model_cache()
+    cold.append(run_session())
+
+warm = [run_session() for _ in range(args.sessions)]
+
+print(f'cold: mean {np.mean(cold):.3f}s, min {np.min(cold):.3f}s, max {np.max(cold):.3f}s')
+print(f'warm: mean {np.mean(warm):.3f}s, min {np.min(warm):.3f}s, max {np.max(warm):.3f}s')
+print(f'speedup: {np.mean(cold) / np.mean(warm):.1f}x')
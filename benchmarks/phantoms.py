@@ -0,0 +1,270 @@
+"""Synthetic head phantoms written as dicom series (like a scanner export) or as niftis (like the output of dcm2nii),
+so the pipeline can be benchmarked without patient data. All sequences of a session are sampled from the same analytic
+head in world coordinates, so they overlap like real acquisitions of one session
+"""
+import datetime
+import os
+from typing import Dict, List, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+# matrix and voxel size (mm) of each sequence, close to clinical acquisitions
+SEQUENCE_GEOMETRY = {
+    'T1': ((256, 256, 176), (1.0, 1.0, 1.0)),
+    'T2': ((320, 320, 30), (0.7, 0.7, 5.0)),
+    'FL': ((256, 256, 30), (0.9, 0.9, 5.0)),
+    'DWI': ((128, 128, 30), (1.8, 1.8, 5.0)),
+    'ADC': ((128, 128, 30), (1.8, 1.8, 5.0)),
+}
+
+# names of the dicom folders, matched by config/sequence_string_lists.json
+SEQUENCE_FOLDER_NAMES = {
+    'T1': 'AX-3D-T1',
+    'T2': 'Ax-T2',
+    'FL': 'AX-FLAIR',
+    'DWI': 'ep2d_diff_4scan_trace_p2_TRACEW',
+    'ADC': 'ep2d_diff_4scan_trace_p2_ADC',
+}
+
+# intensity of background, skull, csf, grey matter, white matter and lesion in each sequence
+SEQUENCE_CONTRASTS = {
+    'T1': (0, 300, 200, 600, 900, 450),
+    'T2': (0, 200, 1500, 800, 500, 1200),
+    'FL': (0, 200, 100, 700, 500, 1400),
+    'DWI': (0, 20, 150, 400, 350, 1100),
+    'ADC': (0, 0, 3000, 900, 750, 350),
+}
+
+SEQUENCES = list(SEQUENCE_GEOMETRY.keys())
+
+# semi-axes (mm) of the head, brain, white matter and ventricles, and the lesion (center and radius in mm, RAS)
+HEAD_AXES = (75, 95, 80)
+BRAIN_AXES = (65, 85, 68)
+WHITE_MATTER_AXES = (48, 66, 50)
+VENTRICLE_AXES = (12, 28, 14)
+LESION_CENTER = (30, 10, 15)
+LESION_RADIUS = 12
+
+def get_geometry(sequence: str, scale: float = 1.0) -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+    """Gets the matrix and voxel size of a sequence, with the in-plane matrix scaled (the field of view stays the same)
+
+    Args:
+        sequence (str): One of SEQUENCES
+        scale (float, optional): Factor for the in-plane matrix size, e.g. 0.5 for quick runs. Defaults to 1.0.
+
+    Returns:
+        Tuple[Tuple[int, ...], Tuple[float, ...]]: The shape and the voxel size
+    """
+    shape, zooms = SEQUENCE_GEOMETRY[sequence]
+    scaled_shape = (max(8, round(shape[0] * scale)), max(8, round(shape[1] * scale)), shape[2])
+    scaled_zooms = (zooms[0] * shape[0] / scaled_shape[0], zooms[1] * shape[1] / scaled_shape[1], zooms[2])
+    return scaled_shape, scaled_zooms
+
+def get_axial_affine(shape: Tuple[int, ...], zooms: Tuple[float, ...]) -> np.ndarray:
+    """Gets the affine of an axial volume centered on the head, in the orientation dcm2nii writes (RPI, LAS in nibabel)
+
+    Args:
+        shape (Tuple[int, ...]): Shape of the volume
+        zooms (Tuple[float, ...]): Voxel size in mm
+
+    Returns:
+        np.ndarray: The voxel to world (RAS) affine
+    """
+    affine = np.diag([-zooms[0], zooms[1], zooms[2], 1.0])
+    affine[:3, 3] = -affine[:3, :3] @ ((np.array(shape[:3]) - 1) / 2)
+    return affine
+
+def inside(points: List[np.ndarray], center: Tuple[float, ...], axes: Tuple[float, ...]) -> np.ndarray:
+    return sum(((points[i] - center[i]) / axes[i]) ** 2 for i in range(3)) < 1
+
+def sample_head(sequence: str, affine: np.ndarray, shape: Tuple[int, ...], rng: np.random.Generator, lesion: bool = True) -> np.ndarray:
+    """Samples the analytic head at the voxels of a volume
+
+    Args:
+        sequence (str): Contrast to sample with, one of SEQUENCES
+        affine (np.ndarray): Voxel to world (RAS) affine
+        shape (Tuple[int, ...]): Shape of the volume (3d)
+        rng (np.random.Generator): For the noise
+        lesion (bool, optional): Add a stroke lesion. Defaults to True.
+
+    Returns:
+        np.ndarray: The intensities as float32
+    """
+    background, skull, csf, grey, white, lesion_intensity = SEQUENCE_CONTRASTS[sequence]
+
+    voxels = np.indices(shape[:3], dtype=np.float32).reshape(3, -1)
+    points = list((affine[:3, :3] @ voxels + affine[:3, 3:4]).astype(np.float32))
+
+    data = np.full(voxels.shape[1], background, dtype=np.float32)
+    data[inside(points, (0, 0, 0), HEAD_AXES)] = skull
+    data[inside(points, (0, 0, 0), BRAIN_AXES)] = grey
+    data[inside(points, (0, 0, 0), WHITE_MATTER_AXES)] = white
+    data[inside(points, (0, 0, 10), VENTRICLE_AXES)] = csf
+    if lesion:
+        data[inside(points, LESION_CENTER, (LESION_RADIUS,) * 3)] = lesion_intensity
+
+    data = data.reshape(shape[:3])
+    noise = rng.normal(0, 0.03 * max(SEQUENCE_CONTRASTS[sequence]), data.shape).astype(np.float32)
+    return np.clip(data + noise * (data > 0), 0, None)
+
+def make_phantom(sequence: str, rng: np.random.Generator, scale: float = 1.0, volumes: int = 1, lesion: bool = True) -> nib.Nifti1Image:
+    """Makes a phantom image of a sequence
+
+    Args:
+        sequence (str): One of SEQUENCES
+        rng (np.random.Generator): For the noise
+        scale (float, optional): See get_geometry. Defaults to 1.0.
+        volumes (int, optional): Number of volumes, more than 1 makes a 4d image (e.g. a dwi with several b-values). Defaults to 1.
+        lesion (bool, optional): Add a stroke lesion. Defaults to True.
+
+    Returns:
+        nib.Nifti1Image: The phantom
+    """
+    shape, zooms = get_geometry(sequence, scale)
+    affine = get_axial_affine(shape, zooms)
+
+    if volumes == 1:
+        data = sample_head(sequence, affine, shape, rng, lesion)
+    else:
+        # later volumes have more diffusion weighting, i.e. less signal
+        data = np.stack([sample_head(sequence, affine, shape, rng, lesion) * 0.6 ** i for i in range(volumes)], axis=-1)
+
+    img = nib.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    img.header.set_xyzt_units(2)
+    return img
+
+def make_template(sequence: str, rng: np.random.Generator, scale: float = 1.0) -> nib.Nifti1Image:
+    """Makes a skull stripped template image, like the templates of the registerToTemplate step
+
+    Args:
+        sequence (str): 'T1' or 'T2'
+        rng (np.random.Generator): For the noise
+        scale (float, optional): See get_geometry. Defaults to 1.0.
+
+    Returns:
+        nib.Nifti1Image: The template
+    """
+    shape = tuple(max(8, round(size * scale)) for size in (160, 192, 160))
+    zooms = tuple(size / new_size for size, new_size in zip((160, 192, 160), shape))
+    affine = get_axial_affine(shape, zooms)
+
+    data = sample_head(sequence, affine, shape, rng, lesion=False)
+    voxels = np.indices(shape, dtype=np.float32).reshape(3, -1)
+    points = list(affine[:3, :3] @ voxels + affine[:3, 3:4])
+    data[~inside(points, (0, 0, 0), BRAIN_AXES).reshape(shape)] = 0
+    return nib.Nifti1Image(data, affine)
+
+def write_dicom_series(folder: str, img: nib.Nifti1Image, description: str, series_number: int, study_uid: str, subject: str) -> List[str]:
+    """Writes a 3d image as an axial MR dicom series, one file per slice
+
+    Args:
+        folder (str): Folder to write the series to (created)
+        img (nib.Nifti1Image): The image, see make_phantom
+        description (str): Series description
+        series_number (int): Series number
+        study_uid (str): Study instance UID shared by the series of a session
+        subject (str): Patient name and id
+
+    Returns:
+        List[str]: Paths to the files
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    data = np.asarray(img.dataobj)
+    zooms = img.header.get_zooms()[:3]
+    series_uid = generate_uid()
+    acquisition_time = datetime.datetime.now().strftime('%H%M%S') + f'.{series_number:06d}'
+
+    # dicom pixel rows run from anterior to posterior and columns from right to left (LPS)
+    pixels = np.round(data[:, ::-1, :]).astype(np.uint16)
+
+    paths = []
+    for k in range(data.shape[2]):
+        ras_position = img.affine @ np.array([0, data.shape[1] - 1, k, 1])
+        instance_uid = generate_uid()
+
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MRImageStorage
+        file_meta.MediaStorageSOPInstanceUID = instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        path = os.path.join(folder, f'IM{k + 1:04d}.dcm')
+        ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = instance_uid
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = 'MR'
+        ds.Manufacturer = 'Phantom'
+        ds.PatientName = subject
+        ds.PatientID = subject
+        ds.SeriesDescription = description
+        ds.SeriesNumber = series_number
+        ds.InstanceNumber = k + 1
+        ds.AcquisitionTime = acquisition_time
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND']
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [float(-ras_position[0]), float(-ras_position[1]), float(ras_position[2])]
+        ds.PixelSpacing = [float(zooms[1]), float(zooms[0])]
+        ds.SliceThickness = float(zooms[2])
+        ds.Rows, ds.Columns = data.shape[1], data.shape[0]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = 0
+        ds.PixelData = np.ascontiguousarray(pixels[:, :, k].T).tobytes()
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+
+    return paths
+
+def make_dicom_session(session_folder: str, subject: str, rng: np.random.Generator, sequences: Optional[List[str]] = None, scale: float = 1.0) -> Dict[str, str]:
+    """Writes a session folder of dicom series, the input of the dcm2nii step
+
+    Args:
+        session_folder (str): Path to the session folder (created)
+        subject (str): Name of the subject
+        rng (np.random.Generator): For the noise
+        sequences (List[str], optional): Sequences to write. Defaults to all SEQUENCES.
+        scale (float, optional): See get_geometry. Defaults to 1.0.
+
+    Returns:
+        Dict[str, str]: Sequence to dicom folder
+    """
+    study_uid = generate_uid()
+    folders = {}
+    for series_number, sequence in enumerate(sequences or SEQUENCES, start=1):
+        folder = os.path.join(session_folder, f'{SEQUENCE_FOLDER_NAMES[sequence]}_{series_number}')
+        write_dicom_series(folder, make_phantom(sequence, rng, scale), SEQUENCE_FOLDER_NAMES[sequence], series_number, study_uid, subject)
+        folders[sequence] = folder
+    return folders
+
+def make_nifti_session(session_folder: str, subject: str, rng: np.random.Generator, sequences: Optional[List[str]] = None, scale: float = 1.0, dwi_volumes: int = 1) -> Dict[str, str]:
+    """Writes the niftis the dcm2nii step would write for a session, e.g. <subject>_AX_T1.nii.gz
+
+    Args:
+        session_folder (str): Path to the session folder (created)
+        subject (str): Name of the subject
+        rng (np.random.Generator): For the noise
+        sequences (List[str], optional): Sequences to write. Defaults to all SEQUENCES.
+        scale (float, optional): See get_geometry. Defaults to 1.0.
+        dwi_volumes (int, optional): Number of volumes of the dwi, more than 1 writes a 4d dwi. Defaults to 1.
+
+    Returns:
+        Dict[str, str]: Sequence to nifti path
+    """
+    os.makedirs(session_folder, exist_ok=True)
+    paths = {}
+    for sequence in sequences or SEQUENCES:
+        path = os.path.join(session_folder, f'{subject}_AX_{sequence}.nii.gz')
+        nib.save(make_phantom(sequence, rng, scale, dwi_volumes if sequence == 'DWI' else 1), path)
+        paths[sequence] = path
+    return paths
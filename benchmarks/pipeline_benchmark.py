@@ -0,0 +1,66 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import setup_environment, make_cohort, time_call, summarize
+
+path_to_run_script = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run.py'))
+
+parser = argparse.ArgumentParser(
+    prog='Pipeline Benchmark',
+    description='Times run.py end to end on a cohort of phantom sessions with the local executor, with stand-in tools and models (runs offline, without slurm, ANTs, FSL or the trained models)'
+)
+
+parser.add_argument('-n', '--sessions', type=int, default=4, help='Number of phantom sessions')
+parser.add_argument('-t', '--target', default='heatmap', help='Artifact to produce, see the Targets section of the README. Defaults to heatmap (all workflow steps)')
+parser.add_argument('-w', '--workers', type=int, help='Number of sessions processed at the same time, see the local executor')
+parser.add_argument('-r', '--repeats', type=int, default=1, help='Number of runs, each on a fresh output folder')
+parser.add_argument('--scale', type=float, default=1.0, help='In-plane matrix size factor of the phantoms, e.g. 0.5 for a quick run')
+parser.add_argument('--tool-delay', type=float, default=0.0, help='Seconds every stand-in tool sleeps, to simulate the cost of the real tools')
+parser.add_argument('--work-dir', help='Folder for the phantoms and outputs, kept after the run. Defaults to a temporary folder')
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+work_folder = args.work_dir or tempfile.mkdtemp(prefix='pipeline_benchmark_')
+setup_environment(work_folder, args.scale, args.tool_delay, args.seed)
+
+from utils.base import read_command_logs
+
+root_folder = os.path.join(work_folder, 'root')
+shutil.rmtree(root_folder, ignore_errors=True)
+make_cohort(root_folder, args.sessions, args.scale, seed=args.seed)
+
+timings = []
+command_times = defaultdict(float)
+for repeat in range(args.repeats):
+    output_folder = os.path.join(work_folder, f'output_{repeat}')
+    shutil.rmtree(output_folder, ignore_errors=True)
+
+    cmd = [sys.executable, path_to_run_script, '-r', root_folder, '-o', output_folder, '-t', args.target, '-x', 'local', '-F']
+    if args.workers:
+        cmd += ['--workers', str(args.workers)]
+
+    elapsed, result = time_call(subprocess.run, cmd)
+    if result.returncode != 0:
+        print(f'run.py failed with code {result.returncode}')
+        exit(1)
+    timings.append(elapsed)
+
+    for record in read_command_logs(output_folder):
+        command_times[record['tool']] += record['wall_time'] / args.repeats
+
+print(f'\n{args.sessions} sessions, target {args.target}, scale {args.scale}, work folder {work_folder}')
+print(f'end to end:   {summarize(timings)}, {args.sessions / min(timings) * 3600:.0f} sessions per hour')
+print('time in stand-in tools per run (all sessions):')
+for tool, seconds in sorted(command_times.items(), key=lambda item: item[1], reverse=True):
+    print(f'  {tool:20s} {seconds:.3f}s')
+
+if not args.work_dir:
+    shutil.rmtree(work_folder)
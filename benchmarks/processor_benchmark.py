@@ -0,0 +1,65 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import setup_environment, make_cohort, get_session_infos, time_call, summarize
+
+parser = argparse.ArgumentParser(
+    prog='Processor Benchmark',
+    description='Times each workflow step on phantom sessions, with stand-in tools and models (runs offline, without ANTs, FSL or the trained models)'
+)
+
+parser.add_argument('-n', '--sessions', type=int, default=2, help='Number of phantom sessions')
+parser.add_argument('-s', '--steps', nargs='+', help='Steps to time, in workflow order. Defaults to all workflow steps (dcm2nii is skipped with --nifti)')
+parser.add_argument('-r', '--repeats', type=int, default=1, help='Number of times the steps are run, each time on a fresh output folder')
+parser.add_argument('--scale', type=float, default=1.0, help='In-plane matrix size factor of the phantoms, e.g. 0.5 for a quick run')
+parser.add_argument('--nifti', action='store_true', help='Start from the niftis dcm2nii writes instead of dicom series')
+parser.add_argument('--dwi-volumes', type=int, default=1, help='Number of volumes of the dwi niftis (with --nifti), more than 1 makes them 4d')
+parser.add_argument('--tool-delay', type=float, default=0.0, help='Seconds every stand-in tool sleeps, to simulate the cost of the real tools')
+parser.add_argument('--work-dir', help='Folder for the phantoms and outputs, kept after the run. Defaults to a temporary folder')
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+work_folder = args.work_dir or tempfile.mkdtemp(prefix='processor_benchmark_')
+setup_environment(work_folder, args.scale, args.tool_delay, args.seed)
+
+from processor.workflow import WORKFLOW_STEPS, run_workflow
+
+steps = args.steps or [step for step in WORKFLOW_STEPS if not (args.nifti and step == 'dcm2nii')]
+
+root_folder = os.path.join(work_folder, 'root')
+shutil.rmtree(root_folder, ignore_errors=True)
+make_cohort(root_folder, args.sessions, args.scale, not args.nifti, args.dwi_volumes, args.seed)
+
+timings = {step: [] for step in steps}
+failed = {step: 0 for step in steps}
+for repeat in range(args.repeats):
+    output_folder = os.path.join(work_folder, f'output_{repeat}')
+    shutil.rmtree(output_folder, ignore_errors=True)
+    session_infos = get_session_infos(root_folder, output_folder)
+
+    # without dcm2nii the niftis are read from the root, like sessions converted in an earlier run
+    if args.nifti:
+        for session_info in session_infos:
+            session_info['session_folder'] = session_info['output_folder']
+            shutil.copytree(os.path.join(root_folder, session_info['subject']), session_info['output_folder'], dirs_exist_ok=True)
+
+    # each step runs for all sessions before the next step, so the steps are timed separately
+    for step in steps:
+        for session_info in session_infos:
+            elapsed, succeeded = time_call(run_workflow, [step], session_info)
+            timings[step].append(elapsed)
+            failed[step] += 0 if succeeded else 1
+
+print(f'\n{args.sessions} sessions x {args.repeats} repeats, scale {args.scale}, {"nifti" if args.nifti else "dicom"} input, work folder {work_folder}')
+for step in steps:
+    print(f'{step:20s} {summarize(timings[step])} per session' + (f', {failed[step]} failed' if failed[step] > 0 else ''))
+print(f'{"total":20s} {sum(sum(step_timings) for step_timings in timings.values()) / args.repeats:.3f}s per repeat')
+
+if not args.work_dir:
+    shutil.rmtree(work_folder)
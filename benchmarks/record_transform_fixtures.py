@@ -0,0 +1,65 @@
+import argparse
+import os
+
+import nibabel as nib
+import numpy as np
+import scipy.io
+
+parser = argparse.ArgumentParser(
+    prog='Record Transform Fixtures',
+    description='Writes the images and transform files of benchmarks/fixtures/transforms and records the outputs of ANTs for them, '
+                'which transform_check.py compares the in-process transforms with. Needs ANTsPy (pip install antspyx), which runs '
+                'antsApplyTransforms in process'
+)
+
+parser.add_argument('-o', '--output-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'transforms'))
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+import ants
+
+def write_itk_affine(path: str, matrix, translation, center) -> str:
+    # the keys and shapes antsRegistration writes to <prefix>0GenericAffine.mat, in LPS
+    mat = {
+        'AffineTransform_float_3_3': np.concatenate([np.ravel(matrix), translation]).astype(np.float32)[:, None],
+        'fixed': np.asarray(center, dtype=np.float32)[:, None],
+    }
+    scipy.io.savemat(path, mat, format='4')
+    return path
+
+os.makedirs(args.output_dir, exist_ok=True)
+rng = np.random.default_rng(args.seed)
+
+def save(img: nib.Nifti1Image, name: str) -> str:
+    path = os.path.join(args.output_dir, name)
+    nib.save(img, path)
+    return path
+
+# an oblique source in LAS and a reference grid reaching past it, so the edges of the source are sampled
+angle = np.deg2rad(10)
+rotation = np.array([[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]])
+source_affine = np.eye(4)
+source_affine[:3, :3] = rotation @ np.diag([-2.0, 1.8, 2.5])
+source_affine[:3, 3] = [12, -10, -8]
+source_path = save(nib.Nifti1Image(rng.random((10, 12, 8), dtype=np.float32) * 100, source_affine), 'source.nii.gz')
+labels_path = save(nib.Nifti1Image(rng.integers(1, 10, (10, 12, 8), dtype=np.uint8), source_affine), 'labels.nii.gz')
+reference_path = save(nib.Nifti1Image(np.zeros((16, 16, 14), dtype=np.float32), np.array([[1.5, 0, 0, -12], [0, 1.5, 0, -14], [0, 0, 1.5, -12], [0, 0, 0, 1]])), 'reference.nii.gz')
+
+centered_path = write_itk_affine(os.path.join(args.output_dir, 'centered_0GenericAffine.mat'), [[1, 0.05, 0], [0, 0.95, 0.1], [0.02, 0, 1.05]], [1, -2, 0.5], [2, -3, 1])
+# half a voxel along L, see transform_check.py
+half_voxel_path = write_itk_affine(os.path.join(args.output_dir, 'half_voxel_0GenericAffine.mat'), np.eye(3), [-0.5, 0, 0], [0, 0, 0])
+identity_affine = np.eye(4)
+half_voxel_labels_path = save(nib.Nifti1Image(rng.integers(1, 10, (8, 6, 4), dtype=np.uint8), identity_affine), 'half_voxel_labels.nii.gz')
+
+recordings = {
+    'ants_linear.nii.gz': (source_path, reference_path, centered_path, 'linear'),
+    'ants_nearest.nii.gz': (labels_path, reference_path, centered_path, 'nearestNeighbor'),
+    'ants_half_voxel_nearest.nii.gz': (half_voxel_labels_path, half_voxel_labels_path, half_voxel_path, 'nearestNeighbor'),
+}
+for name, (moving_path, fixed_path, transform_path, interpolator) in recordings.items():
+    output = ants.apply_transforms(ants.image_read(fixed_path), ants.image_read(moving_path), [transform_path], interpolator=interpolator)
+    ants.image_write(output, os.path.join(args.output_dir, name))
+    print(f'Recorded {name} with {interpolator} interpolation')
+
+print(f'ANTsPy {ants.__version__}')
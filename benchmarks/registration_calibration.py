@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from phantoms import BRAIN_AXES, inside, make_phantom, make_template
+
+from utils.registration import run_registration, get_registration_similarity, get_header_similarity, read_itk_affine
+
+parser = argparse.ArgumentParser(
+    prog='Registration Calibration',
+    description='Runs antsRegistration with the fast profile on phantom pairs (the moving and target sequences the pipeline registers), '
+                'moved out of place by known rigid misalignments, and prints the similarity of each pair before the registration (through '
+                'the headers) and after it, with the error of the registration. The thresholds printed at the end pass the aligned pairs '
+                'and the registrations within --max-error and fail the misaligned pairs and the failed registrations, see min_similarity '
+                'in config/registration_profiles.json. Needs antsRegistration on PATH'
+)
+
+parser.add_argument('-n', '--sessions', type=int, default=2, help='Number of phantom sessions')
+parser.add_argument('--scale', type=float, default=0.5, help='In-plane matrix size factor of the phantoms')
+parser.add_argument('--misalignments', default='0,0 3,3 10,10 20,20', help='Rotations about the z axis (degrees) and shifts along x (mm) of the moving images')
+parser.add_argument('--max-error', type=float, default=2.0, help='Largest displacement (mm) of the brain surface of a registration counted as aligned')
+parser.add_argument('--work-dir', help='Folder for the phantoms and outputs, kept after the run. Defaults to a temporary folder')
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+if shutil.which('antsRegistration') is None:
+    sys.exit('antsRegistration is not on PATH')
+
+work_folder = args.work_dir or tempfile.mkdtemp(prefix='registration_calibration_')
+os.makedirs(work_folder, exist_ok=True)
+rng = np.random.default_rng(args.seed)
+profiles_config = json.load(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'registration_profiles.json')))
+bins = profiles_config['similarity_bins']
+misalignments = [tuple(float(x) for x in misalignment.split(',')) for misalignment in args.misalignments.split()]
+
+# the targets of RegistrationProcessor (skull stripped T1), AdcRegistrationProcessor (T2) and TemplateRegistrationProcessor (templates)
+PAIRS = [('T2', 'T1'), ('FL', 'T1'), ('DWI', 'T1'), ('ADC', 'T1'), ('ADC', 'T2'), ('T1', 'template'), ('T2', 'template')]
+
+def strip_skull(img: nib.Nifti1Image) -> nib.Nifti1Image:
+    data = np.asarray(img.dataobj)
+    points = list(img.affine[:3, :3] @ np.indices(data.shape, dtype=np.float32).reshape(3, -1) + img.affine[:3, 3:4])
+    return nib.Nifti1Image(data * inside(points, (0, 0, 0), BRAIN_AXES).reshape(data.shape), img.affine)
+
+def get_misalignment(degrees: float, shift: float) -> np.ndarray:
+    angle = np.deg2rad(degrees)
+    transform = np.eye(4)
+    transform[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    transform[0, 3] = shift
+    return transform
+
+# the ends of the axes of the brain, in homogeneous coordinates
+BRAIN_POINTS = np.vstack([np.hstack([np.diag(BRAIN_AXES), -np.diag(BRAIN_AXES)]), np.ones(6)])
+
+def get_registration_error(transform_path: str, misalignment: np.ndarray) -> float:
+    # the moving image was moved by the misalignment, the registration should map target points to the points moved by it
+    return float(np.max(np.linalg.norm((read_itk_affine(transform_path) - misalignment)[:3] @ BRAIN_POINTS, axis=0)))
+
+similarities = {}
+for session in range(args.sessions):
+    session_folder = os.path.join(work_folder, f'SUBJ{session + 1:03d}')
+    os.makedirs(session_folder, exist_ok=True)
+    images = {sequence: make_phantom(sequence, rng, args.scale) for sequence in ['T1', 'T2', 'FL', 'DWI', 'ADC']}
+
+    for moving_sequence, target_sequence in PAIRS:
+        if target_sequence == 'template':
+            # skull stripped images are registered to skull stripped templates
+            target = make_template(moving_sequence, rng, args.scale)
+            moving = strip_skull(images[moving_sequence])
+        else:
+            target = strip_skull(images[target_sequence]) if target_sequence == 'T1' else images[target_sequence]
+            moving = images[moving_sequence]
+        target_path = os.path.join(session_folder, f'{moving_sequence}_to_{target_sequence}_target.nii.gz')
+        nib.save(target, target_path)
+
+        for degrees, shift in misalignments:
+            name = f'{moving_sequence}_{degrees:g}_{shift:g}'
+            moving_path = os.path.join(session_folder, f'{name}_to_{target_sequence}_moving.nii.gz')
+            misalignment = get_misalignment(degrees, shift)
+            nib.save(nib.Nifti1Image(np.asarray(moving.dataobj), misalignment @ moving.affine), moving_path)
+
+            start = time.perf_counter()
+            code, err = run_registration('calibration', session_folder, target_path, moving_path, name, target_sequence, 'registration_fast_config.json')
+            if code != 0:
+                sys.exit(f'antsRegistration failed for {name} to {target_sequence}: {err}')
+
+            prefix = os.path.join(session_folder, f'calibration_{name}_to_{target_sequence}_')
+            header = get_header_similarity(target_path, moving_path, bins)
+            registered = get_registration_similarity(target_path, prefix + 'Warped.nii.gz', bins)
+            error = get_registration_error(prefix + '0GenericAffine.mat', misalignment)
+            # the pair left in place is aligned only without a misalignment, the registration only if it found the misalignment
+            samples = similarities.setdefault((moving_sequence, target_sequence), {True: [], False: [], 'loss': []})
+            samples[degrees == 0 and shift == 0].append(header)
+            samples[error <= args.max_error].append(registered)
+            if error <= args.max_error:
+                samples['loss'].append(header - registered)
+            print(f'SUBJ{session + 1:03d} {moving_sequence:>3} to {target_sequence:<8} {degrees:4g} deg {shift:4g} mm: header {header:.3f}, '
+                  f'registered {registered:.3f} with an error of {error:.1f} mm ({time.perf_counter() - start:.1f}s)', flush=True)
+
+thresholds = {}
+losses = {}
+for (moving_sequence, target_sequence), samples in similarities.items():
+    lowest_aligned = min(samples[True])
+    highest_misaligned = max(samples[False], default=1.0)
+    separated = 'separated' if highest_misaligned < lowest_aligned else 'overlapping'
+    print(f'{moving_sequence:>3} to {target_sequence:<8}: {len(samples[True])} aligned at least {lowest_aligned:.3f}, '
+          f'{len(samples[False])} misaligned at most {highest_misaligned:.3f}, {separated}')
+    if highest_misaligned < lowest_aligned:
+        thresholds[f'{moving_sequence}_to_{target_sequence}'] = round((lowest_aligned + highest_misaligned) / 2, 3)
+    # how much lower than through the headers the similarity of a registration that found the misalignment is, see max_similarity_loss
+    if len(samples['loss']) > 0:
+        losses[f'{moving_sequence}_to_{target_sequence}'] = round(max(samples['loss']), 3)
+
+print(json.dumps({'min_similarity': thresholds, 'similarity_loss': losses}, indent=4))
+
+if not args.work_dir:
+    shutil.rmtree(work_folder)
@@ -0,0 +1,122 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import nibabel as nib
+import numpy as np
+from nibabel import processing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import setup_environment, summarize
+from phantoms import make_nifti_session
+
+parser = argparse.ArgumentParser(
+    prog='Stroke Segmentation Benchmark',
+    description='Times the stroke segmentation of phantom sessions (input preparation, inference and saving) and measures its peak memory, '
+                'for the batched float32 path of the pipeline and the previous slice by slice float64 path'
+)
+
+parser.add_argument('-n', '--sessions', type=int, default=4, help='Number of phantom sessions')
+parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of times each session is segmented by each path')
+parser.add_argument('--scale', type=float, default=1.0, help='In-plane matrix size factor of the phantoms, e.g. 2 for 256x256 dwis')
+parser.add_argument('--dwi-volumes', type=int, default=1, help='Number of volumes of the dwi niftis, more than 1 makes them 4d')
+parser.add_argument('--work-dir', help='Folder for the phantoms and outputs, kept after the run. Defaults to a temporary folder')
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+work_folder = args.work_dir or tempfile.mkdtemp(prefix='stroke_benchmark_')
+setup_environment(work_folder, args.scale, seed=args.seed)
+
+from utils.registration import get_cached_model, get_stroke_model_path, prepare_stroke_model_input, save_stroke_prediction
+from utils.registration.stroke_segmentation import IMG_SIZE, MAX_RESIZE_CHANNELS, resize_slices
+
+def segment_per_slice(subject: str, dwi: str, adc: str, output_folder: str) -> None:
+    # the stroke segmentation before it was batched: float64 tensors, cv2.resize of each slice, float64 segmentation
+    adc_img = nib.load(adc)
+    dwi_img = nib.load(dwi)
+    if dwi_img.ndim == 4:
+        dwi_img = nib.funcs.four_to_three(dwi_img)[0]
+    adc_img = processing.conform(adc_img, dwi_img.shape, dwi_img.header.get_zooms())
+
+    num_slices = dwi_img.shape[2]
+    X = np.empty((num_slices, IMG_SIZE, IMG_SIZE, 2))
+    adc_voxels = adc_img.get_fdata()
+    dwi_voxels = dwi_img.get_fdata()
+    for i in range(num_slices):
+        X[i, :, :, 0] = cv2.resize(dwi_voxels[:, :, i], (IMG_SIZE, IMG_SIZE))
+        X[i, :, :, 1] = cv2.resize(adc_voxels[:, :, i], (IMG_SIZE, IMG_SIZE))
+    X = X / np.max(X)
+
+    prediction = np.moveaxis(model.predict(X)[:, :, :, 1], 0, 2)
+    resized_prediction = np.zeros(dwi_img.shape)
+    for i in range(prediction.shape[2]):
+        resized_prediction[:, :, i] = cv2.resize(prediction[:, :, i], (dwi_img.shape[1], dwi_img.shape[0]))
+    resized_prediction = np.where(resized_prediction > 0.7, 1.0, 0.0).astype(int)
+
+    nib.save(nib.Nifti1Image(resized_prediction.astype(float), dwi_img.affine), os.path.join(output_folder, f'{subject}_stroke_segmentation.nii.gz'))
+
+def segment_batched(subject: str, dwi: str, adc: str, output_folder: str) -> None:
+    model_input = prepare_stroke_model_input(subject, dwi, adc)
+    save_stroke_prediction(subject, model.predict(model_input.X), model_input, output_folder)
+
+PATHS = {
+    'per-slice': segment_per_slice,
+    'batched': segment_batched,
+}
+
+rng = np.random.default_rng(args.seed)
+
+# stacks with more slices than cv2.resize takes channels are resized in chunks, which should match resizing each slice
+# (up to float32 rounding, cv2 interpolates many channels with other instructions)
+stack = rng.random((96, 80, 2 * MAX_RESIZE_CHANNELS + 1), dtype=np.float32)
+resized = resize_slices(stack, IMG_SIZE, IMG_SIZE)
+assert np.allclose(resized, np.stack([cv2.resize(stack[:, :, i], (IMG_SIZE, IMG_SIZE)) for i in range(stack.shape[2])], axis=2), atol=1e-6), \
+    f'resize_slices of {stack.shape[2]} slices differs from resizing each slice'
+
+sessions = []
+for i in range(args.sessions):
+    subject = f'SUBJ{i + 1:03d}'
+    paths = make_nifti_session(os.path.join(work_folder, 'root', subject), subject, rng, ['DWI', 'ADC'], args.scale, args.dwi_volumes)
+    sessions.append((subject, paths['DWI'], paths['ADC']))
+
+model = get_cached_model(get_stroke_model_path(False))
+
+timings = {name: [] for name in PATHS}
+peaks = {name: [] for name in PATHS}
+for name, segment in PATHS.items():
+    output_folder = os.path.join(work_folder, name)
+    os.makedirs(output_folder, exist_ok=True)
+
+    # the first call traces the model for the shapes of the session
+    segment(*sessions[0], output_folder)
+
+    for repeat in range(args.repeats):
+        for session in sessions:
+            # numpy allocations are traced, the peak is the largest memory the segmentation of one session held at once
+            tracemalloc.start()
+            start = time.perf_counter()
+            segment(*session, output_folder)
+            timings[name].append(time.perf_counter() - start)
+            peaks[name].append(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+            tracemalloc.stop()
+
+shape = nib.load(sessions[0][1]).shape
+print(f'\n{args.sessions} sessions x {args.repeats} repeats, dwi {shape}, work folder {work_folder}')
+for name in PATHS:
+    print(f'{name:10s} {summarize(timings[name])} per session, peak memory {np.mean(peaks[name]):7.1f} MiB')
+
+# both paths threshold the same prediction, the segmentations should match
+for subject, _, _ in sessions:
+    segmentations = [np.asarray(nib.load(os.path.join(work_folder, name, f'{subject}_stroke_segmentation.nii.gz')).dataobj) for name in PATHS]
+    if not np.array_equal(segmentations[0] != 0, segmentations[1] != 0):
+        print(f'{subject}: segmentations differ in {np.count_nonzero((segmentations[0] != 0) != (segmentations[1] != 0))} voxels')
+
+if not args.work_dir:
+    shutil.rmtree(work_folder)
@@ -0,0 +1,56 @@
+"""Tiny stand-ins for the trained models in models/, with the inputs and outputs of the real models.
+Each is a single 1x1 convolution with fixed weights that roughly finds the brain (mask models) or bright dwi with dark adc
+(stroke models) in the phantoms of phantoms.py, so the steps after inference get plausible masks and segmentations.
+
+    make_stub_models(folder), then point the pipeline to the folder with the PIPELINE_MODELS_FOLDER environment variable
+"""
+import os
+from typing import List
+
+import keras
+import numpy as np
+
+MASK_SEQUENCES = ['t1', 't2', 'fl']
+
+def make_model(dimensions: int, weights: List[float], bias: float) -> keras.Model:
+    """Makes a model classifying each voxel (3d) or pixel (2d) into background and foreground
+
+    Args:
+        dimensions (int): 2 or 3
+        weights (List[float]): Weight of each input channel for the foreground logit
+        bias (float): Bias of the foreground logit
+
+    Returns:
+        keras.Model: Model with spatial dimensions of any size, the output has 2 channels (background, foreground)
+    """
+    inputs = keras.Input((None,) * dimensions + (len(weights),))
+    convolution = (keras.layers.Conv3D if dimensions == 3 else keras.layers.Conv2D)(2, 1, activation='softmax')
+    model = keras.Model(inputs, convolution(inputs))
+
+    kernel = np.zeros((1,) * dimensions + (len(weights), 2), dtype=np.float32)
+    kernel[..., 1] = weights
+    convolution.set_weights([kernel, np.array([0, bias], dtype=np.float32)])
+    return model
+
+def make_stub_models(folder: str) -> str:
+    """Writes the stand-in models with the file names the pipeline loads, see utils/registration/model_cache.py
+
+    Args:
+        folder (str): The models folder (created)
+
+    Returns:
+        str: The folder
+    """
+    os.makedirs(os.path.join(folder, '2d'), exist_ok=True)
+    os.makedirs(os.path.join(folder, '3d'), exist_ok=True)
+
+    # inputs are normalized to the maximum of the image, the head is brighter than a fifth of it
+    for sequence in MASK_SEQUENCES:
+        make_model(3, [40], -8).save(os.path.join(folder, '3d', f'{sequence}_brain_extraction.keras'))
+    make_model(2, [40], -8).save(os.path.join(folder, '2d', 't1_brain_extraction.keras'))
+
+    # channels are the dwi (or b1000) and the adc
+    for name in ['dwi', 'b1000']:
+        make_model(2, [30, -30], -5).save(os.path.join(folder, '2d', f'stroke_segmentation_{name}.keras'))
+
+    return folder
@@ -0,0 +1,204 @@
+"""Stand-ins for the neuroimaging tools the pipeline runs (antsRegistration, antsApplyTransforms, fslmaths, bet, fslroi).
+They accept the command lines the pipeline builds and write outputs with the names, shapes and formats of the real tools,
+with a fraction of their cost, so the python side of the pipeline can be benchmarked without ANTs and FSL.
+
+    install_stub_tools(bin_folder) writes an executable per tool to the folder, put it first on PATH
+
+Setting STUB_TOOL_DELAY (seconds) makes every tool sleep, to simulate the cost of the real tools
+"""
+import os
+import re
+import sys
+import time
+from typing import List, Tuple
+
+import nibabel as nib
+import numpy as np
+import scipy.io
+import scipy.ndimage
+from nibabel import processing
+
+STUB_TOOLS = ['antsRegistration', 'antsApplyTransforms', 'fslmaths', 'bet', 'fslroi']
+
+def install_stub_tools(bin_folder: str) -> str:
+    """Writes an executable for each stub tool to a folder
+
+    Args:
+        bin_folder (str): The folder (created)
+
+    Returns:
+        str: The folder, to put first on PATH
+    """
+    os.makedirs(bin_folder, exist_ok=True)
+    for tool in STUB_TOOLS:
+        path = os.path.join(bin_folder, tool)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" {tool} "$@"\n')
+        os.chmod(path, 0o755)
+    return bin_folder
+
+def get_nifti_path(path: str) -> str:
+    # fsl adds .nii.gz to outputs given without an extension
+    return path if path.endswith('.nii') or path.endswith('.nii.gz') else path + '.nii.gz'
+
+def save(img: nib.Nifti1Image, path: str) -> None:
+    nib.save(img, get_nifti_path(path))
+
+def load_3d(path: str) -> nib.Nifti1Image:
+    # tools run with --dimensionality 3 use the first volume of 4d images
+    img = nib.load(path)
+    return nib.funcs.four_to_three(img)[0] if img.ndim == 4 else img
+
+def get_bracket_values(command: str, option: str) -> List[str]:
+    """Gets the values of an ANTs option given as --option [a, b, ...]
+
+    Args:
+        command (str): The command line
+        option (str): The option, e.g. output
+
+    Returns:
+        List[str]: The values, empty if the option is not given
+    """
+    match = re.search(rf'--{option}\s+\[([^\]]*)\]', command)
+    return [value.strip() for value in match.group(1).split(',')] if match else []
+
+def get_value(args: List[str], option: str) -> str:
+    return args[args.index(option) + 1]
+
+def write_itk_affine(path: str, matrix: np.ndarray, translation: np.ndarray) -> None:
+    """Writes a transform the way antsRegistration writes <prefix>0GenericAffine.mat (ITK's matlab format, LPS coordinates)
+
+    Args:
+        path (str): Path to .mat file
+        matrix (np.ndarray): 3x3 matrix
+        translation (np.ndarray): Translation (the center of rotation is the origin)
+    """
+    parameters = np.concatenate([matrix.ravel(), translation]).reshape(-1, 1)
+    scipy.io.savemat(path, {'AffineTransform_double_3_3': parameters, 'fixed': np.zeros((3, 1))}, format='4')
+
+def ants_registration(args: List[str]) -> None:
+    """Resamples the moving image to the fixed image and writes an identity transform, see config/registration_config.json"""
+    command = ' '.join(args)
+    prefix, warped = (get_bracket_values(command, 'output') + [None])[:2]
+    fixed, moving = get_bracket_values(command, 'initial-moving-transform')[:2]
+
+    fixed_img = load_3d(fixed)
+    moving_img = load_3d(moving)
+
+    write_itk_affine(prefix + '0GenericAffine.mat', np.eye(3), np.zeros(3))
+    if warped is not None:
+        save(processing.resample_from_to(moving_img, fixed_img, order=1), warped)
+
+    if 'SyN[' in command:
+        # displacement fields, 5d with the vector in the last dimension like ITK writes them
+        field = nib.Nifti1Image(np.zeros(fixed_img.shape[:3] + (1, 3), dtype=np.float32), fixed_img.affine)
+        field.header.set_intent('vector')
+        save(field, prefix + '1Warp.nii.gz')
+        save(field, prefix + '1InverseWarp.nii.gz')
+
+def ants_apply_transforms(args: List[str]) -> None:
+    """Resamples the input to the reference image (the stub transforms are identities)"""
+    command = ' '.join(args)
+    transform = (get_bracket_values(command, 'transform') or [get_value(args, '--transform')])[0]
+    scipy.io.loadmat(transform)
+
+    order = 0 if get_value(args, '--interpolation') in ['NearestNeighbor', 'MultiLabel', 'GenericLabel'] else 1
+    img = load_3d(get_value(args, '--input'))
+    save(processing.resample_from_to(img, load_3d(get_value(args, '--reference-image')), order=order), get_value(args, '--output'))
+
+def fslmaths(args: List[str]) -> None:
+    """Supports the operations the pipeline uses: -add, -sub, -mul, -div, -thr, -uthr, -bin and -odt"""
+    img = nib.load(get_nifti_path(args[0]))
+    data = img.get_fdata()
+
+    # fslmaths <in> [operations] <out> [-odt <type>]
+    if len(args) >= 3 and args[-2] == '-odt':
+        operations, output, dtype = args[1:-3], args[-3], args[-1]
+    else:
+        operations, output, dtype = args[1:-1], args[-1], None
+
+    i = 0
+    while i < len(operations):
+        operation = operations[i]
+        if operation == '-bin':
+            data = (data != 0).astype(float)
+            i += 1
+            continue
+
+        value = operations[i + 1]
+        operand = float(value) if re.fullmatch(r'-?[\d.]+(e-?\d+)?', value) else nib.load(get_nifti_path(value)).get_fdata()
+        if operation == '-add':
+            data = data + operand
+        elif operation == '-sub':
+            data = data - operand
+        elif operation == '-mul':
+            data = data * operand
+        elif operation == '-div':
+            data = np.divide(data, operand, out=np.zeros_like(data), where=np.asarray(operand) != 0)
+        elif operation == '-thr':
+            data = np.where(data < operand, 0, data)
+        elif operation == '-uthr':
+            data = np.where(data > operand, 0, data)
+        else:
+            raise ValueError(f'fslmaths stub does not support {operation}')
+        i += 2
+
+    dtypes = {'char': np.uint8, 'short': np.int16, 'int': np.int32, 'float': np.float32, 'double': np.float64}
+    save(nib.Nifti1Image(data.astype(dtypes.get(dtype, np.float32)), img.affine), output)
+
+def bet(args: List[str]) -> None:
+    """Thresholds the image at 10% of its robust range, keeps the largest component, -m writes <out>_mask, -n skips the brain"""
+    img = nib.load(get_nifti_path(args[0]))
+    output = args[1].replace('.nii.gz', '').replace('.nii', '')
+    data = img.get_fdata()
+
+    # bet's robust range
+    low, high = np.percentile(data, [2, 98])
+    mask = data > low + 0.1 * (high - low)
+    labels, count = scipy.ndimage.label(mask)
+    if count > 0:
+        mask = labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1
+    mask = scipy.ndimage.binary_fill_holes(mask)
+
+    if '-n' not in args:
+        save(nib.Nifti1Image((data * mask).astype(np.float32), img.affine), output)
+    if '-m' in args:
+        save(nib.Nifti1Image(mask.astype(np.uint8), img.affine), output + '_mask')
+
+def get_roi(args: List[str]) -> Tuple[slice, ...]:
+    values = [int(value) for value in args]
+    # fslroi <in> <out> <tmin> <tsize> or <xmin> <xsize> <ymin> <ysize> <zmin> <zsize> [<tmin> <tsize>]
+    if len(values) == 2:
+        return (slice(None),) * 3 + (slice(values[0], values[0] + values[1]),)
+    return tuple(slice(values[i], values[i] + values[i + 1]) for i in range(0, len(values), 2))
+
+def fslroi(args: List[str]) -> None:
+    """Crops the image like fslroi, cropping a single volume of a 4d image writes a 3d image"""
+    img = nib.load(get_nifti_path(args[0]))
+    roi = get_roi(args[2:])
+    data = np.asarray(img.dataobj)[roi]
+
+    affine = img.affine.copy()
+    starts = [s.start or 0 for s in roi[:3]] + [0] * (3 - len(roi[:3]))
+    affine[:3, 3] = img.affine[:3, :3] @ starts + img.affine[:3, 3]
+
+    if data.ndim == 4 and data.shape[3] == 1:
+        data = data[..., 0]
+    save(nib.Nifti1Image(data, affine, header=img.header), args[1])
+
+TOOLS = {
+    'antsRegistration': ants_registration,
+    'antsApplyTransforms': ants_apply_transforms,
+    'fslmaths': fslmaths,
+    'bet': bet,
+    'fslroi': fslroi,
+}
+
+if __name__ == '__main__':
+    # the step cache fingerprints the tools by their version
+    if sys.argv[2:] == ['--version']:
+        print(f'{sys.argv[1]} stand-in')
+        sys.exit(0)
+
+    time.sleep(float(os.environ.get('STUB_TOOL_DELAY', 0)))
+    TOOLS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,123 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import nibabel as nib
+import numpy as np
+import scipy.io
+from nibabel.processing import resample_from_to
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+fixtures_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'transforms')
+
+from utils.registration.linear_transform import read_itk_affine
+from utils.registration.apply_transform import apply_linear_transforms
+
+parser = argparse.ArgumentParser(
+    prog='Transform Check',
+    description='Checks the in-process application of antsRegistration transforms against hand-built transform files, against '
+                'nibabel\'s resample_from_to and against outputs of ANTs recorded in fixtures/transforms. Exits with 1 if a check fails'
+)
+
+parser.add_argument('--work-dir', help='Folder for the transform files and images, kept after the run. Defaults to a temporary folder')
+parser.add_argument('--seed', type=int, default=0)
+
+args = parser.parse_args()
+
+work_folder = args.work_dir or tempfile.mkdtemp(prefix='transform_check_')
+os.makedirs(work_folder, exist_ok=True)
+rng = np.random.default_rng(args.seed)
+
+def write_itk_affine(path: str, matrix, translation, center=None) -> str:
+    # the keys and shapes antsRegistration writes to <prefix>0GenericAffine.mat, in LPS
+    mat = {'AffineTransform_float_3_3': np.concatenate([np.ravel(matrix), translation]).astype(np.float32)[:, None]}
+    if center is not None:
+        mat['fixed'] = np.asarray(center, dtype=np.float32)[:, None]
+    scipy.io.savemat(path, mat, format='4')
+    return path
+
+failures = []
+
+def check(name: str, passed: bool, details: str = '') -> None:
+    print(f'{"ok  " if passed else "FAIL"} {name}' + (f': {details}' if details and not passed else ''))
+    if not passed:
+        failures.append(name)
+
+# hand-built transforms, the expected RAS matrices were worked out by hand:
+# T(x) = A (x - center) + center + translation in LPS, offset = translation + center - A center, then x and y are flipped (RAS = diag(-1, -1, 1) LPS)
+matrix = [[1, 0.5, 0], [0, 2, 0.25], [0.1, 0, 1]]
+fixtures = {
+    # offset (-9, -25.5, 2) in LPS, the x-z and y-z couplings change sign in RAS
+    'center and translation': (write_itk_affine(os.path.join(work_folder, 'centered_0GenericAffine.mat'), matrix, [1, 2, 3], [10, 20, 30]),
+                               [[1, 0.5, 0, 9], [0, 2, -0.25, 25.5], [-0.1, 0, 1, 2], [0, 0, 0, 1]]),
+    # without a center the translation is the offset
+    'translation only': (write_itk_affine(os.path.join(work_folder, 'uncentered_0GenericAffine.mat'), np.eye(3), [1, 2, 3]),
+                         [[1, 0, 0, -1], [0, 1, 0, -2], [0, 0, 1, 3], [0, 0, 0, 1]]),
+}
+for name, (path, expected) in fixtures.items():
+    transform = read_itk_affine(path)
+    check(f'read_itk_affine {name}', np.allclose(transform, expected, atol=1e-5), f'got\n{np.round(transform, 4)}')
+
+# linear interpolation through the transform files, compared with resample_from_to of the source moved by the transform
+source_affine = np.array([[-1.2, 0, 0.1, 40], [0, 0.9, 0, -30], [0, -0.05, 2.5, -20], [0, 0, 0, 1]])
+source = nib.Nifti1Image(rng.random((48, 56, 20), dtype=np.float32), source_affine)
+reference = nib.Nifti1Image(np.zeros((50, 50, 30), dtype=np.float32), np.array([[1, 0, 0, -10], [0, 1, 0, -40], [0, 0, 1.5, -5], [0, 0, 0, 1]]))
+source_path = os.path.join(work_folder, 'source.nii.gz')
+reference_path = os.path.join(work_folder, 'reference.nii.gz')
+nib.save(source, source_path)
+nib.save(reference, reference_path)
+
+for name, (path, _) in fixtures.items():
+    output_path = os.path.join(work_folder, 'linear.nii.gz')
+    code = apply_linear_transforms('check', [source_path], [path], reference_path, [output_path], 'linear')
+    # the image is sampled at T(reference point), i.e. the source with the affine inv(T) @ affine is resampled onto the reference
+    moved = nib.Nifti1Image(np.asarray(source.dataobj), np.linalg.inv(read_itk_affine(path)) @ source_affine)
+    expected = np.asarray(resample_from_to(moved, reference, order=1, mode='constant', cval=0.0).dataobj)
+    # resample_from_to zeros the half voxel past the edge voxel centers that ITK clamps to the edge, only the voxels sampled
+    # between the edge voxel centers are compared here, the edges are checked against ANTs below
+    between_centers = np.asarray(resample_from_to(nib.Nifti1Image(np.ones(source.shape, dtype=np.float32), moved.affine), reference, order=1, mode='constant', cval=0.0).dataobj) > 1 - 1e-6
+    resampled = np.asarray(nib.load(output_path).dataobj) if code == 0 else None
+    # coordinates are float32, voxels on the edge of the source may fall on either side of it
+    differ = np.count_nonzero(~np.isclose(resampled, expected, atol=1e-3) & between_centers) if resampled is not None else expected.size
+    check(f'linear resampling {name} matches resample_from_to', differ <= expected.size * 1e-3 and np.count_nonzero(between_centers) > 0,
+          f'{differ} of {np.count_nonzero(between_centers)} voxels differ')
+
+# nearest neighbour rounds halves up like ITK: a shift of half a voxel (-0.5 mm along L in LPS, +0.5 mm along R in RAS) samples
+# the next voxel along x, the last voxel samples outside of the image
+labels = nib.Nifti1Image(rng.integers(1, 255, (16, 12, 8), dtype=np.uint8), np.eye(4))
+labels_path = os.path.join(work_folder, 'labels.nii.gz')
+nib.save(labels, labels_path)
+half_voxel_path = write_itk_affine(os.path.join(work_folder, 'half_voxel_0GenericAffine.mat'), np.eye(3), [-0.5, 0, 0])
+output_path = os.path.join(work_folder, 'nearest.nii.gz')
+code = apply_linear_transforms('check', [labels_path], [half_voxel_path], labels_path, [output_path])
+expected = np.zeros(labels.shape, dtype=np.uint8)
+expected[:-1] = np.asarray(labels.dataobj)[1:]
+resampled = np.asarray(nib.load(output_path).dataobj) if code == 0 else None
+check('nearest neighbour rounds halves up', resampled is not None and np.array_equal(resampled, expected) and resampled.dtype == np.uint8,
+      f'{np.count_nonzero(resampled != expected) if resampled is not None else "all"} voxels differ')
+
+# outputs of antsApplyTransforms recorded by record_transform_fixtures.py: an oblique source on a reference grid reaching past it
+# (including the half voxel past the edge voxel centers) and the half voxel shift for nearest neighbour
+recordings = {
+    'linear': ('source.nii.gz', 'reference.nii.gz', 'centered_0GenericAffine.mat', 'linear', 'ants_linear.nii.gz'),
+    'nearest neighbour': ('labels.nii.gz', 'reference.nii.gz', 'centered_0GenericAffine.mat', 'nearest', 'ants_nearest.nii.gz'),
+    'nearest neighbour half voxel': ('half_voxel_labels.nii.gz', 'half_voxel_labels.nii.gz', 'half_voxel_0GenericAffine.mat', 'nearest', 'ants_half_voxel_nearest.nii.gz'),
+}
+for name, (moving_name, reference_name, transform_name, interpolation, recorded_name) in recordings.items():
+    output_path = os.path.join(work_folder, f'recorded_{recorded_name}')
+    code = apply_linear_transforms('check', [os.path.join(fixtures_folder, moving_name)], [os.path.join(fixtures_folder, transform_name)],
+                                   os.path.join(fixtures_folder, reference_name), [output_path], interpolation)
+    expected = np.asarray(nib.load(os.path.join(fixtures_folder, recorded_name)).dataobj)
+    resampled = np.asarray(nib.load(output_path).dataobj) if code == 0 else None
+    # ANTs computes the coordinates in double precision
+    differ = np.count_nonzero(~np.isclose(resampled, expected, atol=1e-2)) if resampled is not None else expected.size
+    check(f'{name} matches ANTs', differ == 0 and np.count_nonzero(expected) > 0, f'{differ} of {expected.size} voxels differ')
+
+if not args.work_dir:
+    shutil.rmtree(work_folder)
+
+if failures:
+    print(f'{len(failures)} checks failed')
+    sys.exit(1)
@@ -1,13 +1,8 @@
 import argparse
 import os
-import subprocess
-import json
-import pathlib
 
-from src.utils.base import find_all_sessions_for_subjects, get_all_subjects
-
-rpi_script_location = os.path.join(os.path.dirname(__file__), 'src', 'utils', 'registration', 'scripts', 'toRPI.sh')
-os.chmod(rpi_script_location, 0o755)
+from src.utils.base import find_all_sessions_for_subjects, get_all_subjects, get_dicom_index, is_step_done
+from src.utils.executor import get_executor, EXECUTORS
 
 
 parser = argparse.ArgumentParser(
@@ -16,58 +11,51 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument('-r', '--root', required=True)
-parser.add_argument('-s', '--step', required=True)
+step_group = parser.add_mutually_exclusive_group(required=True)
+step_group.add_argument('-s', '--step')
+step_group.add_argument('-t', '--target', help='Run only the steps needed to produce this artifact, e.g. brain or stroke_segmentation')
 parser.add_argument('-o', '--output-dir')
 parser.add_argument('-e', '--email')
 parser.add_argument('-f', '--subject-file')
+parser.add_argument('-F', '--force', action='store_true', help='Rerun steps even if their inputs have not changed since their last run')
+parser.add_argument('-R', '--resume', action='store_true', help='Skip sessions the step already completed for, and steps completed in an earlier (e.g. crashed or timed out) run')
+parser.add_argument('-b', '--batch', action='store_true', help='Process all sessions in one task, batching model inference across sessions (mask and segmentStroke steps only)')
+parser.add_argument('-x', '--executor', choices=EXECUTORS, default='slurm', help='slurm: one job with a task per session, array: a slurm job array reading sessions from a manifest, local: run on this machine without slurm')
+parser.add_argument('--sessions-per-task', type=int, help='Number of sessions each array task processes (array executor only)')
+parser.add_argument('--throttle', type=int, help='Maximum number of array tasks running at the same time (array executor only)')
+parser.add_argument('--workers', type=int, help='Number of sessions processed at the same time (local executor only)')
 
 args = parser.parse_args()
 
 if not args.output_dir:
     args.output_dir = args.root
 
+# jobs run from the src folder
+args.root = os.path.abspath(args.root)
+args.output_dir = os.path.abspath(args.output_dir)
 
-def get_sbatch_script(session_info_list, step, email, output_root_folder):
-    run_step_script_location = os.path.join(pathlib.Path(__file__).parent.resolve(), 'src')
-    return f"""#!/bin/bash
-
-#SBATCH --time=12:00:00
-#SBATCH --cpus-per-task=4
-#SBATCH --mem-per-cpu=4G
-#SBATCH --mail-type=ALL
-#SBATCH --ntasks={len(session_info_list)}
-{('#SBATCH --mail-user=' + email) if email else ''}
-
-module load python/3.8.0
-module load dcm2niix
-module load ANTs/2.3.2
-module load fsl/5.0.10
-module load afni/20191017
-module load openmpi/2.1.1
-module load libpng/1.2.59
-module load gsl
-export LD_PRELOAD=/usr/lib64/libfreetype.so
-source $FSLDIR/etc/fslconf/fsl.sh
-
-cd {run_step_script_location}
-
-export PYTHONPATH=/hpf/projects/ndlamini/scratch/wgao/python3.8.0/
-export TF_CPP_MIN_LOG_LEVEL=3
+if args.target:
+    args.step = f'target:{args.target}'
 
-python preprocess.py {step} {output_root_folder}
+# steps whose processors can batch work across sessions
+BATCHABLE_STEPS = ['mask', 'segmentStroke']
 
-{' & '.join([f"srun --ntasks 1 --nodes 1 -c 4 --quiet --job-name={session_info['session']} python3 run_step_for_subject.py '{json.dumps(session_info)}' {step}" for session_info in session_info_list])}
+if args.batch and args.step not in BATCHABLE_STEPS:
+    parser.error(f'--batch is only supported for the steps {BATCHABLE_STEPS}')
 
-wait
+if args.batch and args.executor == 'array':
+    parser.error('--batch runs all sessions in a single task, use it with the slurm or local executor')
 
-python postprocess.py {step} {output_root_folder}
 
-echo Done!
-"""
+# only folders changed since the last run are listed again, see src/utils/base/dicom_index.py
+os.makedirs(args.output_dir, exist_ok=True)
+dicom_index = get_dicom_index(args.output_dir)
+dicom_index.refresh(args.root)
 
 subjects = get_all_subjects(args.root, args.subject_file)
-subject_sessions = find_all_sessions_for_subjects(args.root, subjects)
+subject_sessions = find_all_sessions_for_subjects(args.root, subjects, dicom_index)
 session_info_list = []
+skipped = 0
 for subject in subject_sessions.keys():
     for session_folder in subject_sessions[subject]:
         session_name = session_folder.split(os.sep)[-1]
@@ -77,17 +65,21 @@ for subject in subject_sessions.keys():
         session_info["session_folder"] = session_folder
         session_info["output_folder"] = os.path.join(args.output_dir, subject) if subject == session_name else os.path.join(args.output_dir, subject, session_name)
         session_info["output_root"] = args.output_dir
+        if args.force:
+            session_info["force"] = True
+
+        if args.resume:
+            if is_step_done(session_info["output_folder"], args.step):
+                skipped += 1
+                continue
+            session_info["resume"] = True
         
         os.makedirs(session_info["output_folder"], exist_ok=True)
         session_info_list.append(session_info)
         
         
+if args.resume:
+    print(f'Resuming: skipped {skipped} sessions that completed {args.step} in an earlier run')
 
-p = subprocess.Popen(['sbatch'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, text=True)
-out, err = p.communicate(input=get_sbatch_script(session_info_list, args.step, args.email, args.output_dir))
-print(out, err)
-
-#print(get_sbatch_script(session_info_list, args.step, args.email, subjects, args.output_dir))
-        
-        
-
+executor = get_executor(args.executor, args.sessions_per_task, args.throttle, args.workers)
+executor.submit(session_info_list, args.step, args.output_dir, args.email, args.batch)
@@ -1,9 +1,10 @@
 from utils.postprocess import postprocessLesionHeatmap
+from processor.workflow import get_steps
 
 from sys import argv
 
 step = argv[1]
 output_folder = argv[2]
 
-if step == 'lesionHeatmap' or step == 'map':
+if 'lesionHeatmap' in (get_steps(step) or []):
     postprocessLesionHeatmap(output_folder)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
+from utils.base import get_session_index
 from utils.registration import register_nifti_to_target
 
 
@@ -7,7 +8,7 @@ import os
 
 class AdcRegistrationProcessor(SessionProcessor):
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def process_session(self, session_info: SessionInfo) -> bool:
         output_folder = session_info["output_folder"]
         subject_name = session_info["subject"]
         session_folder = session_info["session_folder"]
@@ -18,11 +19,12 @@ class AdcRegistrationProcessor(SessionProcessor):
         t2 = f'{nifti_prefix}_T2.nii.gz'
         fl = f'{nifti_prefix}_FL.nii.gz'
 
-        has_t1 = os.path.isfile(t1)
-        has_t2 = os.path.isfile(t2)
-        has_fl = os.path.isfile(fl)
+        output_index = get_session_index(output_folder, subject_name)
+        has_t1 = output_index.contains(t1)
+        has_t2 = output_index.contains(t2)
+        has_fl = output_index.contains(fl)
 
-        files_in_session_folder = os.listdir(session_folder)
+        nifti_files_in_session_folder = get_session_index(session_folder, subject_name).find()
 
         # now, register all the adc sequences
         adc_sequences = ['ADC', 'eADC']
@@ -40,12 +42,16 @@ class AdcRegistrationProcessor(SessionProcessor):
             register_to_seq = 'FL'
             register_to_file = fl
 
+        succeeded = True
         if register_to_seq is not None:
-            for file in files_in_session_folder:
+            for file in [x.name for x in nifti_files_in_session_folder]:
                 for sequence in adc_sequences:
-                    if sequence in file.split('_')[-1] and file.endswith('.nii.gz'):
+                    if sequence in file.split('_')[-1]:
                         output_file = os.path.join(output_folder, file)
                         moving_sequence = file.split('_')[-1].split('.')[0]
-                        register_nifti_to_target(subject_name, output_folder, register_to_file, output_file, moving_sequence, register_to_seq)
+                        if register_nifti_to_target(subject_name, output_folder, register_to_file, output_file, moving_sequence, register_to_seq) != 0:
+                            succeeded = False
         else:
-            print(f'Warning for {subject_name}: Subject has no T1 or T2 or FL to register adc')
\ No newline at end of file
+            print(f'Warning for {subject_name}: Subject has no T1 or T2 or FL to register adc')
+
+        return succeeded
\ No newline at end of file
@@ -1,33 +1,77 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
-from utils.registration import run_cmd
+from utils.base import get_session_index
+from utils.registration import apply_brain_mask
 
 from typing_extensions import override
+from typing import List, Optional, Tuple
 import os
 
 # Remember to add this processor to src/processor/__init__.py when you're done
 class BrainExtractionProcessor(SessionProcessor):
+    REQUIRES = ['registered', 'mask']
+    PRODUCES = ['brain']
+    CACHE_TOOLS = ['nibabel']
+
+    @override
+    def get_cache_inputs(self, session_info: SessionInfo) -> Optional[List[str]]:
+        # registered files, brain masks and the registration target
+        output_index = get_session_index(session_info["output_folder"], session_info["subject"])
+        return [x.path for x in output_index.find(role=['image', 'mask', 'mask_edit', 'registered']) if (x.view == 'AX' or x.target is not None) and x.target != 'template']
+
+    @override
+    def get_cache_outputs(self, session_info: SessionInfo) -> List[str]:
+        target, _, output_files = self.get_brain_files(session_info)
+        return output_files if target is not None else []
+
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def process_session(self, session_info: SessionInfo) -> bool:
         output_folder = session_info["output_folder"]
         subject_name = session_info["subject"]
-        session_folder = session_info["session_folder"]
         
+        output_index = get_session_index(output_folder, subject_name)
+
+        target, input_files, output_files = self.get_brain_files(session_info)
+        
+        if target is None:
+            print(f'Error for {subject_name}: Cannot find target registration sequence. Subject has no T1, T2, FL')
+            return False
+        
+        # first, find the mask, prefer edited masks
+        mask = output_index.get_mask(target)
+            
+        if mask is None:
+            print(f'Error for {subject_name}: Cannot find mask, skipping brain extraction')
+            return False
+
+        codes = apply_brain_mask(subject_name, mask.path, input_files, output_files)
+        return all(code == 0 for code in codes)
+
+    def get_brain_files(self, session_info: SessionInfo) -> Tuple[Optional[str], List[str], List[str]]:
+        """Finds the files to extract the brain of: all registered files and the registration target file
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            Tuple[str | None, List[str], List[str]]: The target sequence of the registered files (None if the session has no T1, T2 or FL),
+                the files and the paths of their brains
+        """
+        output_folder = session_info["output_folder"]
+        subject_name = session_info["subject"]
+        output_index = get_session_index(output_folder, subject_name)
+
         # find registered files:
-        registered_files = list(filter(lambda s: s.endswith('.nii.gz') and '_to_' in s and 'brain' not in s and 'template' not in s and 'SEG' not in s.upper() and 'STROKE' not in s.upper() and 'LESION' not in s.upper(), os.listdir(output_folder)))
+        registered_files = [x for x in output_index.find(role='registered') if x.target != 'template']
         
         # figure out the target sequence of the registered files
         nifti_prefix = os.path.join(output_folder, subject_name)
         target = None
         if len(registered_files) > 0:
-            target = registered_files[0].split('_to_')[1].split('_')[0]
+            target = registered_files[0].target
         else:
-            t1 = f'{nifti_prefix}_AX_T1.nii.gz'
-            t2 = f'{nifti_prefix}_AX_T2.nii.gz'
-            fl = f'{nifti_prefix}_AX_FL.nii.gz'
-            
-            has_t1 = os.path.isfile(t1)
-            has_t2 = os.path.isfile(t2)
-            has_fl = os.path.isfile(fl)
+            has_t1 = output_index.get_image('T1') is not None
+            has_t2 = output_index.get_image('T2') is not None
+            has_fl = output_index.get_image('FL') is not None
 
             if has_t1:
                 target = 'T1'
@@ -35,43 +79,10 @@ class BrainExtractionProcessor(SessionProcessor):
                 target = 'T2'
             elif has_fl:
                 target = 'FL'
-        
+
         if target is None:
-            print(f'Error for {subject_name}: Cannot find target registration sequence. Subject has no T1, T2, FL')
-            return
-        
-        # first, find the mask
-        possible_masks = list(filter(lambda s: 'mask' in s and target in s, os.listdir(output_folder)))
-        
-        # see if there is edit mask:
-        edit_masks = list(filter(lambda s: 'mask_edit' in s, possible_masks))
-        concensus_masks = list(filter(lambda s: s.endswith('_mask.nii.gz'), possible_masks))
-        
-        mask = None
-        
-        if len(edit_masks) > 0:
-            mask = edit_masks[0]
-        elif len(concensus_masks) > 0:
-            mask = concensus_masks[0]
-            
-        if mask is None:
-            print(f'Error for {subject_name}: Cannot find mask, skipping brain extraction')
-            return
-        
-        # perform brain extraction for all registered files
-        mask = os.path.join(session_folder, mask)
-        for registered_file in registered_files:
-            registered_file = os.path.join(session_folder, registered_file)
-            registered_brain = registered_file.split('.')[0] + '_brain.nii.gz'
-            _, err, code = run_cmd(f'fslmaths {registered_file} -mul {mask} {registered_brain}')
-            
-            if code != 0:
-                print(f'Warning for subject {subject_name}: brain extraction from mask failed for {registered_file}: {err}')
+            return None, [], []
 
-        # perform brain extraction for registration target file
-        target_file = f'{nifti_prefix}_AX_{target}.nii.gz'
-        target_brain = f'{nifti_prefix}_AX_{target}_brain.nii.gz'
-        _, err, code = run_cmd(f'fslmaths {target_file} -mul {mask} {target_brain}')
-        
-        if code != 0:
-            print(f'Warning for subject {subject_name}: brain extraction from mask failed for {target_file}: {err}')
\ No newline at end of file
+        input_files = [x.path for x in registered_files] + [f'{nifti_prefix}_AX_{target}.nii.gz']
+        output_files = [x.path.split('.')[0] + '_brain.nii.gz' for x in registered_files] + [f'{nifti_prefix}_AX_{target}_brain.nii.gz']
+        return target, input_files, output_files
@@ -1,60 +1,152 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
-from utils.registration import generate_brain_mask_using_3d_model, run_cmd
+from utils.base import get_session_index, command_context
+from utils.registration import generate_brain_mask_using_3d_model, get_cached_model, get_3d_mask_model_path, prepare_3d_mask_model_input, save_3d_mask_prediction, apply_brain_mask, chunk_sessions, predict_for_sessions
 
 from typing_extensions import override
+from typing import List, Optional, Tuple
 import os
 
 class BrainMaskProcessor(SessionProcessor):
+    # 3d volumes are large, keep batches small to bound activation memory
+    BATCH_SIZE = 2
+    REQUIRES = ['nifti']
+    PRODUCES = ['mask']
+    CACHE_TOOLS = ['keras', 'nibabel']
 
-    @override 
-    def process_session(self, session_info: SessionInfo) -> None:
-        output_folder = session_info["output_folder"]
+    @override
+    def get_cache_inputs(self, session_info: SessionInfo) -> Optional[List[str]]:
+        mask_target = self.get_mask_target(session_info)
+
+        if mask_target is None:
+            return []
+
+        return [mask_target[1], get_3d_mask_model_path(mask_target[0])]
+
+    @override
+    def get_cache_outputs(self, session_info: SessionInfo) -> List[str]:
+        mask_target = self.get_mask_target(session_info)
+
+        if mask_target is None:
+            return []
+
+        # the mask and the brain of the file it was generated for, see extract_brain
+        subject_name = session_info["subject"]
+        return [
+            os.path.join(session_info["output_folder"], f'{subject_name}_AX_{mask_target[0]}_mask.nii.gz'),
+            os.path.join(session_info["session_folder"], f'{subject_name}_AX_{mask_target[0]}_brain.nii.gz'),
+        ]
+
+    @override
+    def process_session(self, session_info: SessionInfo) -> bool:
         subject_name = session_info["subject"]
-        session_folder = session_info["session_folder"]
-
-        nifti_prefix = os.path.join(session_folder, subject_name)
-
-        t1 = f'{nifti_prefix}_AX_T1.nii.gz'
-        t2 = f'{nifti_prefix}_AX_T2.nii.gz'
-        fl = f'{nifti_prefix}_AX_FL.nii.gz'
-
-        has_t1 = os.path.isfile(t1)
-        has_t2 = os.path.isfile(t2)
-        has_fl = os.path.isfile(fl)
-
-        # figure out which file and sequence to create brain mask for
-        register_to_seq = None
-        register_to_file = None
-        if has_t1:
-            register_to_seq = 'T1'
-            register_to_file = t1
-        elif has_t2:
-            register_to_seq = 'T2'
-            register_to_file = t2
-        elif has_fl:
-            register_to_seq = 'FL'
-            register_to_file = fl
-        
-        if register_to_seq is not None:
+        output_folder = session_info["output_folder"]
+
+        mask_target = self.get_mask_target(session_info)
+
+        if mask_target is not None:
+            register_to_seq, register_to_file = mask_target
             code = generate_brain_mask_using_3d_model(subject_name, register_to_seq, register_to_file, output_folder)
-            
-            if code != 0:
-                return
-    
-            # extract brain
-            # first, find mask
-            
-            masks = [os.path.join(output_folder, x) for x in os.listdir(output_folder) if 'mask' in x.lower() and register_to_seq in x.upper()]
-            if len(masks) > 1:
-                print(f'Warning for {subject_name} found multiple brain masks: {masks}\n\tusing {masks[0]}')
-
-            _, err, code = run_cmd(f'fslmaths {register_to_file} -mul {masks[0]} {f"{nifti_prefix}_AX_{register_to_seq}_brain.nii.gz"}')
-            
+
             if code != 0:
-                print(f'Error for {subject_name}: could not extract brain using mask for {register_to_file}:\n{err}')
+                return False
 
+            return self.extract_brain(session_info, register_to_seq, register_to_file)
         else:
             print(f'Warning for {subject_name}: Subject has no T1 or T2 or FL to create brain mask for')
+            return True
+
+    @override
+    def process_sessions(self, session_info_list: List[SessionInfo], step: str) -> List[bool]:
+        succeeded = [True] * len(session_info_list)
+
+        # group sessions by the sequence (and therefore model) their mask is generated for
+        sessions_per_sequence = {}
+        for i, session_info in enumerate(session_info_list):
+            mask_target = self.get_mask_target(session_info)
+
+            if mask_target is None:
+                print(f'Warning for {session_info["subject"]}: Subject has no T1 or T2 or FL to create brain mask for')
+                continue
+
+            sessions_per_sequence.setdefault(mask_target[0], []).append((i, session_info, mask_target[1]))
+
+        for sequence, sessions in sessions_per_sequence.items():
+            model = get_cached_model(get_3d_mask_model_path(sequence))
+
+            for sessions_chunk in chunk_sessions(sessions):
+                # an error in one session does not stop the others
+                prepared_sessions = []
+                for i, session_info, target_file in sessions_chunk:
+                    try:
+                        with command_context(step, session_info):
+                            model_input = prepare_3d_mask_model_input(session_info["subject"], target_file)
+                    except Exception as e:
+                        print(f'Error for {session_info["subject"]}: could not read {target_file}: {e}')
+                        model_input = None
+
+                    if model_input is not None:
+                        prepared_sessions.append((i, session_info, target_file, model_input))
+                    else:
+                        succeeded[i] = False
+
+                print(f'Generating masks for {len(prepared_sessions)} {sequence} sessions...', flush=True)
+                try:
+                    predictions = predict_for_sessions(model, [model_input.X for _, _, _, model_input in prepared_sessions], self.BATCH_SIZE)
+                except Exception as e:
+                    for i, session_info, _, _ in prepared_sessions:
+                        print(f'Error for {session_info["subject"]}: mask generation failed: {e}')
+                        succeeded[i] = False
+                    continue
+
+                for (i, session_info, target_file, model_input), prediction in zip(prepared_sessions, predictions):
+                    try:
+                        # the commands of each session are recorded to its own commands.jsonl
+                        with command_context(step, session_info):
+                            code = save_3d_mask_prediction(session_info["subject"], sequence, prediction[0, :, :, :, 1], model_input, session_info["output_folder"])
+                            succeeded[i] = code == 0 and self.extract_brain(session_info, sequence, target_file)
+                    except Exception as e:
+                        print(f'Error for {session_info["subject"]}: could not save the mask or extract the brain: {e}')
+                        succeeded[i] = False
+
+        return succeeded
+
+    def get_mask_target(self, session_info: SessionInfo) -> Optional[Tuple[str, str]]:
+        """Figures out which file and sequence to create brain mask for
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            Tuple[str, str] | None: The sequence and path of the file, None if the session has no T1 or T2 or FL
+        """
+        session_index = get_session_index(session_info["session_folder"], session_info["subject"])
+
+        for sequence in ['T1', 'T2', 'FL']:
+            image = session_index.get_image(sequence)
+            if image is not None:
+                return sequence, image.path
+
+        return None
+
+    def extract_brain(self, session_info: SessionInfo, register_to_seq: str, register_to_file: str) -> bool:
+        """Extracts the brain of the file the mask was generated for
+
+        Args:
+            session_info (SessionInfo): The session
+            register_to_seq (str): Sequence the mask was generated for
+            register_to_file (str): Path to the file the mask was generated for
+
+        Returns:
+            bool: True if the brain was extracted
+        """
+        output_folder = session_info["output_folder"]
+        subject_name = session_info["subject"]
+        nifti_prefix = os.path.join(session_info["session_folder"], subject_name)
+
+        # first, find mask
+        masks = [x.path for x in get_session_index(output_folder, subject_name).find(role=['mask', 'mask_edit'], sequence=register_to_seq)]
+        if len(masks) > 1:
+            print(f'Warning for {subject_name} found multiple brain masks: {masks}\n\tusing {masks[0]}')
 
-        
-        
\ No newline at end of file
+        codes = apply_brain_mask(subject_name, masks[0], [register_to_file], [f'{nifti_prefix}_AX_{register_to_seq}_brain.nii.gz'])
+        return all(code == 0 for code in codes)
@@ -1,43 +1,66 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
-from utils.base import find_sequences_for_session
-from utils.registration import convert_dcm_folder_to_nifti
+from utils.base import find_sequences_for_session, get_session_index, get_dicom_index, save_nifti, load_intensities, load_volume, intensity_image, DicomIndex, ANY
+from utils.registration import convert_dcm_folders_to_nifti
 
 from typing_extensions import override
+from typing import List, Optional
 import os
 import nibabel as nib
 from nibabel import processing
 
 class DcmToNiftiProcessor(SessionProcessor):
     FLE_STRING = 'FLE'
+    PRODUCES = ['nifti']
+    OUTPUT_BECOMES_SESSION_FOLDER = True
+    CACHE_CONFIG_FILES = ['sequence_string_lists.json']
+    CACHE_TOOLS = ['dicom2nifti', 'nibabel']
+    # number of dicom folders converted at the same time, None for one per cpu
+    CONVERSION_WORKERS = None
 
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def get_cache_inputs(self, session_info: SessionInfo) -> Optional[List[str]]:
+        sequences = find_sequences_for_session(session_info["session_folder"], self.get_dicom_index(session_info))
+        return [dcm_folder for dcm_folders in sequences.values() for dcm_folder in dcm_folders]
+
+    @override
+    def get_cache_outputs(self, session_info: SessionInfo) -> List[str]:
+        # the converted niftis (with the b-values and vectors of diffusion series) and the dwis replaced by the reoriented ones
+        output_index = get_session_index(session_info["output_folder"], session_info["subject"])
+        output_index.refresh(force=True)
+        return [x.path for x in output_index.find(target=None, role=['image', 'old'], extension=['.nii.gz', '.bval', '.bvec']) if x.view is not None]
+
+    @override
+    def process_session(self, session_info: SessionInfo) -> bool:
         output_folder = session_info["output_folder"]
         subject_name = session_info["subject"]
         session_folder = session_info["session_folder"]
 
-        sequences = find_sequences_for_session(session_folder)
+        dicom_index = self.get_dicom_index(session_info)
+        sequences = find_sequences_for_session(session_folder, dicom_index)
         # convert all dcm folders to nifti
+        dcm_folders = []
         for sequence in sequences.keys():
             for dcm_folder in sequences[sequence]:
                 # ignore t1-fle folders
                 if sequence == 'T1' and 'FLE' in dcm_folder: continue
 
-                convert_dcm_folder_to_nifti(subject_name, output_folder, dcm_folder, sequence)
+                dcm_folders.append((sequence, dcm_folder))
+
+        # without the index the views are read from the dicom folders
+        views = [dicom_index.get_view(dcm_folder) for _, dcm_folder in dcm_folders] if dicom_index is not None else None
+        converted = convert_dcm_folders_to_nifti(subject_name, output_folder, dcm_folders, self.CONVERSION_WORKERS, views)
 
         # if we have dwi and adc, reorient dwi
-        dwi_nifti_files = [x for x in os.listdir(output_folder) if x.endswith('.nii.gz') and 'DWI' in x and 'BRAIN' not in x.upper() and 'OLD' not in x.upper() and '_TO_' not in x.upper()]
+        output_index = get_session_index(output_folder, subject_name)
+        dwi_nifti_files = [x.name for x in output_index.find(role='image', target=None) if x.sequence is not None and 'DWI' in x.sequence]
         for dwi_file in dwi_nifti_files:
             adc_file = dwi_file.replace('DWI', 'ADC')
             adc_full_path = os.path.join(output_folder, adc_file)
             dwi_full_path = os.path.join(output_folder, dwi_file)
-            if not os.path.exists(adc_full_path):
+            if not output_index.contains(adc_file):
                 continue
             
-            dwi = nib.funcs.squeeze_image(nib.load(dwi_full_path))
-
-            if dwi.ndim == 4:
-                dwi = nib.funcs.four_to_three(dwi)[0]
+            dwi = load_volume(nib.funcs.squeeze_image(nib.load(dwi_full_path)))
 
             adc = nib.load(adc_full_path)
 
@@ -45,11 +68,29 @@ class DcmToNiftiProcessor(SessionProcessor):
             dwi_reorient = processing.conform(dwi, adc.shape, adc.header.get_zooms())
 
             # rename old dwi files
-            old_dwi_files = [x for x in os.listdir(output_folder) if 'DWI' in x and 'OLD' not in x.upper() and not 'TO' in x.upper()]
+            old_dwi_files = [x.name for x in output_index.find(extension=ANY, target=None) if 'DWI' in x.name and x.role != 'old']
             for old_dwi_file in old_dwi_files:
                 full_path = os.path.join(output_folder, old_dwi_file)
                 new_path = os.path.join(output_folder, old_dwi_file.replace('DWI', 'DWI_old'))
                 os.rename(full_path, new_path)
 
             # save reoriented dwi file
-            nib.save(nib.Nifti1Image(dwi_reorient.get_fdata(), adc.affine), dwi_full_path)
\ No newline at end of file
+            save_nifti(intensity_image(load_intensities(dwi_reorient), adc.affine), dwi_full_path)
+
+        # folders that could not be converted were printed
+        return all(converted)
+
+    def get_dicom_index(self, session_info: SessionInfo) -> Optional[DicomIndex]:
+        """Gets the dicom index run.py wrote to the output root before submitting, opened read-only since all tasks of
+        a job share it. Only checks (one stat per folder) that the session's folders did not change since
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            DicomIndex | None: The index, None if there is none or the session changed (its folders are then read directly)
+        """
+        dicom_index = get_dicom_index(session_info["output_root"], read_only=True)
+        if dicom_index is None or not dicom_index.is_current(session_info["session_folder"]):
+            return None
+        return dicom_index
\ No newline at end of file
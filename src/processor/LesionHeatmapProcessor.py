@@ -1,27 +1,44 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
+from utils.base import get_session_index
 from utils.registration import run_cmd
 from utils.filelock import LockedFile
+from utils.postprocess import saveLesionHeatmapPartial
 
 from typing_extensions import override
 import os
 from datetime import date
 
 class LesionHeatmapProcessor(SessionProcessor):
+    REQUIRES = ['template']
+    PRODUCES = ['heatmap']
+
+    def __init__(self, aggregate: bool = True):
+        """
+        Args:
+            aggregate (bool): If true, each session only writes its lesion as a partial and postprocess.py sums all partials
+                into the heatmap. If false, each session adds its lesion to the heatmap itself while holding a lock. Default true
+        """
+        self.aggregate = aggregate
+
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def process_session(self, session_info: SessionInfo) -> bool:
         output_folder = session_info["output_root"]
         subject_name = session_info["subject"]
         session_folder = session_info["session_folder"]
         
-        lesion_files = list(filter(lambda s: ('seg' in s.lower() or 'lesion' in s.lower() or 'stroke' in s.lower()) and '_to_template' in s.lower(), os.listdir(session_folder)))
+        lesion_files = [x.name for x in get_session_index(session_folder, subject_name).find(role='registered_segmentation', target='template')]
 
         # if has no lesion file, then nothing to do
         if len(lesion_files) == 0:
             print(f'Error for subject {subject_name}: Cannot find lesion file')
-            return
+            return False
         
         
         lesion_file_path = os.path.join(session_folder, lesion_files[0])
+
+        if self.aggregate:
+            saveLesionHeatmapPartial(output_folder, subject_name, session_info["session"], lesion_file_path)
+            return True
         
         # has lesion file
         heatmap_file = f'lesion_heatmap_{date.today().strftime("%y-%m-%d")}'
@@ -38,10 +55,16 @@ class LesionHeatmapProcessor(SessionProcessor):
                     print(f'Subject {subject_name} is the first segmentation, creating lesion map')
                     locked_name_file.truncate(0)
                     
-                    # copy seg file as lesion file
-                    out, err, status = run_cmd(f'cp {lesion_file_path} {heatmap_file_path}')
+                    # copy seg file as lesion file, as float so the sum of uint8 segmentations does not overflow
+                    out, err, status = run_cmd(f'fslmaths {lesion_file_path} {heatmap_file_path} -odt float')
                     print(out, err)
                 else:
-                    run_cmd(f'fslmaths {heatmap_file_path} -add {lesion_file_path} {heatmap_file_path}')
+                    out, err, status = run_cmd(f'fslmaths {heatmap_file_path} -add {lesion_file_path} {heatmap_file_path}')
+
+                if status != 0:
+                    print(f'Error for subject {subject_name}: Could not add lesion to heatmap: {err}')
+                    return False
 
                 locked_name_file.write(f'{subject_name} added to heatmap: {heatmap_file_path}\n')
+
+        return True
@@ -1,100 +1,143 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
-from utils.registration import register_nifti_to_target, run_cmd
+from utils.base import get_session_index
+from utils.registration import register_niftis_to_target, get_registration_outputs, RegistrationJob, apply_brain_mask
 
 
 from typing_extensions import override
+from typing import List, Optional
 import os
 
 class RegistrationProcessor(SessionProcessor):
+    REQUIRES = ['nifti', 'mask']
+    PRODUCES = ['registered']
+    CACHE_CONFIG_FILES = ['registration_config.json', 'registration_fast_config.json', 'registration_profiles.json']
+    CACHE_TOOLS = ['ants', 'nibabel']
+
+    @override
+    def get_cache_inputs(self, session_info: SessionInfo) -> Optional[List[str]]:
+        # raw sequences and brain masks (including hand edited masks)
+        session_index = get_session_index(session_info["session_folder"], session_info["subject"])
+        return [x.path for x in session_index.find(view='AX', target=None) if x.role not in ['brain', 'resampled']]
+
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def get_cache_outputs(self, session_info: SessionInfo) -> List[str]:
+        output_folder = session_info["output_folder"]
+        subject_name = session_info["subject"]
+        target = self.get_target(session_info)
+
+        if target is None:
+            return []
+
+        # the target brain and the transform and warped image of every registration
+        outputs = [os.path.join(output_folder, f'{subject_name}_AX_{target}_brain.nii.gz')]
+        for job in self.get_registration_jobs(session_info, target):
+            outputs.extend(get_registration_outputs(subject_name, output_folder, job.moving_sequence, job.target_sequence))
+        return outputs
+
+    @override
+    def process_session(self, session_info: SessionInfo) -> bool:
         output_folder = session_info["output_folder"]
         subject_name = session_info["subject"]
-        session_folder = session_info["session_folder"]
 
         nifti_prefix = os.path.join(output_folder, subject_name)
+        output_index = get_session_index(output_folder, subject_name)
 
-        t1 = f'{nifti_prefix}_AX_T1.nii.gz'
-        t2 = f'{nifti_prefix}_AX_T2.nii.gz'
-        fl = f'{nifti_prefix}_AX_FL.nii.gz'
-        
-        has_t1 = os.path.isfile(t1)
-        has_t2 = os.path.isfile(t2)
-        has_fl = os.path.isfile(fl)
-        
-        target = None
-        if has_t1:
-            target = 'T1'
-        elif has_t2:
-            target = 'T2'
-        elif has_fl:
-            target = 'FL'
+        target = self.get_target(session_info)
         
         if target is None:
             print(f'Error for {subject_name}: Cannot find target registration sequence. Subject has no T1, T2, FL')
-            return
-        
-        # first, find the mask
-        possible_masks = list(filter(lambda s: 'mask' in s and target in s, os.listdir(output_folder)))
-        
-        # see if there is edit mask:
-        edit_masks = list(filter(lambda s: 'mask_edit' in s, possible_masks))
-        concensus_masks = list(filter(lambda s: s.endswith('_mask.nii.gz'), possible_masks))
-        
-        mask = None
+            return False
         
-        if len(edit_masks) > 0:
-            mask = edit_masks[0]
-        elif len(concensus_masks) > 0:
-            mask = concensus_masks[0]
+        # first, find the mask, prefer edited masks
+        mask = output_index.get_mask(target)
             
         if mask is None:
             print(f'Error for {subject_name}: Cannot find mask, stopping registration...')
-            return
+            return False
         
          # perform brain extraction for registration target file
         target_file = f'{nifti_prefix}_AX_{target}.nii.gz'
         target_brain = f'{nifti_prefix}_AX_{target}_brain.nii.gz'
-        _, err, code = run_cmd(f'fslmaths {target_file} -mul {mask} {target_brain}')
-        
-        if code != 0:
-            print(f'Error for subject {subject_name}: brain extraction from mask failed for {target_file}. Stopping registration: {err}')
+        if any(code != 0 for code in apply_brain_mask(subject_name, mask.path, [target_file], [target_brain])):
+            return False
+
+        # failed registrations were printed
+        results = register_niftis_to_target(subject_name, output_folder, target_brain, self.get_registration_jobs(session_info, target))
+        return all(result.code == 0 for result in results)
+
+    def get_target(self, session_info: SessionInfo) -> Optional[str]:
+        """Figures out which sequence the other sequences are registered to
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            str | None: T1, T2 or FL, None if the session has none of them
+        """
+        output_index = get_session_index(session_info["output_folder"], session_info["subject"])
+
+        for sequence in ['T1', 'T2', 'FL']:
+            if output_index.get_image(sequence) is not None:
+                return sequence
+
+        return None
 
-        files_in_session_folder = os.listdir(session_folder)
-        is_raw_sequence_nifti = lambda file, sequence: file.endswith('.nii.gz') and sequence.upper() in file.upper() and not '_to_' in file and '_AX_' in file and 'brain' not in file and 'resampled' not in file and 'MASK' not in file.upper() and 'OLD' not in file.upper()
+    def get_registration_jobs(self, session_info: SessionInfo, target: str) -> List[RegistrationJob]:
+        """Gets the registrations of a session
 
-        for file in files_in_session_folder:
-            output_file = os.path.join(output_folder, file)
-            moving_sequence = file.split('_')[-1].split('.')[0] if len(file.split('_')) >= 2 else ''
-            if is_raw_sequence_nifti(file, 'T1') and not file.endswith('_T1.nii.gz') and has_t1:
+        Args:
+            session_info (SessionInfo): The session
+            target (str): The registration target, see get_target
+
+        Returns:
+            List[RegistrationJob]: The niftis to register, they run concurrently
+        """
+        output_folder = session_info["output_folder"]
+        subject_name = session_info["subject"]
+        output_index = get_session_index(output_folder, subject_name)
+
+        has_t1 = output_index.get_image('T1') is not None
+        has_t2 = output_index.get_image('T2') is not None
+        has_fl = output_index.get_image('FL') is not None
+
+        # raw images, e.g. <subject>_AX_T2.nii.gz or <subject>_AX_T1_1.nii.gz
+        raw_niftis = get_session_index(session_info["session_folder"], subject_name).find(view='AX', role='image')
+        # registrations are collected and run concurrently
+        jobs = []
+        is_sequence = lambda file, sequence: file.sequence is not None and sequence.upper() in file.sequence.upper()
+        # the images the others are registered to, e.g. <subject>_AX_T1.nii.gz
+        is_target_image = lambda file, sequences: file.variant is None and file.sequence in sequences
+
+        for file in raw_niftis:
+            output_file = os.path.join(output_folder, file.name)
+            moving_sequence = file.name.split('_')[-1].split('.')[0]
+            if is_sequence(file, 'T1') and not is_target_image(file, ['T1']) and has_t1:
                 # register files like <subject>_T1b.nii.gz to t1
-                register_nifti_to_target(subject_name, output_folder, target_brain, output_file, moving_sequence, 'T1')
+                jobs.append(RegistrationJob(output_file, moving_sequence, 'T1'))
             
-            if is_raw_sequence_nifti(file, 'T2') and has_t1:
-                register_nifti_to_target(subject_name, output_folder, target_brain, output_file, moving_sequence, 'T1')
-            elif is_raw_sequence_nifti(file, 'T2') and not file.endswith('_T2.nii.gz') and has_t2:
+            if is_sequence(file, 'T2') and has_t1:
+                jobs.append(RegistrationJob(output_file, moving_sequence, 'T1'))
+            elif is_sequence(file, 'T2') and not is_target_image(file, ['T2']) and has_t2:
                 # register files like <subject>_T2b.nii.gz to t2
-                register_nifti_to_target(subject_name, output_folder, target_brain, output_file, moving_sequence, 'T2')
+                jobs.append(RegistrationJob(output_file, moving_sequence, 'T2'))
             
-            if is_raw_sequence_nifti(file, 'FL') and has_t1:
-                register_nifti_to_target(subject_name, output_folder, target_brain, output_file, moving_sequence, 'T1')
-            elif is_raw_sequence_nifti(file, 'FL') and has_t2:
-                register_nifti_to_target(subject_name, output_folder, target_brain, output_file, moving_sequence, 'T2')
-            elif is_raw_sequence_nifti(file, 'FL') and not file.endswith('_FL.nii.gz') and not file.endswith('_FLAIR.nii.gz') and has_fl:
+            if is_sequence(file, 'FL') and has_t1:
+                jobs.append(RegistrationJob(output_file, moving_sequence, 'T1'))
+            elif is_sequence(file, 'FL') and has_t2:
+                jobs.append(RegistrationJob(output_file, moving_sequence, 'T2'))
+            elif is_sequence(file, 'FL') and not is_target_image(file, ['FL', 'FLAIR']) and has_fl:
                 # register files like <subject>_FLb.nii.gz to fl
-                register_nifti_to_target(subject_name, output_folder, target_brain, output_file, moving_sequence, 'FL')
+                jobs.append(RegistrationJob(output_file, moving_sequence, 'FL'))
 
         # now, register all the other sequences
         other_sequences = ['DWI', 'b0', 'b1000', 'ADC', 'eADC', 'b2600']
 
-        if target is not None:
-            for file in files_in_session_folder:
-                file_name = file.split(os.sep)[-1]
-                for sequence in other_sequences:
-                    if is_raw_sequence_nifti(file_name, sequence):
-                        output_file = os.path.join(output_folder, file)
-                        moving_sequence = file.split('_')[-1].split('.')[0]
-                        register_nifti_to_target(subject_name, output_folder, target_brain, output_file, moving_sequence, target)
-                        break
-        else:
-            print(f'Warning for {subject_name}: Subject has no T1 or T2 or FL brain to register files')
+        for file in raw_niftis:
+            for sequence in other_sequences:
+                if is_sequence(file, sequence):
+                    output_file = os.path.join(output_folder, file.name)
+                    moving_sequence = file.name.split('_')[-1].split('.')[0]
+                    jobs.append(RegistrationJob(output_file, moving_sequence, target))
+                    break
+
+        return jobs
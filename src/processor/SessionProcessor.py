@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import NamedTuple
+from typing import List, NamedTuple, Optional
+
+from utils.base import command_context
 
 
 class SessionInfo(NamedTuple):
@@ -7,8 +9,69 @@ class SessionInfo(NamedTuple):
     session: str
     session_path: str
     output_folder: str
-    
+
 class SessionProcessor(ABC):
+    # artifacts (see processor/workflow.py) this processor needs and creates, used to order the steps of a workflow
+    REQUIRES: List[str] = []
+    PRODUCES: List[str] = []
+    # if true, the output folder becomes the session folder of the steps after this one
+    OUTPUT_BECOMES_SESSION_FOLDER = False
+
+    # config files (in /config) and tools (see utils/cache) whose changes invalidate this processor's cached outputs
+    CACHE_CONFIG_FILES: List[str] = []
+    CACHE_TOOLS: List[str] = []
+
     @abstractmethod
-    def process_session(self, session_info: SessionInfo) -> None:
-        pass
\ No newline at end of file
+    def process_session(self, session_info: SessionInfo) -> bool:
+        """Processes a session. Errors are printed (`Error for <subject>: ...`) and reported by returning False,
+        a session the step has nothing to do for (printed as a warning) is not a failure
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            bool: True if the session was processed, False if the step failed for it
+        """
+        pass
+
+    def process_sessions(self, session_info_list: List[SessionInfo], step: str) -> List[bool]:
+        """Processes many sessions in one process. Processors that can share work between sessions
+        (e.g. batching model inference) override this, by default each session is processed on its own.
+        A session that fails does not stop the others
+
+        Args:
+            session_info_list (List[SessionInfo]): The sessions to process
+            step (str): The step being run, the external commands of each session are recorded for it (see command_context)
+
+        Returns:
+            List[bool]: Whether each session succeeded, see process_session
+        """
+        succeeded = []
+        for session_info in session_info_list:
+            with command_context(step, session_info):
+                succeeded.append(self.process_session(session_info))
+        return succeeded
+
+    def get_cache_inputs(self, session_info: SessionInfo) -> Optional[List[str]]:
+        """Gets the files and folders this processor reads for a session. The step cache skips the processor
+        when none of them changed since its last run. By default processors are not cached and always run
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            List[str] | None: Paths to the inputs, None if the processor should always run
+        """
+        return None
+
+    def get_cache_outputs(self, session_info: SessionInfo) -> List[str]:
+        """Gets the files this processor writes for a session. The step cache asks for them once the processor succeeded
+        and runs the processor again when one of them is missing. Processors that are cached (see get_cache_inputs) override this
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            List[str]: Paths to the outputs
+        """
+        return []
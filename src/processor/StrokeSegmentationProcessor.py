@@ -1,78 +1,220 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
-from utils.registration import segment_stroke, apply_linear_transform
+from utils.base import get_session_index, save_nifti, load_labels, label_image, command_context
+from utils.registration import segment_stroke, apply_linear_transform, get_cached_model, get_stroke_model_path, prepare_stroke_model_input, save_stroke_prediction, chunk_sessions, predict_for_sessions
 
 from typing_extensions import override
+from typing import List, NamedTuple, Optional, Tuple
 import os
 import nilearn.image
 import nibabel as nib
-import numpy as np
+
+class StrokeInputs(NamedTuple):
+    dwi_or_b1000: str
+    adc: str
+    has_b1000: bool
 
 class StrokeSegmentationProcessor(SessionProcessor):
+    # number of 2d slices per forward pass when batching sessions
+    BATCH_SIZE = 256
+    REQUIRES = ['nifti', 'registered']
+    PRODUCES = ['stroke_segmentation']
+    CACHE_TOOLS = ['keras']
+
+    @override
+    def get_cache_inputs(self, session_info: SessionInfo) -> Optional[List[str]]:
+        stroke_inputs = self.get_stroke_inputs(session_info)
+
+        if stroke_inputs is None:
+            return []
+
+        # the files segmented on, the registration targets and the dwi or b1000 registration used to move the segmentation
+        # (only the transform and warped image, other files of the registration may be written by brainExtraction at the same time)
+        session_index = get_session_index(session_info["session_folder"], session_info["subject"])
+        targets = [x.path for x in session_index.find(view='AX', sequence=['T1', 'T2', 'FL'], variant=None, role='image')]
+        target = self.get_target(session_info)
+        registration_files = list(self.get_registration_files(session_info, stroke_inputs, target)) if target is not None else []
+
+        return [stroke_inputs.dwi_or_b1000, stroke_inputs.adc, get_stroke_model_path(not stroke_inputs.has_b1000)] + targets + registration_files
+
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def get_cache_outputs(self, session_info: SessionInfo) -> List[str]:
+        if self.get_stroke_inputs(session_info) is None:
+            return []
+
+        # the segmentation and the segmentation registered to the target, see register_segmentation
         output_folder = session_info["output_folder"]
         subject_name = session_info["subject"]
-        session_folder = session_info["session_folder"]
-        
-        nifti_prefix = os.path.join(session_folder, subject_name)
+        return [
+            os.path.join(output_folder, f'{subject_name}_stroke_segmentation.nii.gz'),
+            os.path.join(output_folder, f'{subject_name}_stroke_segmentation_to_{self.get_target(session_info)}_Warped.nii.gz'),
+        ]
 
-        # segment on non-registered adc and dwi
-        adc = f'{nifti_prefix}_AX_ADC.nii.gz'
-        b1000 = f'{nifti_prefix}_AX_b1000.nii.gz'
-        dwi = f'{nifti_prefix}_AX_DWI.nii.gz'
+    @override
+    def process_session(self, session_info: SessionInfo) -> bool:
+        subject_name = session_info["subject"]
+        output_folder = session_info["output_folder"]
 
-        has_adc = os.path.isfile(adc)
-        has_b1000 = os.path.isfile(b1000)
-        has_dwi = os.path.isfile(dwi)
+        stroke_inputs = self.get_stroke_inputs(session_info)
 
         # if we dont have adc or if we dont have either the dwi or b1000, then cannot segment
-        if not has_adc or not (has_b1000 or has_dwi):
+        if stroke_inputs is None:
             print(f'Warning for {subject_name}: subject does not have the required files to perform automatic stroke segmentation')
-            return
+            return True
 
         # use b1000 if we have that, otherwise use dwi
-        if has_b1000:
-            code = segment_stroke(subject_name, b1000, adc, output_folder)
-        elif has_dwi:
-            code = segment_stroke(subject_name, dwi, adc, output_folder, True)
-        
-        if code == 0:
-            t1 = f'{nifti_prefix}_AX_T1.nii.gz'
-            t2 = f'{nifti_prefix}_AX_T2.nii.gz'
-            fl = f'{nifti_prefix}_AX_FL.nii.gz'
-            
-            has_t1 = os.path.isfile(t1)
-            has_t2 = os.path.isfile(t2)
-            has_fl = os.path.isfile(fl)
-
-            target = None
-            if has_t1:
-                target = 'T1'
-            elif has_t2:
-                target = 'T2'
-            elif has_fl:
-                target = 'FL'
-
-            if target is None:
-                print(f'Warning for {subject_name}: no target to register stroke segmentation to')
-
-            stroke_segmentation_path = os.path.join(output_folder, f'{subject_name}_stroke_segmentation.nii.gz')
-            registered_segmentation_output_path = os.path.join(output_folder, f'{subject_name}_stroke_segmentation_to_{target}_Warped.nii.gz')
-            
-            dwi_b1000_str = 'b1000' if has_b1000 else 'DWI'
-            
-            transform_path = os.path.join(output_folder, f'{subject_name}_{dwi_b1000_str}_to_{target}_0GenericAffine.mat')
-            registered_dwi_path = os.path.join(output_folder, f'{subject_name}_{dwi_b1000_str}_to_{target}_Warped.nii.gz')
-            if not os.path.exists(stroke_segmentation_path) or not os.path.exists(transform_path) or not os.path.exists(registered_dwi_path):
-                print(f'Error for {subject_name}: Tried to register {stroke_segmentation_path} using {transform_path} and {registered_dwi_path} butat least one of these files do not exist')
-                return
-            
-            apply_linear_transform(subject_name, stroke_segmentation_path, transform_path, b1000 if has_b1000 else dwi, registered_segmentation_output_path)
-            
-            # resize registered segmentation file to dwi
-            seg = nib.load(registered_segmentation_output_path)
-            dwi_or_b1000 = nib.load(registered_dwi_path)
-            
-            seg_resampled = nilearn.image.resample_img(seg, dwi_or_b1000.affine, dwi_or_b1000.shape, interpolation='nearest')
-            seg_resampled = nib.Nifti1Image(np.round(seg_resampled.get_fdata()), seg_resampled.affine)
-            nib.save(seg_resampled, registered_segmentation_output_path)
\ No newline at end of file
+        code = segment_stroke(subject_name, stroke_inputs.dwi_or_b1000, stroke_inputs.adc, output_folder, not stroke_inputs.has_b1000)
+
+        if code != 0:
+            return False
+
+        return self.register_segmentation(session_info, stroke_inputs)
+
+    @override
+    def process_sessions(self, session_info_list: List[SessionInfo], step: str) -> List[bool]:
+        succeeded = [True] * len(session_info_list)
+
+        # group sessions by the model they are segmented with (b1000 or dwi)
+        sessions_per_model = {}
+        for i, session_info in enumerate(session_info_list):
+            stroke_inputs = self.get_stroke_inputs(session_info)
+
+            if stroke_inputs is None:
+                print(f'Warning for {session_info["subject"]}: subject does not have the required files to perform automatic stroke segmentation')
+                continue
+
+            sessions_per_model.setdefault(not stroke_inputs.has_b1000, []).append((i, session_info, stroke_inputs))
+
+        for segment_on_dwi, sessions in sessions_per_model.items():
+            model = get_cached_model(get_stroke_model_path(segment_on_dwi))
+
+            for sessions_chunk in chunk_sessions(sessions):
+                # an error in one session does not stop the others
+                prepared_sessions = []
+                for i, session_info, stroke_inputs in sessions_chunk:
+                    try:
+                        with command_context(step, session_info):
+                            model_input = prepare_stroke_model_input(session_info["subject"], stroke_inputs.dwi_or_b1000, stroke_inputs.adc)
+                    except Exception as e:
+                        print(f'Error for {session_info["subject"]}: could not read the stroke segmentation inputs: {e}')
+                        model_input = None
+
+                    if model_input is not None:
+                        prepared_sessions.append((i, session_info, stroke_inputs, model_input))
+                    else:
+                        succeeded[i] = False
+
+                print(f'Generating stroke segmentations for {len(prepared_sessions)} sessions...', flush=True)
+                try:
+                    predictions = predict_for_sessions(model, [model_input.X for _, _, _, model_input in prepared_sessions], self.BATCH_SIZE)
+                except Exception as e:
+                    for i, session_info, _, _ in prepared_sessions:
+                        print(f'Error for {session_info["subject"]}: stroke segmentation failed: {e}')
+                        succeeded[i] = False
+                    continue
+
+                for (i, session_info, stroke_inputs, model_input), prediction in zip(prepared_sessions, predictions):
+                    try:
+                        # the commands of each session are recorded to its own commands.jsonl
+                        with command_context(step, session_info):
+                            code = save_stroke_prediction(session_info["subject"], prediction, model_input, session_info["output_folder"])
+                            succeeded[i] = code == 0 and self.register_segmentation(session_info, stroke_inputs)
+                    except Exception as e:
+                        print(f'Error for {session_info["subject"]}: could not save or register the stroke segmentation: {e}')
+                        succeeded[i] = False
+
+        return succeeded
+
+    def get_stroke_inputs(self, session_info: SessionInfo) -> Optional[StrokeInputs]:
+        """Finds the non-registered adc and dwi (or b1000) to segment stroke on
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            StrokeInputs | None: The files to segment on, None if the session does not have an adc and a dwi or b1000
+        """
+        session_index = get_session_index(session_info["session_folder"], session_info["subject"])
+
+        adc = session_index.get_image('ADC')
+        b1000 = session_index.get_image('b1000')
+        dwi = session_index.get_image('DWI')
+
+        if adc is None or (b1000 is None and dwi is None):
+            return None
+
+        return StrokeInputs(b1000.path if b1000 is not None else dwi.path, adc.path, b1000 is not None)
+
+    def get_target(self, session_info: SessionInfo) -> Optional[str]:
+        """Figures out which sequence the stroke segmentation is registered to
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            str | None: T1, T2 or FL, None if the session has none of them
+        """
+        session_index = get_session_index(session_info["session_folder"], session_info["subject"])
+
+        for sequence in ['T1', 'T2', 'FL']:
+            if session_index.get_image(sequence) is not None:
+                return sequence
+
+        return None
+
+    def get_registration_files(self, session_info: SessionInfo, stroke_inputs: StrokeInputs, target: str) -> Tuple[str, str]:
+        """Gets the files of the dwi or b1000 registration the segmentation is moved with
+
+        Args:
+            session_info (SessionInfo): The session
+            stroke_inputs (StrokeInputs): The files the stroke was segmented on
+            target (str): The registration target, see get_target
+
+        Returns:
+            Tuple[str, str]: Paths to the affine transform and the registered dwi or b1000
+        """
+        output_folder = session_info["output_folder"]
+        subject_name = session_info["subject"]
+        dwi_b1000_str = 'b1000' if stroke_inputs.has_b1000 else 'DWI'
+
+        transform_path = os.path.join(output_folder, f'{subject_name}_{dwi_b1000_str}_to_{target}_0GenericAffine.mat')
+        registered_dwi_path = os.path.join(output_folder, f'{subject_name}_{dwi_b1000_str}_to_{target}_Warped.nii.gz')
+        return transform_path, registered_dwi_path
+
+    def register_segmentation(self, session_info: SessionInfo, stroke_inputs: StrokeInputs) -> bool:
+        """Registers the generated stroke segmentation to the target sequence using the dwi or b1000 registration transform
+
+        Args:
+            session_info (SessionInfo): The session
+            stroke_inputs (StrokeInputs): The files the stroke was segmented on
+
+        Returns:
+            bool: True if the segmentation was registered
+        """
+        output_folder = session_info["output_folder"]
+        subject_name = session_info["subject"]
+        output_index = get_session_index(output_folder, subject_name)
+
+        target = self.get_target(session_info)
+
+        if target is None:
+            print(f'Warning for {subject_name}: no target to register stroke segmentation to')
+
+        stroke_segmentation_path = os.path.join(output_folder, f'{subject_name}_stroke_segmentation.nii.gz')
+        registered_segmentation_output_path = os.path.join(output_folder, f'{subject_name}_stroke_segmentation_to_{target}_Warped.nii.gz')
+
+        transform_path, registered_dwi_path = self.get_registration_files(session_info, stroke_inputs, target)
+        if not output_index.contains(stroke_segmentation_path) or not output_index.contains(transform_path) or not output_index.contains(registered_dwi_path):
+            print(f'Error for {subject_name}: Tried to register {stroke_segmentation_path} using {transform_path} and {registered_dwi_path} butat least one of these files do not exist')
+            return False
+
+        if apply_linear_transform(subject_name, stroke_segmentation_path, transform_path, stroke_inputs.dwi_or_b1000, registered_segmentation_output_path) != 0:
+            return False
+
+        # resize registered segmentation file to dwi
+        seg = nib.load(registered_segmentation_output_path)
+        dwi_or_b1000 = nib.load(registered_dwi_path)
+
+        seg_resampled = nilearn.image.resample_img(seg, dwi_or_b1000.affine, dwi_or_b1000.shape, interpolation='nearest')
+        seg_resampled = label_image(load_labels(seg_resampled), seg_resampled.affine)
+        save_nifti(seg_resampled, registered_segmentation_output_path)
+        return True
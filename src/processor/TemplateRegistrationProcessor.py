@@ -1,45 +1,80 @@
 from .SessionProcessor import SessionProcessor, SessionInfo
-from utils.registration import register_nifti_to_target, apply_linear_transform
+from utils.base import get_session_index, save_nifti, load_intensities, intensity_image, label_image
+from utils.registration import register_nifti_to_target, get_registration_outputs, stage_template, read_itk_affine, get_conform_affine, resample_images
 
 from typing_extensions import override
+from typing import List, Optional, Tuple
 import os
 import nibabel as nib
 from nibabel import processing
 import numpy as np
 
-template_t1_file = '/hpf/projects/ndlamini/scratch/kwalker/templates/dHCP_40weeks/template_t1.nii.gz'
-template_t2_file = '/hpf/projects/ndlamini/scratch/kwalker/templates/dHCP_40weeks/template_t2.nii.gz'
+# PIPELINE_TEMPLATES_FOLDER points the pipeline to other templates (e.g. the phantom templates of benchmarks/)
+templates_folder = os.environ.get('PIPELINE_TEMPLATES_FOLDER') or '/hpf/projects/ndlamini/scratch/kwalker/templates/dHCP_40weeks'
+template_t1_file = os.path.join(templates_folder, 'template_t1.nii.gz')
+template_t2_file = os.path.join(templates_folder, 'template_t2.nii.gz')
 
 class TemplateRegistrationProcessor(SessionProcessor):
+    REQUIRES = ['brain', 'stroke_segmentation']
+    PRODUCES = ['template']
+    CACHE_CONFIG_FILES = ['registration_config.json', 'registration_fast_config.json', 'registration_profiles.json']
+    CACHE_TOOLS = ['ants']
+
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def get_cache_inputs(self, session_info: SessionInfo) -> Optional[List[str]]:
+        # brains, registered segmentations and the templates. The originals, not their node-local copies: those are under a
+        # per-job folder (which would change the fingerprint of every run) and checking the cache should not copy the templates
+        session_index = get_session_index(session_info["session_folder"], session_info["subject"])
+        input_files = [x for x in session_index.find(role=['brain', 'registered_brain', 'registered_segmentation']) if x.target != 'template']
+
+        return [x.path for x in input_files] + [template_t1_file, template_t2_file]
+
+    @override
+    def get_cache_outputs(self, session_info: SessionInfo) -> List[str]:
         output_folder = session_info["output_folder"]
         subject_name = session_info["subject"]
-        session_folder = session_info["session_folder"]
-        
-        files = sorted(os.listdir(session_folder), key=lambda s: -os.path.getmtime(os.path.join(session_folder, s)))
-        
-        nifti_files = list(filter(lambda s: s.endswith('.nii.gz'), files))
-        
-        brain_files = list(filter(lambda s: 'BRAIN' in s.upper() and not 'RESAMPLED' in s.upper(), nifti_files))
-        
-        registered_files = list(filter(lambda s: '_TO_' in s.upper() and not 'TEMPLATE' in s.upper(), nifti_files))
+        target, target_brain_files, registered_brain_files, segmentation_files = self.get_files_to_register(session_info)
+
+        if target is None or len(target_brain_files) == 0:
+            return []
+
+        # the resampled target brain, its registration to the template and every file moved with it, see process_session
+        moving_brain = os.path.join(session_info["session_folder"], target_brain_files[0])
+        outputs = [moving_brain.split('.nii.gz')[0] + '_resampled.nii.gz'] + get_registration_outputs(subject_name, output_folder, target, 'template')
+        for file in registered_brain_files + segmentation_files:
+            registered_file_name = file.split('.nii.gz')[0].split('_to_')[0]
+            outputs.append(os.path.join(output_folder, f'{registered_file_name}_to_template_Warped.nii.gz'))
+
+        return outputs
+
+    def get_files_to_register(self, session_info: SessionInfo) -> Tuple[Optional[str], List[str], List[str], List[str]]:
+        """Figures out the target sequence of the session and the files that are registered to the template
+
+        Args:
+            session_info (SessionInfo): The session
+
+        Returns:
+            Tuple[str | None, List[str], List[str], List[str]]: The target sequence (None if there is none), the brain files of the target, the registered
+            brain files and the registered segmentation files (names in the session folder, newest first)
+        """
+        session_index = get_session_index(session_info["session_folder"], session_info["subject"])
+
+        # newest first
+        nifti_files = session_index.find(newest_first=True)
+
+        registered_files = [x for x in nifti_files if x.target is not None and x.target != 'template']
+
+        registered_brain_files = [x.name for x in registered_files if x.role == 'registered_brain']
+        segmentation_files = [x.name for x in registered_files if x.role == 'registered_segmentation']
 
-        registered_brain_files = list(filter(lambda s: 'BRAIN' in s.upper(), registered_files))
-        
         # figure out the target sequence of the registered files
-        nifti_prefix = os.path.join(output_folder, subject_name)
         target = None
         if len(registered_files) > 0:
-            target = registered_files[0].split('_to_')[1].split('_')[0]
+            target = registered_files[0].target
         else:
-            t1 = f'{nifti_prefix}_AX_T1.nii.gz'
-            t2 = f'{nifti_prefix}_AX_T2.nii.gz'
-            fl = f'{nifti_prefix}_AX_FL.nii.gz'
-            
-            has_t1 = os.path.isfile(t1)
-            has_t2 = os.path.isfile(t2)
-            has_fl = os.path.isfile(fl)
+            has_t1 = session_index.get_image('T1') is not None
+            has_t2 = session_index.get_image('T2') is not None
+            has_fl = session_index.get_image('FL') is not None
 
             if has_t1:
                 target = 'T1'
@@ -47,26 +82,38 @@ class TemplateRegistrationProcessor(SessionProcessor):
                 target = 'T2'
             elif has_fl:
                 target = 'FL'
+
+        # find the corresponding target brain
+        target_brain_files = [x.name for x in nifti_files if x.role == 'brain' and x.sequence == target] if target is not None else []
+
+        return target, target_brain_files, registered_brain_files, segmentation_files
+
+    @override
+    def process_session(self, session_info: SessionInfo) -> bool:
+        output_folder = session_info["output_folder"]
+        subject_name = session_info["subject"]
+        session_folder = session_info["session_folder"]
+        
+        session_index = get_session_index(session_folder, subject_name)
+
+        target, target_brain_files, registered_brain_files, segmentation_files = self.get_files_to_register(session_info)
         
         if target is None:
             print(f'Error for subject {subject_name}: Could not find file to register to template. Stopping...')
-            return
-        
-        # find the corresponding target brain
-        target_brain_files = list(filter(lambda s: target in s.upper() and not '_TO_' in s.upper(), brain_files))
+            return False
         
         if len(target_brain_files) > 1:
             print(f'Warning for subject {subject_name}: more than one brain file for target {target}, picking {target_brain_files[0]}')
         if len(target_brain_files) == 0:
             print(f'Error for subject {subject_name}: No brain file found for target {target}, did you run the brain extraction step? Stopping...')
-            return
+            return False
         
         moving_brain = os.path.join(session_folder, target_brain_files[0])
         
-        # figure out which template brain to register to
-        template_brain = template_t2_file
+        # figure out which template brain to register to, all reads of the template go to its node-local copy
+        template_brain = stage_template(template_t2_file)
         if target == 'T1':
-            template_brain = template_t1_file
+            template_brain = stage_template(template_t1_file)
             
         img = nib.load(moving_brain)
         template = nib.load(template_brain)
@@ -75,49 +122,51 @@ class TemplateRegistrationProcessor(SessionProcessor):
         img = processing.conform(img, template.shape)
         
         # save this image with the affine transform of template file (hopefully the two files should be almost in same space now)
-        resampled_img = nib.Nifti1Image(img.get_fdata(), template.affine)
+        resampled_img = intensity_image(load_intensities(img), template.affine)
         
         # save the resized and transformed file
         moving_brain_file_resampled_name = moving_brain.split('.nii.gz')[0] + '_resampled.nii.gz'
-        nib.save(resampled_img, moving_brain_file_resampled_name)
+        save_nifti(resampled_img, moving_brain_file_resampled_name)
         
         # do the registration of resized and transformed file to target file
         code = register_nifti_to_target(subject_name, output_folder, template_brain, moving_brain_file_resampled_name, target, 'template')
         if code != 0:
             # registration failed
-            return
+            return False
 
         # use the registered file to register all other files
-        segmentation_files = list(filter(lambda s: ("STROKE" in s.upper() or "SEG" in s.upper() or "LESION" in s.upper()) and '_TO_' in s.upper(), nifti_files))
         all_files_to_register_to_template = registered_brain_files + segmentation_files
 
         # get the affine transform matrix from registered to template file
-        files = sorted(os.listdir(session_folder), key=lambda s: -os.path.getmtime(os.path.join(session_folder, s)))
-        registered_to_template_transform_files = list(filter(lambda s: s.endswith('.mat') and '_TO_TEMPLATE' in s.upper() and target in s.upper() and 'GenericAffine' in s, files))
+        session_index.refresh(force=True)
+        registered_to_template_transform_files = [x.name for x in session_index.find(sequence=target, role='transform', target='template', extension='.mat', newest_first=True)]
 
         if len(registered_to_template_transform_files) > 1:
             print(f'Warning for {subject_name}: Multiple affine transform files for {target} to template. Using {registered_to_template_transform_files[0]}...')
         elif len(registered_to_template_transform_files) == 0:
             print(f'Error for {subject_name}: Could not find affine transform file for {target} to template. Stopping...')
-            return
+            return False
         
         register_to_template_transform = registered_to_template_transform_files[0]
+        transform = read_itk_affine(os.path.join(output_folder, register_to_template_transform))
 
+        imgs = []
+        transforms = []
+        orders = []
         for file in all_files_to_register_to_template:
             print(f'Registering {file} to template')
-            full_path = os.path.join(session_folder, file)
-            img = nib.load(full_path)
-
-            if file in segmentation_files:
-                img = processing.conform(img, template.shape, order=1)
-                registered_img = nib.Nifti1Image(np.round(img.get_fdata()), template.affine)
-            else:
-                img = processing.conform(img, template.shape)
-                registered_img = nib.Nifti1Image(img.get_fdata(), template.affine)
+            img = nib.load(os.path.join(session_folder, file))
+
+            # like the moving brain, the file is conformed to the template shape and given the template's affine before the
+            # transform is applied. The three steps are composed so the file is only resampled once
+            transforms.append(get_conform_affine(img, template.shape) @ np.linalg.inv(template.affine) @ transform)
+            imgs.append(img)
+            # nearest neighbour keeps the labels of segmentations
+            orders.append(0 if file in segmentation_files else 1)
+
+        for file, data in zip(all_files_to_register_to_template, resample_images(imgs, template.shape, template.affine, transforms, orders)):
             registered_file_name = file.split('.nii.gz')[0].split('_to_')[0]
             registered_file_path = os.path.join(output_folder, f'{registered_file_name}_to_template_Warped.nii.gz')
-            nib.save(registered_img, registered_file_path)
-            
-            apply_linear_transform(subject_name, registered_file_path, os.path.join(output_folder, register_to_template_transform), template_brain, registered_file_path)
+            save_nifti((label_image if file in segmentation_files else intensity_image)(data, template.affine), registered_file_path)
 
-            
\ No newline at end of file
+        return True
@@ -7,12 +7,12 @@ import os
 # Remember to add this processor to src/processor/__init__.py when you're done
 class __TemplateProcessor(SessionProcessor):
     @override
-    def process_session(self, session_info: SessionInfo) -> None:
+    def process_session(self, session_info: SessionInfo) -> bool:
         output_folder = session_info["output_folder"]
         subject_name = session_info["subject"]
         session_folder = session_info["session_folder"]
         session_name = session_info["session"]
         
-        # process session code here
+        # process session code here, print errors and return False if the session could not be processed
         
-        pass
\ No newline at end of file
+        return True
\ No newline at end of file
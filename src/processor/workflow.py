@@ -0,0 +1,213 @@
+from . import get_processor_for_step
+from .SessionProcessor import SessionProcessor, SessionInfo
+from utils.base import get_session_index, finalize_niftis, mark_step_done, clear_step_done, is_step_done, get_done_steps, command_context
+from utils.cache import run_with_step_cache
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List, Optional, Set, Tuple
+
+# steps that take part in workflows, each processor declares the artifacts it requires and produces
+WORKFLOW_STEPS = ['dcm2nii', 'mask', 'registration', 'brainExtraction', 'segmentStroke', 'registerToTemplate', 'lesionHeatmap']
+
+# composite steps are named subgraphs of the workflow
+COMPOSITE_STEPS = {
+    'base': ['dcm2nii', 'mask', 'registration'],
+    'all': ['dcm2nii', 'mask', 'registration', 'brainExtraction', 'segmentStroke'],
+    'fixMask': ['registration', 'brainExtraction', 'segmentStroke'],
+    'map': ['registerToTemplate', 'lesionHeatmap'],
+}
+
+# steps can also be given as target:<artifact>, which runs the steps needed to produce the artifact
+TARGET_PREFIX = 'target:'
+
+# maximum number of steps of one session that run at the same time
+MAX_CONCURRENT_STEPS = 4
+
+
+def get_producers() -> Dict[str, str]:
+    """Gets the step producing each artifact
+
+    Returns:
+        Dict[str, str]: Artifact to step mapping
+    """
+    producers = {}
+    for step in WORKFLOW_STEPS:
+        for artifact in get_processor_for_step(step).PRODUCES:
+            producers[artifact] = step
+    return producers
+
+def get_steps_for_target(artifact: str) -> Optional[List[str]]:
+    """Gets the minimal set of steps needed to produce an artifact
+
+    Args:
+        artifact (str): The artifact, e.g. brain
+
+    Returns:
+        List[str] | None: The steps in workflow order, None if no step produces the artifact
+    """
+    producers = get_producers()
+
+    if artifact not in producers:
+        return None
+
+    steps = set()
+    artifacts_to_visit = [artifact]
+    while len(artifacts_to_visit) > 0:
+        step = producers[artifacts_to_visit.pop()]
+        if step in steps:
+            continue
+
+        steps.add(step)
+        artifacts_to_visit.extend(x for x in get_processor_for_step(step).REQUIRES if x in producers)
+
+    return [step for step in WORKFLOW_STEPS if step in steps]
+
+def get_steps(step: str) -> Optional[List[str]]:
+    """Resolves a step given to run.py (a single, composite or target step) to the steps it runs
+
+    Args:
+        step (str): The step
+
+    Returns:
+        List[str] | None: The steps to run, None if the step does not exist
+    """
+    if step in COMPOSITE_STEPS:
+        return COMPOSITE_STEPS[step]
+    elif step.startswith(TARGET_PREFIX):
+        return get_steps_for_target(step[len(TARGET_PREFIX):])
+    elif get_processor_for_step(step) is not None:
+        return [step]
+
+    return None
+
+def get_dependencies(steps: List[str]) -> Dict[str, Set[str]]:
+    """Gets which of the given steps each step has to wait for. Artifacts produced by steps
+    that are not part of the given steps are expected to already exist
+
+    Args:
+        steps (List[str]): The steps to run
+
+    Returns:
+        Dict[str, Set[str]]: Step to the steps it depends on
+    """
+    processors = {step: get_processor_for_step(step) for step in steps}
+    dependencies = {}
+    for step, processor in processors.items():
+        dependencies[step] = set(other_step for other_step, other_processor in processors.items()
+                                 if other_step != step and len(set(other_processor.PRODUCES) & set(processor.REQUIRES)) > 0)
+    return dependencies
+
+def get_downstream_steps(steps: List[str]) -> Set[str]:
+    """Gets the given steps and all workflow steps that (directly or not) use their outputs
+
+    Args:
+        steps (List[str]): The steps
+
+    Returns:
+        Set[str]: The steps whose outputs are stale once the given steps run again
+    """
+    dependencies = get_dependencies(WORKFLOW_STEPS)
+    downstream = set(steps)
+    changed = True
+    while changed:
+        changed = False
+        for step, step_dependencies in dependencies.items():
+            if step not in downstream and len(step_dependencies & downstream) > 0:
+                downstream.add(step)
+                changed = True
+    return downstream
+
+def clear_stale_markers(steps: List[str], output_folder: str) -> None:
+    """Removes the completion markers that no longer hold once the given steps run again: the markers of the steps,
+    of the workflow steps using their outputs and of all composite and target steps
+
+    Args:
+        steps (List[str]): The steps about to run
+        output_folder (str): Path to session output folder
+    """
+    unaffected = set(WORKFLOW_STEPS) - get_downstream_steps(steps)
+    for step in get_done_steps(output_folder):
+        if step not in unaffected:
+            clear_step_done(output_folder, step)
+
+def run_workflow(steps: List[str], session_info: SessionInfo) -> bool:
+    """Runs steps for a session, each step as soon as the steps it depends on are done.
+    Independent steps (e.g. brainExtraction and segmentStroke) run at the same time.
+    Each step leaves a completion marker in the session's .pipeline folder, with session_info["resume"]
+    steps completed in an earlier (e.g. crashed) run are skipped
+
+    Args:
+        steps (List[str]): The steps to run
+        session_info (SessionInfo): The session
+
+    Returns:
+        bool: True if all steps ran, False if a step failed, i.e. raised or its processor reported an error (steps depending on it are not run)
+    """
+    subject_name = session_info["subject"]
+    output_folder = session_info["output_folder"]
+    dependencies = get_dependencies(steps)
+    done = set()
+    failed = set()
+
+    if session_info.get("resume"):
+        for step in steps:
+            if is_step_done(output_folder, step):
+                print(f'Skipping {step} for {subject_name}: completed in an earlier run')
+                if get_processor_for_step(step).OUTPUT_BECOMES_SESSION_FOLDER:
+                    session_info["session_folder"] = output_folder
+                done.add(step)
+    else:
+        clear_stale_markers(steps, output_folder)
+
+    def run_step(step: str) -> Tuple[SessionProcessor, bool]:
+        processor = get_processor_for_step(step)
+        clear_step_done(output_folder, step)
+        # external commands of the step are recorded to .pipeline/commands.jsonl, see stats.py
+        with command_context(step, session_info):
+            succeeded = run_with_step_cache(step, processor, session_info)
+        return processor, succeeded
+
+    with ThreadPoolExecutor(MAX_CONCURRENT_STEPS) as executor:
+        running = {}
+        while True:
+            for step in steps:
+                if step in done or step in failed or step in running.values():
+                    continue
+
+                if len(dependencies[step] & failed) > 0:
+                    print(f'Error for {subject_name}: not running {step} because a step it depends on failed')
+                    failed.add(step)
+                elif dependencies[step] <= done:
+                    running[executor.submit(run_step, step)] = step
+
+            if len(running) == 0:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    processor, succeeded = future.result()
+                except Exception as e:
+                    print(f'Error for {subject_name}: step {step} failed: {e}')
+                    failed.add(step)
+                    continue
+
+                if not succeeded:
+                    # the processor printed the error, the steps using its outputs are not run and it is not marked done
+                    failed.add(step)
+                    continue
+
+                # outputs may have overwritten files, which does not change the folder's modification time
+                get_session_index(session_info["output_folder"], subject_name).refresh(force=True)
+
+                if processor.OUTPUT_BECOMES_SESSION_FOLDER:
+                    # output folder now becomes root folder of next steps
+                    session_info["session_folder"] = session_info["output_folder"]
+                mark_step_done(output_folder, step)
+                done.add(step)
+
+    # niftis were written in the intermediate storage format, compress them once now that the steps are done
+    finalize_niftis(session_info["output_folder"])
+
+    return len(failed) == 0
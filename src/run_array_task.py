@@ -0,0 +1,30 @@
+from processor.workflow import get_steps, run_workflow
+from utils.base import mark_step_done
+
+import json
+import os
+from sys import argv
+
+# runs the sessions of one task of a slurm job array, see SlurmArrayExecutor in utils/executor
+with open(argv[1]) as manifest_file:
+    tasks = json.load(manifest_file)
+step = argv[2]
+# manifests longer than MaxArraySize are split over several arrays, each starting at an offset
+offset = int(argv[3]) if len(argv) > 3 else 0
+
+steps = get_steps(step)
+if steps is None:
+    print(f'Step {step} does not exist, aborting...')
+    exit(1)
+
+# packed sessions run one after the other, the steps of each session still run concurrently
+failed = False
+for session_info in tasks[offset + int(os.environ['SLURM_ARRAY_TASK_ID'])]:
+    if not run_workflow(steps, session_info):
+        failed = True
+    else:
+        # lets run.py --resume skip the session
+        mark_step_done(session_info["output_folder"], step)
+
+if failed:
+    exit(1)
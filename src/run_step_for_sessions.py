@@ -0,0 +1,35 @@
+from processor import get_processor_for_step
+from processor.workflow import clear_stale_markers
+from utils.base import finalize_niftis, mark_step_done
+
+import json
+from sys import argv
+
+# runs one step for many sessions in a single process, see the --batch option of run.py
+with open(argv[1]) as session_list_file:
+    session_info_list = json.load(session_list_file)
+step = argv[2]
+
+processor = get_processor_for_step(step)
+if processor is None:
+    print(f'Step {step} does not exist, aborting...')
+    exit(1)
+# the outputs of the step and of the steps using them are replaced, like run_workflow does for a single session
+for session_info in session_info_list:
+    clear_stale_markers([step], session_info["output_folder"])
+
+# the external commands of each session are recorded to its .pipeline/commands.jsonl, like run_workflow does
+succeeded = processor.process_sessions(session_info_list, step)
+
+for session_info, session_succeeded in zip(session_info_list, succeeded):
+    # niftis were written in the intermediate storage format, see config/storage_config.json
+    finalize_niftis(session_info["output_folder"])
+
+    # lets run.py --resume skip the session
+    if session_succeeded:
+        mark_step_done(session_info["output_folder"], step)
+
+failed = len(succeeded) - sum(succeeded)
+if failed > 0:
+    print(f'{step} failed for {failed} of {len(succeeded)} sessions')
+    exit(1)
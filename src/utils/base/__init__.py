@@ -1,2 +1,10 @@
 from .find_sequence_names import find_sequences_for_session
-from .subject_sessions import find_all_sessions_for_subjects, get_all_subjects
\ No newline at end of file
+from .subject_sessions import find_all_sessions_for_subjects, get_all_subjects
+from .resources import get_available_cpus
+from .session_index import SessionIndex, SessionFile, get_session_index, ANY
+from .dicom_index import DicomIndex, DicomFolder, get_dicom_index, get_view_for_orientation
+from .storage import save_nifti, finalize_niftis, hash_nifti_content
+from .atomic import get_temp_path, publish_output, publish_prefixed_outputs
+from .pipeline_state import get_pipeline_state_folder, mark_step_done, clear_step_done, is_step_done, get_done_steps, PIPELINE_STATE_FOLDER
+from .command_log import command_context, in_command_context, read_command_logs, percentile
+from .image_io import load_intensities, load_labels, load_mask, load_volume, intensity_image, label_image, INTENSITY_DTYPE, LABEL_DTYPE
\ No newline at end of file
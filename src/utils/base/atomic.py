@@ -0,0 +1,44 @@
+import os
+
+# outputs are written under a hidden name first, hidden files are ignored by the session index and the step cache
+TEMP_PREFIX = '.tmp_'
+
+def get_temp_path(path: str) -> str:
+    """Gets the hidden path an output is written to before it is renamed to its final path.
+    The name keeps its extension, tools that pick the output format from the extension (fsl, itk) write the same format
+
+    Args:
+        path (str): Final path of the output, or a prefix of output paths (e.g. an antsRegistration output prefix)
+
+    Returns:
+        str: The temporary path
+    """
+    folder, name = os.path.split(path)
+    return os.path.join(folder, TEMP_PREFIX + name)
+
+def publish_output(temp_path: str, path: str, success: bool = True) -> None:
+    """Renames an output written to its temporary path to its final path, so the output appears complete or not at all.
+    Outputs of failed commands are removed
+
+    Args:
+        temp_path (str): Temporary path, see get_temp_path
+        path (str): Final path
+        success (bool, optional): Whether the command writing the output succeeded. Defaults to True.
+    """
+    if success:
+        os.replace(temp_path, path)
+    elif os.path.exists(temp_path):
+        os.remove(temp_path)
+
+def publish_prefixed_outputs(temp_prefix: str, prefix: str, success: bool = True) -> None:
+    """Renames all outputs written with a temporary prefix (e.g. by antsRegistration) to the final prefix
+
+    Args:
+        temp_prefix (str): Temporary prefix, see get_temp_path
+        prefix (str): Final prefix
+        success (bool, optional): Whether the command writing the outputs succeeded. Defaults to True.
+    """
+    folder, temp_name = os.path.split(temp_prefix)
+    for name in os.listdir(folder):
+        if name.startswith(temp_name):
+            publish_output(os.path.join(folder, name), prefix + name[len(temp_name):], success)
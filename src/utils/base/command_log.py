@@ -0,0 +1,165 @@
+import contextvars
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+from .pipeline_state import get_pipeline_state_folder, PIPELINE_STATE_FOLDER
+
+COMMAND_LOG_FILE = 'commands.jsonl'
+# output of the commands, one file per command
+COMMAND_OUTPUT_FOLDER = 'logs'
+
+# the step and session the commands run by the current thread (or task) belong to, see command_context
+_command_context: contextvars.ContextVar = contextvars.ContextVar('command_context', default=None)
+
+# steps of a session run on several threads, records are appended one line at a time
+_log_lock = threading.Lock()
+
+@contextmanager
+def command_context(step: str, session_info: dict) -> Iterator[None]:
+    """Records the external commands run inside the block (see run_cmd) to the session's .pipeline/commands.jsonl
+
+    Args:
+        step (str): The step running the commands
+        session_info (dict): The session
+    """
+    token = _command_context.set({
+        'step': step,
+        'subject': session_info["subject"],
+        'session': session_info["session"],
+        'output_folder': session_info["output_folder"],
+    })
+    try:
+        yield
+    finally:
+        _command_context.reset(token)
+
+def in_command_context(fn: Callable) -> Callable:
+    """Wraps a function so it runs in the command context of the caller, e.g. when it is run by a thread pool
+    (threads do not inherit the context of the thread that submitted the work)
+
+    Args:
+        fn (Callable): The function
+
+    Returns:
+        Callable: The wrapped function
+    """
+    context = contextvars.copy_context()
+    # a context can only be entered by one thread at a time, each call runs in its own copy
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+def get_tool_name(sys_cmd: str) -> str:
+    """Gets the name of the tool a command runs, e.g. antsRegistration for `antsRegistration --dimensionality 3 ...`.
+    For chained commands (a && b) this is the first tool
+
+    Args:
+        sys_cmd (str): The command
+
+    Returns:
+        str: The tool name
+    """
+    for word in sys_cmd.split():
+        # skip environment variable assignments (VAR=value cmd)
+        if '=' not in word:
+            return os.path.basename(word)
+    return ''
+
+def get_command_output_folder() -> Optional[str]:
+    """Gets (and creates) the folder the output of commands run in the current command context is written to, .pipeline/logs of the session
+
+    Returns:
+        str | None: Path to the folder, None outside of a command context
+    """
+    context = _command_context.get()
+    if context is None:
+        return None
+
+    folder = os.path.join(get_pipeline_state_folder(context['output_folder']), COMMAND_OUTPUT_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def log_command(sys_cmd: str, start: float, wall_time: float, user_time: float, sys_time: float, max_rss_kb: int, exit_code: int, output_path: Optional[str] = None) -> None:
+    """Appends a record of a finished command to the commands.jsonl of the session in the current command context.
+    Commands run outside of a command context (e.g. in preprocess.py) are not recorded
+
+    Args:
+        sys_cmd (str): The command
+        start (float): Start time (seconds since the epoch)
+        wall_time (float): Elapsed time in seconds
+        user_time (float): User CPU time of the command and the processes it waited for, in seconds
+        sys_time (float): System CPU time in seconds
+        max_rss_kb (int): Peak resident set size of the largest process of the command, in KiB
+        exit_code (int): Exit code, negative signal number if the command was killed
+        output_path (str, optional): Path to the file with the output of the command. Defaults to None.
+    """
+    context = _command_context.get()
+    if context is None:
+        return
+
+    record = {
+        'step': context['step'],
+        'subject': context['subject'],
+        'session': context['session'],
+        'tool': get_tool_name(sys_cmd),
+        'command': sys_cmd,
+        'start': round(start, 3),
+        'wall_time': round(wall_time, 3),
+        'user_time': round(user_time, 3),
+        'sys_time': round(sys_time, 3),
+        'max_rss_mb': round(max_rss_kb / 1024, 1),
+        'exit_code': exit_code,
+    }
+    if output_path is not None:
+        record['output'] = output_path
+
+    log_path = os.path.join(get_pipeline_state_folder(context['output_folder']), COMMAND_LOG_FILE)
+    with _log_lock, open(log_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def read_command_logs(output_root_folder: str) -> List[dict]:
+    """Reads the command records of all sessions in an output folder
+
+    Args:
+        output_root_folder (str): Path to output root folder
+
+    Returns:
+        List[dict]: The records, see log_command
+    """
+    records = []
+    for folder, subfolders, files in os.walk(output_root_folder):
+        if os.path.basename(folder) != PIPELINE_STATE_FOLDER:
+            continue
+
+        subfolders.clear()
+        if COMMAND_LOG_FILE not in files:
+            continue
+
+        with open(os.path.join(folder, COMMAND_LOG_FILE)) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # last line of a job killed while writing it
+                    continue
+    return records
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Gets a percentile of values, interpolating linearly between the closest ranks (like numpy.percentile)
+
+    Args:
+        values (List[float]): The values
+        q (float): The percentile (0-100)
+
+    Returns:
+        float | None: The percentile, None if there are no values
+    """
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
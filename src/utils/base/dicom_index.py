@@ -0,0 +1,292 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pydicom as dcm
+
+from .session_index import RACY_INTERVAL_NS
+
+# hidden file in the output root holding the index
+DICOM_INDEX_FILE = '.dicom_index.sqlite'
+
+# bump when the folders table changes, older indexes are rebuilt
+SCHEMA_VERSION = 2
+
+AXIAL_ORIENTATION = [1, 0, 0, 0, 1, 0]
+CORONAL_ORIENTATION = [1, 0, 0, 0, 0, -1]
+SAGITTAL_ORIENTATION = [0, 1, 0, 0, 0, -1]
+
+HEADER_TAGS = ['SeriesInstanceUID', 'SeriesDescription', 'ImageOrientationPatient', 'AcquisitionTime']
+
+class DicomFolder(NamedTuple):
+    """A folder below the root as recorded in the index. Folders holding dicom files have the header fields of their first file"""
+    path: str
+    subfolders: List[str]
+    # like the listing of is_session_folder without an index, these include hidden entries
+    first_subfolder: Optional[str]
+    has_dcm_names: bool
+    has_nifti: bool
+    instance_count: int
+    series_uid: Optional[str]
+    description: Optional[str]
+    orientation: Optional[List[float]]
+    view: Optional[str]
+    acquisition_time: Optional[str]
+
+def get_view_for_orientation(orientation) -> str:
+    """Determines the view (axial, sagittal, coronal) from the ImageOrientationPatient of a dicom
+
+    Args:
+        orientation: The six direction cosines of ImageOrientationPatient
+
+    Returns:
+        str: the view, returns UK if unknown
+    """
+    try:
+        orientation = np.round(np.asarray(orientation, dtype=float)).astype(int)
+
+        if np.array_equal(orientation, AXIAL_ORIENTATION):
+            return 'AX'
+        elif np.array_equal(orientation, SAGITTAL_ORIENTATION):
+            return 'SAG'
+        elif np.array_equal(orientation, CORONAL_ORIENTATION):
+            return 'COR'
+    except:
+        pass
+
+    return 'UK'
+
+def scan_folder(path: str) -> DicomFolder:
+    """Lists a folder and reads the header (not the pixel data) of its first dicom file
+
+    Args:
+        path (str): Path to folder
+
+    Returns:
+        DicomFolder: The folder
+    """
+    subfolders = []
+    files = []
+    first_subfolder = None
+    has_dcm_names = False
+    has_nifti = False
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # is_session_folder reads hidden entries too (from os.walk and os.listdir), the index skips them
+            hidden = entry.name.startswith('.')
+            has_dcm_names = has_dcm_names or entry.name.endswith('dcm')
+            if entry.is_dir():
+                if first_subfolder is None:
+                    first_subfolder = entry.name
+                if not hidden:
+                    subfolders.append(entry.name)
+            elif entry.is_file():
+                has_nifti = has_nifti or entry.name.endswith('.nii') or entry.name.endswith('.nii.gz')
+                if not hidden:
+                    files.append(entry.name)
+
+    # dicom files usually end in .dcm, folders exported without extensions only hold dicom files
+    dicom_files = sorted(file for file in files if file.lower().endswith('dcm'))
+    if len(dicom_files) == 0 and not has_nifti:
+        dicom_files = sorted(files)
+
+    header = None
+    for file in dicom_files[:1]:
+        try:
+            header = dcm.dcmread(os.path.join(path, file), stop_before_pixels=True, specific_tags=HEADER_TAGS)
+        except Exception:
+            pass
+
+    if header is None:
+        return DicomFolder(path, subfolders, first_subfolder, has_dcm_names, has_nifti, 0, None, None, None, None, None)
+
+    orientation = getattr(header, 'ImageOrientationPatient', None)
+    orientation = [float(x) for x in orientation] if orientation is not None else None
+
+    def get_string(tag: str) -> Optional[str]:
+        value = getattr(header, tag, None)
+        return str(value) if value is not None else None
+
+    return DicomFolder(path, subfolders, first_subfolder, has_dcm_names, has_nifti, len(dicom_files), get_string('SeriesInstanceUID'), get_string('SeriesDescription'),
+                       orientation, get_view_for_orientation(orientation), get_string('AcquisitionTime'))
+
+class DicomIndex:
+    """Persistent catalog of the folders below a root folder and the dicom series they hold, stored in SQLite.
+    A folder is listed (and the header of its first dicom read) only when its modification time changed since it was
+    last indexed, so refreshing an unchanged root costs one stat per folder.
+    run.py is the only writer, the tasks of a job open the index read-only (see get_dicom_index)"""
+
+    def __init__(self, index_path: str, read_only: bool = False):
+        self.index_path = index_path
+        self.read_only = read_only
+        self._lock = threading.RLock()
+        # steps of a session run in threads, all queries hold the lock
+        if read_only:
+            # raises sqlite3.OperationalError if the file does not exist
+            self._connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, timeout=60, check_same_thread=False)
+            if self._connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                self._connection.close()
+                raise sqlite3.OperationalError(f'{index_path} was written by another version of the pipeline')
+            return
+
+        self._connection = sqlite3.connect(index_path, timeout=60, check_same_thread=False)
+
+        with self._lock, self._connection:
+            if self._connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                self._connection.execute('DROP TABLE IF EXISTS folders')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, subfolders TEXT, first_subfolder TEXT, has_dcm_names INTEGER, has_nifti INTEGER, instance_count INTEGER,
+                series_uid TEXT, description TEXT, orientation TEXT, view TEXT, acquisition_time TEXT)''')
+            self._connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def refresh(self, folder: str) -> None:
+        """Indexes a folder tree again, only folders whose modification time changed are listed
+
+        Args:
+            folder (str): Root of the tree, e.g. the root folder or a session folder
+        """
+        if self.read_only:
+            raise ValueError(f'{self.index_path} is opened read-only, only run.py refreshes it')
+
+        with self._lock, self._connection:
+            folders_to_visit = [os.path.abspath(folder)]
+            while len(folders_to_visit) > 0:
+                path = folders_to_visit.pop()
+
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    self._remove_tree(path)
+                    continue
+
+                row = self._connection.execute('SELECT mtime_ns, subfolders FROM folders WHERE path = ?', (path,)).fetchone()
+
+                if row is not None and row[0] == mtime_ns:
+                    subfolders = json.loads(row[1])
+                else:
+                    indexed_folder = scan_folder(path)
+                    subfolders = indexed_folder.subfolders
+
+                    # folders that disappeared since the last scan
+                    if row is not None:
+                        for subfolder in set(json.loads(row[1])) - set(subfolders):
+                            self._remove_tree(os.path.join(path, subfolder))
+
+                    # a folder modified this recently may still change without changing its modification time, index it again next time
+                    if time.time_ns() - mtime_ns <= RACY_INTERVAL_NS:
+                        mtime_ns = None
+
+                    self._connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                        path, mtime_ns, json.dumps(subfolders), indexed_folder.first_subfolder, int(indexed_folder.has_dcm_names), int(indexed_folder.has_nifti), indexed_folder.instance_count,
+                        indexed_folder.series_uid, indexed_folder.description,
+                        json.dumps(indexed_folder.orientation) if indexed_folder.orientation is not None else None,
+                        indexed_folder.view, indexed_folder.acquisition_time))
+
+                folders_to_visit.extend(os.path.join(path, subfolder) for subfolder in subfolders)
+
+    def is_current(self, folder: str) -> bool:
+        """Checks that a folder tree did not change since it was indexed, without writing to the index
+
+        Args:
+            folder (str): Root of the tree, e.g. a session folder
+
+        Returns:
+            bool: False if a folder of the tree is not indexed, was modified since or was modified too recently to tell
+        """
+        with self._lock:
+            folders_to_visit = [os.path.abspath(folder)]
+            while len(folders_to_visit) > 0:
+                path = folders_to_visit.pop()
+                row = self._connection.execute('SELECT mtime_ns, subfolders FROM folders WHERE path = ?', (path,)).fetchone()
+
+                try:
+                    if row is None or row[0] != os.stat(path).st_mtime_ns:
+                        return False
+                except FileNotFoundError:
+                    return False
+
+                folders_to_visit.extend(os.path.join(path, subfolder) for subfolder in json.loads(row[1]))
+
+        return True
+
+    def _remove_tree(self, path: str) -> None:
+        self._connection.execute('DELETE FROM folders WHERE path = ? OR substr(path, 1, ?) = ?', (path, len(path) + 1, path + os.sep))
+
+    def _to_folder(self, row) -> DicomFolder:
+        path, _, subfolders, first_subfolder, has_dcm_names, has_nifti, instance_count, series_uid, description, orientation, view, acquisition_time = row
+        return DicomFolder(path, json.loads(subfolders), first_subfolder, bool(has_dcm_names), bool(has_nifti), instance_count, series_uid, description,
+                           json.loads(orientation) if orientation is not None else None, view, acquisition_time)
+
+    def get_folder(self, path: str) -> Optional[DicomFolder]:
+        """Gets an indexed folder
+
+        Args:
+            path (str): Path to folder
+
+        Returns:
+            DicomFolder | None: The folder, None if it is not indexed
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT * FROM folders WHERE path = ?', (os.path.abspath(path),)).fetchone()
+            return self._to_folder(row) if row is not None else None
+
+    def get_subfolders(self, path: str) -> List[DicomFolder]:
+        """Gets the indexed subfolders of a folder, in the order they were listed
+
+        Args:
+            path (str): Path to folder
+
+        Returns:
+            List[DicomFolder]: The subfolders, empty if the folder is not indexed
+        """
+        folder = self.get_folder(path)
+        if folder is None:
+            return []
+
+        subfolders = [self.get_folder(os.path.join(folder.path, subfolder)) for subfolder in folder.subfolders]
+        return [subfolder for subfolder in subfolders if subfolder is not None]
+
+    def get_view(self, dicom_folder: str) -> Optional[str]:
+        """Gets the view (axial, sagittal, coronal) of a dicom folder
+
+        Args:
+            dicom_folder (str): Path to dicom folder
+
+        Returns:
+            str | None: the view (UK if unknown), None if the folder is not indexed
+        """
+        folder = self.get_folder(dicom_folder)
+        if folder is None:
+            return None
+        return folder.view or 'UK'
+
+_dicom_indexes: Dict[Tuple[str, bool], Optional[DicomIndex]] = {}
+_dicom_indexes_lock = threading.Lock()
+
+def get_dicom_index(output_root: str, read_only: bool = False) -> Optional[DicomIndex]:
+    """Gets the dicom index kept in the output root folder, shared by all processors of the process.
+    Tasks open it read-only: the output root is usually on shared storage, where concurrent SQLite writers from many nodes
+    contend for (or corrupt) the file
+
+    Args:
+        output_root (str): Path to output root folder
+        read_only (bool, optional): Open the index without writing to it. Defaults to False.
+
+    Returns:
+        DicomIndex | None: The index, None if it is opened read-only and does not exist (or cannot be read)
+    """
+    index_path = os.path.abspath(os.path.join(output_root, DICOM_INDEX_FILE))
+    key = (index_path, read_only)
+    with _dicom_indexes_lock:
+        if key not in _dicom_indexes:
+            try:
+                _dicom_indexes[key] = DicomIndex(index_path, read_only)
+            except sqlite3.Error:
+                if not read_only:
+                    raise
+                _dicom_indexes[key] = None
+        return _dicom_indexes[key]
@@ -21,17 +21,19 @@ def find_strings_with_sequence(strings, seq_string):
         
     return result
 
-def find_sequences_for_session(session_path):
+def find_sequences_for_session(session_path, dicom_index=None):
     """Finds sequences of interest for a session
 
     Args:
         session_path (string): Path to the session
+        dicom_index (DicomIndex, optional): Index to list the session folder from instead of the filesystem. Defaults to None.
 
     Returns:
         dict: A sequence to filename mapping, sorted by importance as defined in config/sequence_string_lists.json
     """
     result = {}
-    objects_in_session_folder = os.listdir(session_path)
+    indexed_folder = dicom_index.get_folder(session_path) if dicom_index is not None else None
+    objects_in_session_folder = list(indexed_folder.subfolders) if indexed_folder is not None else os.listdir(session_path)
 
     for sequence in sequence_lists.keys():
         result[sequence] = []
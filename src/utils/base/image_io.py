@@ -0,0 +1,105 @@
+"""Voxel data types of the images the pipeline loads and saves. Intensities are float32, labels (masks, segmentations) uint8,
+instead of nibabel's float64 default, which takes 8 bytes per voxel in memory and on disk:
+
+    data = load_intensities(img)                       # float32, nibabel keeps no cached copy
+    save_nifti(label_image(mask, affine), path)         # uint8 on disk
+"""
+from typing import Optional, Union
+
+import nibabel as nib
+import numpy as np
+
+INTENSITY_DTYPE = np.float32
+LABEL_DTYPE = np.uint8
+
+def _get_image(img: Union[str, nib.Nifti1Image]) -> nib.Nifti1Image:
+    return nib.load(img) if isinstance(img, str) else img
+
+def load_intensities(img: Union[str, nib.Nifti1Image]) -> np.ndarray:
+    """Loads the (scaled) voxel values of an image as float32. Unlike get_fdata(), the array is not cached by the image,
+    so it is freed as soon as the caller drops it
+
+    Args:
+        img (str | nib.Nifti1Image): Path to nifti or the loaded image
+
+    Returns:
+        np.ndarray: The voxel values
+    """
+    return _get_image(img).get_fdata(dtype=INTENSITY_DTYPE, caching='unchanged')
+
+def load_labels(img: Union[str, nib.Nifti1Image]) -> np.ndarray:
+    """Loads the labels of a mask or segmentation as uint8, rounding labels stored as floats (e.g. after interpolation)
+
+    Args:
+        img (str | nib.Nifti1Image): Path to nifti or the loaded image
+
+    Returns:
+        np.ndarray: The labels
+    """
+    img = _get_image(img)
+    data = np.asanyarray(img.dataobj)
+    if np.issubdtype(data.dtype, np.floating):
+        # arrays read from disk are not shared with the image and are rounded in place
+        data = np.rint(data, out=None if data is img.dataobj else data)
+    return data.astype(LABEL_DTYPE, copy=False)
+
+def load_mask(img: Union[str, nib.Nifti1Image]) -> np.ndarray:
+    """Loads a mask as a boolean array, every non-zero voxel is inside
+
+    Args:
+        img (str | nib.Nifti1Image): Path to nifti or the loaded image
+
+    Returns:
+        np.ndarray: The mask
+    """
+    return np.asanyarray(_get_image(img).dataobj) != 0
+
+def load_volume(img: Union[str, nib.Nifti1Image], index: int = 0) -> nib.Nifti1Image:
+    """Gets one volume of a 4d image (e.g. the b0 of a dwi series) as a 3d image. Only the bytes of the volume are read, through
+    nibabel's array proxy (memory-mapped for uncompressed niftis), instead of the whole series like four_to_three or get_fdata
+
+    Args:
+        img (str | nib.Nifti1Image): Path to nifti or the loaded image
+        index (int, optional): Index of the volume. Defaults to 0.
+
+    Returns:
+        nib.Nifti1Image: The volume, with the affine and header of the image. 3d images are returned as they are
+    """
+    img = _get_image(img)
+    if len(img.shape) < 4:
+        return img
+    return img.slicer[:, :, :, index]
+
+def intensity_image(data: np.ndarray, affine: np.ndarray, header: Optional[nib.Nifti1Header] = None) -> nib.Nifti1Image:
+    """Makes an image of intensities, stored as float32
+
+    Args:
+        data (np.ndarray): The voxel values
+        affine (np.ndarray): The affine
+        header (nib.Nifti1Header, optional): Header to copy the other fields from. Defaults to None.
+
+    Returns:
+        nib.Nifti1Image: The image
+    """
+    img = nib.Nifti1Image(np.asarray(data, dtype=INTENSITY_DTYPE), affine, header=header)
+    img.set_data_dtype(INTENSITY_DTYPE)
+    return img
+
+def label_image(data: np.ndarray, affine: np.ndarray, header: Optional[nib.Nifti1Header] = None) -> nib.Nifti1Image:
+    """Makes an image of labels (e.g. a mask or segmentation), stored as uint8 without intensity scaling
+
+    Args:
+        data (np.ndarray): The labels (boolean, integer or whole floats)
+        affine (np.ndarray): The affine
+        header (nib.Nifti1Header, optional): Header to copy the other fields from. Defaults to None.
+
+    Returns:
+        nib.Nifti1Image: The image
+    """
+    data = np.asarray(data)
+    if np.issubdtype(data.dtype, np.floating):
+        data = np.rint(data)
+    img = nib.Nifti1Image(data.astype(LABEL_DTYPE, copy=False), affine, header=header)
+    img.set_data_dtype(LABEL_DTYPE)
+    img.header.set_slope_inter(1, 0)
+    return img
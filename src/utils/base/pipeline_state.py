@@ -0,0 +1,73 @@
+import json
+import os
+from datetime import datetime
+from typing import List
+
+# hidden folder in each session output folder that holds the pipeline's bookkeeping files
+PIPELINE_STATE_FOLDER = '.pipeline'
+STEP_MARKER_EXTENSION = '.done'
+
+def get_pipeline_state_folder(output_folder: str) -> str:
+    """Gets (and creates) the folder holding the pipeline bookkeeping files of a session
+
+    Args:
+        output_folder (str): Path to session output folder
+
+    Returns:
+        str: Path to the state folder
+    """
+    state_folder = os.path.join(output_folder, PIPELINE_STATE_FOLDER)
+    os.makedirs(state_folder, exist_ok=True)
+    return state_folder
+
+def get_step_marker_path(output_folder: str, step: str) -> str:
+    return os.path.join(output_folder, PIPELINE_STATE_FOLDER, step + STEP_MARKER_EXTENSION)
+
+def mark_step_done(output_folder: str, step: str) -> None:
+    """Records that a step (or a composite step, e.g. all) completed for a session, see run.py --resume
+
+    Args:
+        output_folder (str): Path to session output folder
+        step (str): The step
+    """
+    get_pipeline_state_folder(output_folder)
+    with open(get_step_marker_path(output_folder, step), 'w') as f:
+        json.dump({'completed': datetime.now().isoformat(timespec='seconds')}, f)
+
+def clear_step_done(output_folder: str, step: str) -> None:
+    """Removes the completion marker of a step, e.g. when the step starts again
+
+    Args:
+        output_folder (str): Path to session output folder
+        step (str): The step
+    """
+    try:
+        os.remove(get_step_marker_path(output_folder, step))
+    except FileNotFoundError:
+        pass
+
+def get_done_steps(output_folder: str) -> List[str]:
+    """Gets the steps with a completion marker for a session
+
+    Args:
+        output_folder (str): Path to session output folder
+
+    Returns:
+        List[str]: The steps
+    """
+    state_folder = os.path.join(output_folder, PIPELINE_STATE_FOLDER)
+    if not os.path.isdir(state_folder):
+        return []
+    return [name[:-len(STEP_MARKER_EXTENSION)] for name in os.listdir(state_folder) if name.endswith(STEP_MARKER_EXTENSION)]
+
+def is_step_done(output_folder: str, step: str) -> bool:
+    """Checks if a step completed for a session since it was last started
+
+    Args:
+        output_folder (str): Path to session output folder
+        step (str): The step
+
+    Returns:
+        bool: True if the step completed
+    """
+    return os.path.isfile(get_step_marker_path(output_folder, step))
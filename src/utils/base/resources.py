@@ -0,0 +1,18 @@
+import os
+
+
+def get_available_cpus() -> int:
+    """Gets the number of cpus this task may use. Uses the slurm allocation if there is one, otherwise the cpus the process is allowed to run on
+
+    Returns:
+        int: Number of cpus
+    """
+    slurm_cpus = os.environ.get('SLURM_CPUS_PER_TASK')
+
+    if slurm_cpus is not None and slurm_cpus.isdigit() and int(slurm_cpus) > 0:
+        return int(slurm_cpus)
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
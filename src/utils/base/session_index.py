@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+VIEWS = ['AX', 'COR', 'SAG', 'UK']
+
+# a folder modified this recently may still change within the resolution of its modification time, so it is scanned again on the next query
+RACY_INTERVAL_NS = 2 * 10**9
+
+# matches any value in SessionIndex.find
+ANY = object()
+
+class SessionFile(NamedTuple):
+    """A file of a session parsed from its name, e.g. <subject>_AX_T1_1_brain.nii.gz or <subject>_DWI_to_T1_Warped.nii.gz
+
+    role is one of image, brain, mask, mask_edit, resampled, first_vol, old, segmentation (files before registration),
+    registered, registered_brain, registered_segmentation, transform, registration_output (files after registration) or other
+    """
+    name: str
+    path: str
+    extension: str
+    subject: Optional[str]
+    view: Optional[str]
+    sequence: Optional[str]
+    variant: Optional[str]
+    role: str
+    target: Optional[str]
+
+# suffixes of file names before registration and their role, checked in order
+ROLE_SUFFIXES = [
+    ('_mask_edit', 'mask_edit'),
+    ('_mask', 'mask'),
+    ('_brain_resampled', 'resampled'),
+    ('_resampled', 'resampled'),
+    ('_brain', 'brain'),
+    ('_first_vol', 'first_vol'),
+]
+
+def split_extension(name: str) -> Tuple[str, str]:
+    if name.endswith('.nii.gz'):
+        return name[:-len('.nii.gz')], '.nii.gz'
+    return os.path.splitext(name)
+
+def parse_session_file_name(folder: str, name: str, subject: str) -> SessionFile:
+    """Parses the name of a file created by the pipeline
+
+    Args:
+        folder (str): Folder the file is in
+        name (str): Name of the file
+        subject (str): Name of the subject of the session, file names start with it
+
+    Returns:
+        SessionFile: The parsed file, has role other and no other fields if the name does not start with the subject
+    """
+    stem, extension = split_extension(name)
+    path = os.path.join(folder, name)
+
+    if not stem.startswith(subject + '_'):
+        return SessionFile(name, path, extension, None, None, None, None, 'other', None)
+
+    rest = stem[len(subject) + 1:]
+
+    # <moving>_to_<target>_<registration output>
+    target = None
+    registration_output = None
+    if '_to_' in rest:
+        rest, registered = rest.split('_to_', 1)
+        target, _, registration_output = registered.partition('_')
+
+    role = 'image'
+    if any(x in rest.lower() for x in ['seg', 'lesion', 'stroke']):
+        role = 'segmentation'
+        tokens = []
+    else:
+        for suffix, suffix_role in ROLE_SUFFIXES:
+            if rest.endswith(suffix) or rest == suffix[1:]:
+                role = suffix_role
+                rest = rest[:-len(suffix)] if rest.endswith(suffix) else ''
+                break
+
+        tokens = [x for x in rest.split('_') if x != '']
+        if 'old' in [x.lower() for x in tokens]:
+            role = 'old'
+
+    view = tokens.pop(0) if len(tokens) > 0 and tokens[0] in VIEWS else None
+    sequence = tokens[0] if len(tokens) > 0 else None
+    variant = '_'.join(tokens[1:]) if len(tokens) > 1 else None
+
+    if target is not None:
+        if 'GenericAffine' in registration_output:
+            role = 'transform'
+        elif registration_output == 'Warped' and role == 'segmentation':
+            role = 'registered_segmentation'
+        elif registration_output == 'Warped':
+            role = 'registered'
+        elif registration_output == 'Warped_brain':
+            role = 'registered_brain'
+        else:
+            role = 'registration_output'
+
+    return SessionFile(name, path, extension, subject, view, sequence, variant, role, target)
+
+def _matches(value, criterion) -> bool:
+    if criterion is ANY:
+        return True
+    if isinstance(criterion, (list, tuple, set)):
+        return value in criterion
+    return value == criterion
+
+class SessionIndex:
+    """Catalog of the files in a session folder. The folder is listed once with os.scandir and listed again only
+    when it changes (files created, deleted or renamed), so queries do not go to the filesystem"""
+
+    def __init__(self, folder: str, subject: str):
+        self.folder = folder
+        self.subject = subject
+        self._lock = threading.RLock()
+        self._folder_mtime = None
+        self._entries: Dict[str, os.DirEntry] = {}
+        self._files: Dict[str, SessionFile] = {}
+
+    def refresh(self, force: bool = False) -> None:
+        """Lists the folder again if it changed since it was last listed
+
+        Args:
+            force (bool, optional): List the folder even if it did not change, e.g. after files were overwritten. Defaults to False.
+        """
+        with self._lock:
+            folder_mtime = os.stat(self.folder).st_mtime_ns
+
+            if not force and folder_mtime == self._folder_mtime:
+                return
+
+            with os.scandir(self.folder) as entries:
+                self._entries = {entry.name: entry for entry in entries if not entry.name.startswith('.') and entry.is_file()}
+            self._files = {name: parse_session_file_name(self.folder, name, self.subject) for name in sorted(self._entries)}
+
+            self._folder_mtime = folder_mtime if time.time_ns() - folder_mtime > RACY_INTERVAL_NS else None
+
+    def add(self, path: str) -> None:
+        """Adds (or updates) a file written to the folder
+
+        Args:
+            path (str): Path to the file
+        """
+        with self._lock:
+            self.refresh()
+            name = os.path.basename(path)
+            self._entries.pop(name, None)
+            self._files[name] = parse_session_file_name(self.folder, name, self.subject)
+
+    def names(self) -> List[str]:
+        """Gets the names of all (non-hidden) files in the folder
+
+        Returns:
+            List[str]: The file names, sorted
+        """
+        with self._lock:
+            self.refresh()
+            return list(self._files)
+
+    def contains(self, name: str) -> bool:
+        """Checks if a file is in the folder
+
+        Args:
+            name (str): File name or path
+
+        Returns:
+            bool: True if the file exists
+        """
+        with self._lock:
+            self.refresh()
+            return os.path.basename(name) in self._files
+
+    def get_mtime(self, name: str) -> int:
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry.stat().st_mtime_ns if entry is not None else os.stat(os.path.join(self.folder, name)).st_mtime_ns
+
+    def find(self, view=ANY, sequence=ANY, variant=ANY, role=ANY, target=ANY, extension='.nii.gz', newest_first: bool = False) -> List[SessionFile]:
+        """Finds files by their parsed name. Each criterion is a value, a list of allowed values or ANY
+
+        Args:
+            view (optional): e.g. AX. Defaults to ANY.
+            sequence (optional): e.g. T1. Defaults to ANY.
+            variant (optional): Suffix of files converted from multiple dicom folders of one sequence, e.g. 1. Defaults to ANY.
+            role (optional): See SessionFile. Defaults to ANY.
+            target (optional): Sequence the file was registered to. Defaults to ANY.
+            extension (optional): Defaults to '.nii.gz'.
+            newest_first (bool, optional): Sort by modification time (newest first) instead of by name. Defaults to False.
+
+        Returns:
+            List[SessionFile]: The matching files
+        """
+        with self._lock:
+            self.refresh()
+            files = [file for file in self._files.values()
+                     if _matches(file.view, view) and _matches(file.sequence, sequence) and _matches(file.variant, variant)
+                     and _matches(file.role, role) and _matches(file.target, target) and _matches(file.extension, extension)]
+
+            if newest_first:
+                files.sort(key=lambda file: -self.get_mtime(file.name))
+
+            return files
+
+    def get_image(self, sequence: str, view: str = 'AX') -> Optional[SessionFile]:
+        """Gets the image of a sequence converted from the first dicom folder of the sequence, e.g. <subject>_AX_T1.nii.gz
+
+        Args:
+            sequence (str): e.g. T1
+            view (str, optional): Defaults to 'AX'.
+
+        Returns:
+            SessionFile | None: The image, None if the session does not have it
+        """
+        files = self.find(view=view, sequence=sequence, variant=None, role='image')
+        return files[0] if len(files) > 0 else None
+
+    def get_mask(self, sequence: str) -> Optional[SessionFile]:
+        """Gets the brain mask of a sequence, a hand edited mask (<subject>_AX_T1_mask_edit.nii.gz) is preferred over a generated one
+
+        Args:
+            sequence (str): e.g. T1
+
+        Returns:
+            SessionFile | None: The mask, None if the session has no mask for the sequence
+        """
+        masks = self.find(sequence=sequence, role='mask_edit', target=None) or self.find(sequence=sequence, role='mask', target=None)
+        return masks[0] if len(masks) > 0 else None
+
+_session_indexes: Dict[Tuple[str, str], SessionIndex] = {}
+_session_indexes_lock = threading.Lock()
+
+def get_session_index(folder: str, subject: str) -> SessionIndex:
+    """Gets the index of a session folder, shared by all processors of the process
+
+    Args:
+        folder (str): Path to session folder
+        subject (str): Name of the subject of the session
+
+    Returns:
+        SessionIndex: The index
+    """
+    key = (os.path.abspath(folder), subject)
+    with _session_indexes_lock:
+        if key not in _session_indexes:
+            _session_indexes[key] = SessionIndex(key[0], subject)
+        return _session_indexes[key]
@@ -0,0 +1,231 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, List
+
+import nibabel as nib
+
+from .resources import get_available_cpus
+from .atomic import get_temp_path, publish_output
+
+path_to_storage_config = os.path.abspath(__file__ + '/../../../../config/storage_config.json')
+storage_config = json.load(open(path_to_storage_config))
+
+# gzip level niftis are written with by the pipeline while sessions are processed, for each intermediate format.
+# Files keep their .nii.gz names in every format, so file name resolution does not depend on the format
+INTERMEDIATE_COMPRESS_LEVELS = {
+    # stored (level 0) gzip, no deflate cost when writing or reading
+    'uncompressed': 0,
+    'fast': 1,
+    # the final level, compressed on several threads
+    'parallel': None,
+}
+
+# uncompressed bytes compressed per thread in the parallel format, each chunk is a gzip member of the file
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+
+# gzip header flags, see RFC 1952
+FHCRC, FEXTRA, FNAME, FCOMMENT = 2, 4, 8, 16
+# extra flags byte of files gzipped at level 1
+XFL_FASTEST = 4
+
+def get_final_compress_level() -> int:
+    return storage_config['final_compress_level']
+
+def get_intermediate_compress_level() -> int:
+    level = INTERMEDIATE_COMPRESS_LEVELS[storage_config['intermediate_format']]
+    return get_final_compress_level() if level is None else level
+
+def get_gzip_threads() -> int:
+    if storage_config['intermediate_format'] != 'parallel':
+        return 1
+    return storage_config.get('parallel_threads') or get_available_cpus()
+
+class ParallelGzipWriter(io.IOBase):
+    """Write-only file object gzipping what is written to it on several threads (zlib releases the GIL). The data is compressed
+    in chunks of PARALLEL_CHUNK_SIZE bytes and the chunks are written as gzip members, which every gzip reader (nibabel, fsl, itk)
+    reads as one stream. At most two chunks per thread are held in memory
+
+    Args:
+        fileobj (BinaryIO): File to write the gzipped data to
+        level (int): Compress level (0-9)
+        threads (int): Number of threads
+    """
+
+    def __init__(self, fileobj: BinaryIO, level: int, threads: int):
+        super().__init__()
+        self._fileobj = fileobj
+        self._level = level
+        self._executor = ThreadPoolExecutor(threads)
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast('B')
+        self._buffer += data
+        self._position += len(data)
+
+        while len(self._buffer) >= PARALLEL_CHUNK_SIZE:
+            self._submit(bytes(self._buffer[:PARALLEL_CHUNK_SIZE]))
+            del self._buffer[:PARALLEL_CHUNK_SIZE]
+
+        return len(data)
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # nibabel seeks to where the image data starts, which is where it already is
+        if whence != os.SEEK_SET or offset != self._position:
+            raise OSError('ParallelGzipWriter can only be written to in order')
+        return self._position
+
+    def _submit(self, chunk: bytes) -> None:
+        self._pending.append(self._executor.submit(gzip.compress, chunk, self._level, mtime=0))
+        # chunks are written in order as they are done
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        # an empty file is still a gzip member
+        if len(self._buffer) > 0 or self._position == 0:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        try:
+            while len(self._pending) > 0:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown()
+            super().close()
+
+def write_gzip(path: str, write: Callable[[BinaryIO], None], level: int) -> None:
+    """Gzips a file as it is written, without holding its (uncompressed or compressed) content in memory
+
+    Args:
+        path (str): Path to the file
+        write (Callable[[BinaryIO], None]): Writes the uncompressed content to the file object it is given
+        level (int): Compress level (0-9)
+    """
+    threads = get_gzip_threads()
+
+    # written next to the file and renamed, readers never see a partially written file
+    temp_path = get_temp_path(path)
+    with open(temp_path, 'wb') as f:
+        # no file name or time in the gzip header, the same content always gives the same file
+        with (ParallelGzipWriter(f, level, threads) if threads > 1 else gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=f, mtime=0)) as gz:
+            write(gz)
+    publish_output(temp_path, path)
+
+def save_nifti(img: nib.Nifti1Image, path: str, final: bool = False) -> None:
+    """Saves a nifti the way config/storage_config.json says. Use instead of nib.save
+
+    Args:
+        img (nib.Nifti1Image): The image
+        path (str): Path to save to, .nii.gz files are compressed according to the storage config
+        final (bool, optional): The file is a deliverable that is not finalized later (e.g. written after all sessions ran),
+            compress it at the final level right away. Defaults to False.
+    """
+    if not path.endswith('.gz'):
+        nib.save(img, path)
+        return
+
+    if not isinstance(img, nib.Nifti1Image):
+        img = nib.Nifti1Image(img.dataobj, img.affine, header=img.header)
+
+    level = get_final_compress_level() if final else get_intermediate_compress_level()
+    # like img.to_bytes, but the header and the data are streamed through the compressor
+    write_gzip(path, lambda f: img.to_file_map(img.make_file_map({'image': f, 'header': f})), level)
+
+def get_gzip_compression(path: str) -> str:
+    """Finds out how a gzip file was compressed from its header and the first deflate block
+
+    Args:
+        path (str): Path to gzip file
+
+    Returns:
+        str: 'stored' (level 0), 'fastest' (level 1) or 'other'
+    """
+    with open(path, 'rb') as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b'\x1f\x8b\x08':
+            return 'other'
+
+        flags = header[3]
+        if flags & FEXTRA:
+            f.read(int.from_bytes(f.read(2), 'little'))
+        for flag in [FNAME, FCOMMENT]:
+            if flags & flag:
+                while f.read(1) not in [b'\x00', b'']:
+                    pass
+        if flags & FHCRC:
+            f.read(2)
+
+        first_block = f.read(1)
+
+    # bits 1-2 of a deflate block are its type, 0 for stored
+    if len(first_block) == 1 and (first_block[0] >> 1) & 3 == 0:
+        return 'stored'
+    return 'fastest' if header[8] == XFL_FASTEST else 'other'
+
+def finalize_niftis(folder: str) -> List[str]:
+    """Compresses the niftis written in an intermediate format in a folder at the final level, once after all steps of a session ran
+
+    Args:
+        folder (str): Path to folder, e.g. a session output folder
+
+    Returns:
+        List[str]: Paths to the compressed niftis
+    """
+    intermediate_level = get_intermediate_compress_level()
+    final_level = get_final_compress_level()
+
+    if intermediate_level == final_level:
+        return []
+
+    compressions = ['stored'] if intermediate_level == 0 else ['stored', 'fastest']
+
+    finalized = []
+    with os.scandir(folder) as entries:
+        paths = [entry.path for entry in entries if entry.is_file() and entry.name.endswith('.nii.gz') and not entry.name.startswith('.')]
+
+    for path in paths:
+        if get_gzip_compression(path) not in compressions:
+            continue
+
+        with gzip.open(path, 'rb') as f:
+            write_gzip(path, lambda gz: shutil.copyfileobj(f, gz, PARALLEL_CHUNK_SIZE), final_level)
+        finalized.append(path)
+
+    return finalized
+
+def hash_nifti_content(path: str, hasher) -> None:
+    """Feeds the uncompressed content of a gzipped nifti to a hash, so recompressing the file does not change its hash
+
+    Args:
+        path (str): Path to .nii.gz file
+        hasher: e.g. hashlib.sha1()
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            while len(chunk) > 0:
+                hasher.update(decompressor.decompress(chunk))
+                if not decompressor.eof:
+                    break
+                # next gzip member
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
@@ -44,15 +44,29 @@ def get_all_subjects(root_folder, subject_file=None):
     
     return folders_in_root
 
-def is_session_folder(folder):
+def is_session_folder(folder, dicom_index=None):
     """Determines if a folder is a session folder
 
     Args:
         folder (string): Path to folder
+        dicom_index (DicomIndex, optional): Index to look the folder up in instead of the filesystem. Defaults to None.
 
     Returns:
         bool: True if folder is session folder, false otherwise
     """
+    indexed_folder = dicom_index.get_folder(folder) if dicom_index is not None else None
+    if indexed_folder is not None:
+        # the same rule as below, from what the index recorded of the listings
+        if indexed_folder.has_nifti:
+            return True
+        if indexed_folder.first_subfolder is None:
+            return False
+        first_subfolder = dicom_index.get_folder(os.path.join(folder, indexed_folder.first_subfolder))
+        if first_subfolder is not None:
+            return first_subfolder.has_dcm_names
+        # hidden folders are not indexed
+        return any(file.endswith('dcm') for file in os.listdir(os.path.join(folder, indexed_folder.first_subfolder)))
+
     _, folders, files = next(os.walk(folder))
     
     folder_has_nifti_files = any(file.endswith('.nii') or file.endswith('.nii.gz') for file in files)
@@ -67,21 +81,26 @@ def is_session_folder(folder):
     return False
 
 
-def find_sessions_for_subject(subject_folder):
+def find_sessions_for_subject(subject_folder, dicom_index=None):
     """Finds all session folders in a subject folder
     
     Args:
         subject_folder (string): Path to subject folder
+        dicom_index (DicomIndex, optional): Index to look the folders up in instead of the filesystem. Defaults to None.
     Returns:
         list[string]: A list of session folders inside the subject_folder. Note that the subject folder itself may be a session folder
     """
-    if is_session_folder(subject_folder):
+    if is_session_folder(subject_folder, dicom_index):
         return [subject_folder]
     
-    _, session_folders, _ = next(os.walk(subject_folder))
+    indexed_folder = dicom_index.get_folder(subject_folder) if dicom_index is not None else None
+    if indexed_folder is not None:
+        session_folders = indexed_folder.subfolders
+    else:
+        _, session_folders, _ = next(os.walk(subject_folder))
     return [os.path.join(subject_folder, session) for session in session_folders]
 
-def find_all_sessions_for_subjects(root_folder, subjects):
+def find_all_sessions_for_subjects(root_folder, subjects, dicom_index=None):
     """Generates a subject to session folders map. If the subject is single session, the list has one element, the subject folder itself
     For example
     {
@@ -93,6 +112,7 @@ def find_all_sessions_for_subjects(root_folder, subjects):
     Args:
         root_folder (string): Top level folder containing all subject folders
         subjects (list[string]): A list of all subject names (subject folders)
+        dicom_index (DicomIndex, optional): Index of the root folder, see utils/base/dicom_index.py. Defaults to None.
 
     Raises:
         Exception: IF a subject folder is empty
@@ -103,6 +123,6 @@ def find_all_sessions_for_subjects(root_folder, subjects):
 
     result_dict = {}
     for subject in subjects:
-        result_dict[subject] = find_sessions_for_subject(os.path.join(root_folder, subject))
+        result_dict[subject] = find_sessions_for_subject(os.path.join(root_folder, subject), dicom_index)
     
     return result_dict
@@ -0,0 +1 @@
+from .step_cache import run_with_step_cache, get_pipeline_state_folder
\ No newline at end of file
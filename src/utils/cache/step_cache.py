@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+from importlib import metadata
+
+from ..registration import run_cmd
+from ..base import hash_nifti_content, get_pipeline_state_folder, PIPELINE_STATE_FOLDER
+
+config_folder = os.path.abspath(__file__ + '/../../../../config/')
+
+MANIFEST_FILE = 'manifest.json'
+
+# commands printing the version of external tools, anything else is looked up as a python package
+TOOL_VERSION_COMMANDS = {
+    'ants': 'antsRegistration --version',
+    'fsl': 'cat $FSLDIR/etc/fslversion',
+}
+
+_file_hashes = {}
+_tool_versions = {}
+_manifest_lock = threading.Lock()
+
+def hash_file(path: str) -> str:
+    """Hashes the content of a file. Hashes are remembered for the lifetime of the process as long as the file's size and modification time do not change.
+    Gzipped niftis are hashed by their uncompressed content, so niftis recompressed by the storage policy (see utils/base/storage.py) keep their hash
+
+    Args:
+        path (str): Path to file
+
+    Returns:
+        str: Hex digest of the file content
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+
+    if key not in _file_hashes:
+        sha = hashlib.sha1()
+        if path.endswith('.nii.gz'):
+            hash_nifti_content(path, sha)
+        else:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+        _file_hashes[key] = sha.hexdigest()
+
+    return _file_hashes[key]
+
+def hash_folder(path: str) -> str:
+    """Hashes the names, sizes and modification times of all files in a folder tree.
+    Used for dicom folders, where hashing the content would mean reading every slice
+
+    Args:
+        path (str): Path to folder
+
+    Returns:
+        str: Hex digest of the folder listing
+    """
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            stat = os.stat(file_path)
+            sha.update(f'{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return sha.hexdigest()
+
+def get_tool_version(tool: str) -> str:
+    """Gets the version of an external tool or python package, queried once per process
+
+    Args:
+        tool (str): Key of TOOL_VERSION_COMMANDS or name of a python package
+
+    Returns:
+        str: The version, 'unknown' if it could not be determined
+    """
+    if tool not in _tool_versions:
+        version = 'unknown'
+        if tool in TOOL_VERSION_COMMANDS:
+            out, _, code = run_cmd(TOOL_VERSION_COMMANDS[tool])
+            if code == 0:
+                version = out.strip()
+        else:
+            try:
+                version = metadata.version(tool)
+            except metadata.PackageNotFoundError:
+                pass
+        _tool_versions[tool] = version
+
+    return _tool_versions[tool]
+
+def get_step_fingerprint(processor, input_paths: List[str]) -> str:
+    """Computes the fingerprint of a processor run from its input files, its config files and the versions of the tools it uses
+
+    Args:
+        processor (SessionProcessor): The processor
+        input_paths (List[str]): Files and folders the processor reads
+
+    Returns:
+        str: Hex digest identifying the run
+    """
+    fingerprint = {
+        'inputs': {path: hash_file(path) if os.path.isfile(path) else hash_folder(path) for path in input_paths if os.path.exists(path)},
+        'config': {config_file: hash_file(os.path.join(config_folder, config_file)) for config_file in processor.CACHE_CONFIG_FILES},
+        'tools': {tool: get_tool_version(tool) for tool in processor.CACHE_TOOLS},
+    }
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+def read_manifest(output_folder: str) -> Dict[str, dict]:
+    manifest_path = os.path.join(output_folder, PIPELINE_STATE_FOLDER, MANIFEST_FILE)
+
+    if not os.path.isfile(manifest_path):
+        return {}
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def update_manifest(output_folder: str, step: str, entry: Optional[dict]) -> None:
+    with _manifest_lock:
+        manifest = read_manifest(output_folder)
+        if entry is not None:
+            manifest[step] = entry
+        else:
+            manifest.pop(step, None)
+
+        manifest_path = os.path.join(get_pipeline_state_folder(output_folder), MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+def run_with_step_cache(step: str, processor, session_info: dict) -> bool:
+    """Runs a processor for a session unless its inputs, config and tools are unchanged since its last successful run and all its outputs
+    (see SessionProcessor.get_cache_outputs) still exist. Failed runs are not remembered
+
+    Args:
+        step (str): Name of the step
+        processor (SessionProcessor): The processor of the step
+        session_info (dict): The session
+
+    Returns:
+        bool: False if the processor failed, True if it succeeded or was skipped
+    """
+    input_paths = processor.get_cache_inputs(session_info)
+
+    if input_paths is None:
+        # processor does not support caching
+        return processor.process_session(session_info)
+
+    output_folder = session_info["output_folder"]
+    entry = read_manifest(output_folder).get(step)
+    # outputs are recorded relative to the output folder
+    previous_outputs = set(os.path.abspath(os.path.join(output_folder, output)) for output in entry["outputs"]) if entry is not None else set()
+
+    # a processor's own outputs are never its inputs (e.g. brain files rewritten on every run)
+    input_paths = [path for path in input_paths if os.path.abspath(path) not in previous_outputs]
+    fingerprint = get_step_fingerprint(processor, input_paths)
+
+    if not session_info.get("force") and entry is not None and entry["fingerprint"] == fingerprint and all(os.path.exists(output) for output in previous_outputs):
+        print(f'Skipping {step} for {session_info["subject"]}: inputs unchanged since last run', flush=True)
+        return True
+
+    succeeded = processor.process_session(session_info)
+
+    # a failed run may have written some of its outputs (and overwritten those of the last run), it is run again next time
+    if succeeded:
+        outputs = sorted(set(os.path.relpath(os.path.abspath(path), os.path.abspath(output_folder)) for path in processor.get_cache_outputs(session_info)))
+        update_manifest(output_folder, step, {"fingerprint": fingerprint, "outputs": outputs})
+    elif entry is not None:
+        update_manifest(output_folder, step, None)
+
+    return succeeded
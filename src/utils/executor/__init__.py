@@ -0,0 +1 @@
+from .executors import Executor, SlurmExecutor, SlurmArrayExecutor, LocalExecutor, get_executor, EXECUTORS
\ No newline at end of file
@@ -0,0 +1,253 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+path_to_executor_config = os.path.abspath(__file__ + '/../../../../config/executor_config.json')
+executor_config = json.load(open(path_to_executor_config))
+
+# folder with the scripts the jobs run (run_step_for_subject.py, preprocess.py, ...)
+src_folder = os.path.abspath(__file__ + '/../../../')
+
+# slurm's default MaxArraySize, used when the cluster's cannot be read
+DEFAULT_MAX_ARRAY_SIZE = 1001
+
+ENVIRONMENT_SETUP = """module load python/3.8.0
+module load dcm2niix
+module load ANTs/2.3.2
+module load fsl/5.0.10
+module load afni/20191017
+module load openmpi/2.1.1
+module load libpng/1.2.59
+module load gsl
+export LD_PRELOAD=/usr/lib64/libfreetype.so
+source $FSLDIR/etc/fslconf/fsl.sh
+
+export PYTHONPATH=/hpf/projects/ndlamini/scratch/wgao/python3.8.0/
+export TF_CPP_MIN_LOG_LEVEL=3"""
+
+def get_sbatch_header(email: Optional[str], ntasks: int = 1, extra_options: Optional[List[str]] = None) -> str:
+    options = [
+        f'--time={executor_config["time"]}',
+        f'--cpus-per-task={executor_config["cpus_per_task"]}',
+        f'--mem-per-cpu={executor_config["mem_per_cpu"]}',
+        '--mail-type=ALL',
+        f'--ntasks={ntasks}',
+    ] + (extra_options or [])
+
+    if email:
+        options.append(f'--mail-user={email}')
+
+    return '#!/bin/bash\n\n' + '\n'.join(f'#SBATCH {option}' for option in options)
+
+def write_session_list(output_root_folder: str, name: str, session_lists: list) -> str:
+    """Writes sessions to a json file in the output root folder for jobs to read, instead of passing them on the command line
+
+    Args:
+        output_root_folder (str): Path to output root folder
+        name (str): Name of the file (without extension)
+        session_lists (list): The sessions
+
+    Returns:
+        str: Path to the file
+    """
+    session_list_file = os.path.join(output_root_folder, f'{name}.json')
+    with open(session_list_file, 'w') as f:
+        json.dump(session_lists, f)
+    return session_list_file
+
+def sbatch(script: str, dependency: Optional[str] = None) -> str:
+    """Submits a script to slurm
+
+    Args:
+        script (str): The sbatch script
+        dependency (str, optional): Value of sbatch's --dependency option, e.g. afterok:<job id>. Defaults to None.
+
+    Returns:
+        str: Id of the submitted job
+    """
+    cmd = ['sbatch', '--parsable'] + ([f'--dependency={dependency}'] if dependency else [])
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, text=True)
+    out, err = p.communicate(input=script)
+
+    if p.returncode != 0:
+        raise Exception(f'sbatch failed: {err}')
+
+    # --parsable prints <job id>[;<cluster>]
+    return out.strip().split(';')[0]
+
+def get_max_array_size() -> int:
+    """Gets the maximum number of tasks of a job array (array indices go from 0 to MaxArraySize - 1). Read from the executor config,
+    or from `scontrol show config` when the config leaves it unset
+
+    Returns:
+        int: MaxArraySize of the cluster, DEFAULT_MAX_ARRAY_SIZE if it cannot be determined
+    """
+    if executor_config.get('max_array_size'):
+        return executor_config['max_array_size']
+
+    try:
+        out = subprocess.run(['scontrol', 'show', 'config'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    except OSError:
+        return DEFAULT_MAX_ARRAY_SIZE
+
+    match = re.search(r'^MaxArraySize\s*=\s*(\d+)', out, re.MULTILINE)
+    return int(match.group(1)) if match is not None else DEFAULT_MAX_ARRAY_SIZE
+
+class Executor(ABC):
+    """Runs a step for the sessions found by run.py"""
+
+    @abstractmethod
+    def submit(self, session_info_list: List[dict], step: str, output_root_folder: str, email: Optional[str] = None, batch: bool = False) -> None:
+        """Runs (or submits jobs that run) the step for the sessions, with preprocess.py before and postprocess.py after all sessions
+
+        Args:
+            session_info_list (List[dict]): The sessions
+            step (str): The step, see processor/workflow.py
+            output_root_folder (str): Path to output root folder
+            email (str, optional): Email to notify about the jobs. Defaults to None.
+            batch (bool, optional): Process all sessions in one task with run_step_for_sessions.py. Defaults to False.
+        """
+        pass
+
+class SlurmExecutor(Executor):
+    """One job with one slurm task per session, the session infos are passed to the tasks on the command line"""
+
+    def get_session_commands(self, session_info_list: List[dict], step: str) -> str:
+        return ' & '.join([f"srun --ntasks 1 --nodes 1 -c {executor_config['cpus_per_task']} --quiet --job-name={session_info['session']} python3 run_step_for_subject.py '{json.dumps(session_info)}' {step}" for session_info in session_info_list])
+
+    def get_batch_command(self, session_info_list: List[dict], step: str, output_root_folder: str) -> str:
+        session_list_file = write_session_list(output_root_folder, f'session_list_{step}', session_info_list)
+        return f"srun --ntasks 1 --nodes 1 -c {executor_config['cpus_per_task']} --quiet --job-name=batch_{step} python3 run_step_for_sessions.py '{session_list_file}' {step}"
+
+    def get_sbatch_script(self, session_info_list: List[dict], step: str, email: Optional[str], output_root_folder: str, batch: bool = False) -> str:
+        run_commands = self.get_batch_command(session_info_list, step, output_root_folder) if batch else self.get_session_commands(session_info_list, step)
+        return f"""{get_sbatch_header(email, 1 if batch else len(session_info_list))}
+
+{ENVIRONMENT_SETUP}
+
+cd {src_folder}
+
+python preprocess.py {step} {output_root_folder}
+
+{run_commands}
+
+wait
+
+python postprocess.py {step} {output_root_folder}
+
+echo Done!
+"""
+
+    def submit(self, session_info_list: List[dict], step: str, output_root_folder: str, email: Optional[str] = None, batch: bool = False) -> None:
+        job_id = sbatch(self.get_sbatch_script(session_info_list, step, email, output_root_folder, batch))
+        print(f'Submitted batch job {job_id}')
+
+class SlurmArrayExecutor(Executor):
+    """A slurm job array with one array task per group of sessions. The groups are written to a manifest file that each array task
+    reads its sessions from by SLURM_ARRAY_TASK_ID, so the script stays small for any number of sessions.
+    preprocess.py and postprocess.py run in their own jobs before and after the array. Manifests with more tasks than the cluster's
+    MaxArraySize (see get_max_array_size) are split over several job arrays
+
+    Args:
+        sessions_per_task (int, optional): Number of sessions each array task processes one after the other. Defaults to the executor config.
+        throttle (int, optional): Maximum number of array tasks running at the same time. Defaults to the executor config.
+    """
+
+    def __init__(self, sessions_per_task: Optional[int] = None, throttle: Optional[int] = None):
+        self.sessions_per_task = sessions_per_task or executor_config['sessions_per_task']
+        self.throttle = throttle or executor_config['array_throttle']
+
+    def get_tasks(self, session_info_list: List[dict]) -> List[List[dict]]:
+        return [session_info_list[i:i + self.sessions_per_task] for i in range(0, len(session_info_list), self.sessions_per_task)]
+
+    def get_script(self, command: str, email: Optional[str], extra_options: Optional[List[str]] = None) -> str:
+        return f"""{get_sbatch_header(email, 1, extra_options)}
+
+{ENVIRONMENT_SETUP}
+
+cd {src_folder}
+
+{command}
+"""
+
+    def submit(self, session_info_list: List[dict], step: str, output_root_folder: str, email: Optional[str] = None, batch: bool = False) -> None:
+        if batch:
+            raise Exception('--batch runs all sessions in a single task, use it with the slurm or local executor')
+
+        tasks = self.get_tasks(session_info_list)
+        if len(tasks) == 0:
+            print('No sessions to process')
+            return
+
+        manifest_file = write_session_list(output_root_folder, f'session_tasks_{step}_{datetime.now().strftime("%y%m%d-%H%M%S")}', tasks)
+
+        preprocess_job = sbatch(self.get_script(f'python preprocess.py {step} {output_root_folder}', None, [f'--job-name=preprocess_{step}']))
+
+        # each array runs the tasks of the manifest from its offset on
+        max_array_size = get_max_array_size()
+        array_jobs = []
+        for offset in range(0, len(tasks), max_array_size):
+            num_tasks = min(max_array_size, len(tasks) - offset)
+            array_options = [f'--array=0-{num_tasks - 1}%{self.throttle}', f'--job-name={step}']
+            array_jobs.append(sbatch(self.get_script(f"python run_array_task.py '{manifest_file}' {step} {offset}", None, array_options), f'afterok:{preprocess_job}'))
+
+        # runs when all array tasks finished, failed or not
+        postprocess_job = sbatch(self.get_script(f'python postprocess.py {step} {output_root_folder}\n\necho Done!', email, [f'--job-name=postprocess_{step}']), 'afterany:' + ':'.join(array_jobs))
+
+        print(f'Submitted array job{"s" if len(array_jobs) > 1 else ""} {", ".join(array_jobs)} with {len(tasks)} tasks for {len(session_info_list)} sessions (preprocess job {preprocess_job}, postprocess job {postprocess_job})')
+
+class LocalExecutor(Executor):
+    """Runs the sessions on this machine, each in its own process (like a slurm task), without slurm
+
+    Args:
+        num_workers (int, optional): Number of sessions processed at the same time. Defaults to the executor config, or to the cpus of the machine divided by the cpus per task.
+    """
+
+    def __init__(self, num_workers: Optional[int] = None):
+        self.num_workers = num_workers or executor_config['local_workers'] or max(1, (os.cpu_count() or 1) // executor_config['cpus_per_task'])
+
+    def run(self, args: List[str]) -> int:
+        # the pipeline sizes its thread pools from the cpus of the slurm task (see utils/base/resources.py)
+        env = dict(os.environ, SLURM_CPUS_PER_TASK=str(executor_config['cpus_per_task']))
+        return subprocess.run([sys.executable] + args, cwd=src_folder, env=env).returncode
+
+    def submit(self, session_info_list: List[dict], step: str, output_root_folder: str, email: Optional[str] = None, batch: bool = False) -> None:
+        self.run(['preprocess.py', step, output_root_folder])
+
+        if batch:
+            session_list_file = write_session_list(output_root_folder, f'session_list_{step}', session_info_list)
+            codes = [self.run(['run_step_for_sessions.py', session_list_file, step])]
+        else:
+            with ThreadPoolExecutor(self.num_workers) as executor:
+                codes = list(executor.map(lambda session_info: self.run(['run_step_for_subject.py', json.dumps(session_info), step]), session_info_list))
+
+        self.run(['postprocess.py', step, output_root_folder])
+
+        failed = sum(1 for code in codes if code != 0)
+        print(f'Done! {len(codes) - failed} of {len(codes)} tasks succeeded')
+
+EXECUTORS = ['slurm', 'array', 'local']
+
+def get_executor(name: str, sessions_per_task: Optional[int] = None, throttle: Optional[int] = None, local_workers: Optional[int] = None) -> Executor:
+    """Gets the executor run.py submits with
+
+    Args:
+        name (str): One of EXECUTORS
+        sessions_per_task (int, optional): See SlurmArrayExecutor. Defaults to None.
+        throttle (int, optional): See SlurmArrayExecutor. Defaults to None.
+        local_workers (int, optional): See LocalExecutor. Defaults to None.
+
+    Returns:
+        Executor: The executor
+    """
+    if name == 'array':
+        return SlurmArrayExecutor(sessions_per_task, throttle)
+    elif name == 'local':
+        return LocalExecutor(local_workers)
+    return SlurmExecutor()
@@ -1 +1 @@
-from .lesionHeatmap import postprocessLesionHeatmap
\ No newline at end of file
+from .lesionHeatmap import postprocessLesionHeatmap, saveLesionHeatmapPartial, getLesionHeatmapPartialsFolder
\ No newline at end of file
@@ -1,12 +1,129 @@
 from ..registration import run_cmd
+from ..base import save_nifti
 
 import os
 from datetime import date
 import math
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+import numpy as np
+
+# number of threads used to read and sum lesion partials
+REDUCE_WORKERS = 4
+
+
+def getLesionHeatmapName():
+    return f'lesion_heatmap_{date.today().strftime("%y-%m-%d")}'
+
+
+def getLesionHeatmapPartialsFolder(output_folder):
+    return os.path.join(output_folder, f'{getLesionHeatmapName()}_partials')
+
+
+def getLesionHeatmapPartials(partials_folder):
+    """Lists the partials written by saveLesionHeatmapPartial
+
+    Args:
+        partials_folder (string): See getLesionHeatmapPartialsFolder
+
+    Returns:
+        list: (subject name, path to partial) of each session, sorted
+    """
+    partials = []
+    for subject_name in sorted(os.listdir(partials_folder)):
+        subject_folder = os.path.join(partials_folder, subject_name)
+        if os.path.isdir(subject_folder):
+            partials.extend((subject_name, os.path.join(subject_folder, x)) for x in sorted(os.listdir(subject_folder)) if x.endswith('.npz'))
+    return partials
+
+
+def saveLesionHeatmapPartial(output_folder, subject_name, session_name, lesion_file_path):
+    """Saves a template space lesion as a compact bit-packed partial to be summed into the heatmap by postprocessLesionHeatmap
+
+    Args:
+        output_folder (string): Root output folder the heatmap is created in
+        subject_name (string): Name of subject the lesion belongs to
+        session_name (string): Name of session the lesion belongs to. Session names (e.g. ses-01) repeat across subjects,
+            partials are saved to <partials folder>/<subject>/<session>.npz
+        lesion_file_path (string): Path to the lesion segmentation in template space
+    """
+    partials_folder = os.path.join(getLesionHeatmapPartialsFolder(output_folder), subject_name)
+    os.makedirs(partials_folder, exist_ok=True)
+
+    lesion = nib.load(lesion_file_path)
+    lesion_voxels = np.asanyarray(lesion.dataobj) > 0
+
+    partial_path = os.path.join(partials_folder, f'{session_name}.npz')
+    np.savez_compressed(partial_path, lesion=np.packbits(lesion_voxels), shape=lesion_voxels.shape, affine=lesion.affine)
+
+
+def _sumLesionHeatmapPartials(partial_paths):
+    heatmap = None
+    affine = None
+    for partial_path in partial_paths:
+        with np.load(partial_path) as partial:
+            shape = tuple(partial['shape'])
+            lesion = np.unpackbits(partial['lesion'], count=int(np.prod(shape))).reshape(shape)
+
+            if heatmap is None:
+                heatmap = np.zeros(shape, dtype=np.uint16)
+                affine = partial['affine']
+            elif heatmap.shape != shape:
+                raise Exception(f'Lesion partial {partial_path} has shape {shape} but expected {heatmap.shape}')
+
+            heatmap += lesion
+    return heatmap, affine
+
+
+def reduceLesionHeatmapPartials(output_folder):
+    """Sums all lesion partials into the lesion heatmap, thresholds voxels with less than 10% of subjects and writes the names file
+
+    Args:
+        output_folder (string): Root output folder the heatmap is created in
+    """
+    heatmap_name = getLesionHeatmapName()
+    partials_folder = getLesionHeatmapPartialsFolder(output_folder)
+    partials = getLesionHeatmapPartials(partials_folder)
+
+    if len(partials) == 0:
+        return
+
+    heatmap_file_path = os.path.join(output_folder, heatmap_name + '.nii.gz')
+    thresh_file_path = os.path.join(output_folder, heatmap_name + '_thr.nii.gz')
+
+    # each worker sums its share of the partials, then the per-worker sums are added up
+    partial_paths = [partial_path for _, partial_path in partials]
+    num_workers = min(REDUCE_WORKERS, len(partial_paths))
+    with ThreadPoolExecutor(num_workers) as executor:
+        worker_sums = list(executor.map(_sumLesionHeatmapPartials, [partial_paths[i::num_workers] for i in range(num_workers)]))
+
+    heatmap, affine = worker_sums[0]
+    for worker_heatmap, _ in worker_sums[1:]:
+        if worker_heatmap.shape != heatmap.shape:
+            raise Exception(f'Lesion partials in {partials_folder} do not all have the same shape')
+        heatmap += worker_heatmap
+
+    save_nifti(nib.Nifti1Image(heatmap, affine), heatmap_file_path, final=True)
+
+    with open(os.path.join(output_folder, f'{heatmap_name}_names.txt'), 'w') as name_file:
+        for subject_name, _ in partials:
+            name_file.write(f'{subject_name} added to heatmap: {heatmap_file_path}\n')
+
+    thresh = math.floor(len(partials) * 0.1)
+
+    print(f'Removing voxels with less than {thresh} subjects')
+
+    heatmap[heatmap < thresh] = 0
+    save_nifti(nib.Nifti1Image(heatmap, affine), thresh_file_path, final=True)
 
 
 def postprocessLesionHeatmap(output_folder):
-    heatmap_name = f'lesion_heatmap_{date.today().strftime("%y-%m-%d")}'
+    if os.path.isdir(getLesionHeatmapPartialsFolder(output_folder)):
+        # sessions emitted partials instead of adding to the heatmap themselves
+        reduceLesionHeatmapPartials(output_folder)
+        return
+
+    heatmap_name = getLesionHeatmapName()
     name_file = f'{heatmap_name}_names.txt'
 
     name_file_path = os.path.join(output_folder, name_file)
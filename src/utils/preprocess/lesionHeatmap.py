@@ -1,4 +1,5 @@
 import os
+import shutil
 from datetime import date
 
 def preprocessLesionHeatmap(output_folder):
@@ -22,4 +23,6 @@ def preprocessLesionHeatmap(output_folder):
     try:
         os.remove(f'{heatmap_name}_names.txt')
     except:
-        pass
\ No newline at end of file
+        pass
+
+    shutil.rmtree(f'{heatmap_name}_partials', ignore_errors=True)
\ No newline at end of file
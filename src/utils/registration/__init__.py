@@ -1,8 +1,15 @@
-from .dcm_to_nifti import convert_dcm_folder_to_nifti
-from .generate_mask import generate_brain_mask, generate_brain_mask_using_model, generate_brain_mask_using_3d_model
-from .register_nifti import register_nifti_to_target
+from .dcm_to_nifti import convert_dcm_folder_to_nifti, convert_dcm_folders_to_nifti
+from .generate_mask import generate_brain_mask, generate_brain_mask_using_model, generate_brain_mask_using_3d_model, get_3d_mask_model_path, prepare_3d_mask_model_input, save_3d_mask_prediction
+from .register_nifti import register_nifti_to_target, run_registration, get_registration_outputs
+from .registration_quality import get_registration_similarity, get_header_similarity
 from .check_4d import check_4d
 from .brain_extraction import extract_brain_for_files_and_register_to_target
-from .command import run_cmd, run_cmd_async
-from .stroke_segmentation import segment_stroke
-from .apply_transform import apply_linear_transform
\ No newline at end of file
+from .command import run_cmd, run_cmd_async, run_command, run_commands, start_command, CommandResult
+from .stroke_segmentation import segment_stroke, get_stroke_model_path, prepare_stroke_model_input, save_stroke_prediction
+from .apply_transform import apply_linear_transform, apply_linear_transforms
+from .linear_transform import read_itk_affine, compose_transforms, get_conform_affine, resample_images
+from .model_cache import get_cached_model, clear_model_cache
+from .template_cache import stage_template
+from .batch_inference import chunk_sessions, predict_for_sessions
+from .parallel_registration import register_niftis_to_target, RegistrationJob, RegistrationResult
+from .apply_mask import apply_brain_mask
\ No newline at end of file
@@ -0,0 +1,91 @@
+from ..base import get_available_cpus, save_nifti, load_mask
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import nibabel as nib
+import numpy as np
+
+def load_brain_mask(mask_path: str) -> np.ndarray:
+    """Loads a brain mask as a boolean array, every non-zero voxel is brain
+
+    Args:
+        mask_path (str): Path to mask nifti
+
+    Returns:
+        np.ndarray: The mask
+    """
+    mask = load_mask(mask_path)
+
+    # masks saved as 4d images with a single volume
+    while mask.ndim > 3 and mask.shape[-1] == 1:
+        mask = mask[..., 0]
+
+    return mask
+
+def apply_loaded_brain_mask(mask: np.ndarray, input_path: str, output_path: str) -> None:
+    """Multiplies a nifti by a brain mask and saves the result the way `fslmaths <input> -mul <mask> <output>` does:
+    with the header and data type of the input and without intensity scaling
+
+    Args:
+        mask (np.ndarray): Boolean mask, see load_brain_mask
+        input_path (str): Path to nifti to extract brain from
+        output_path (str): Path to save brain to
+    """
+    img = nib.load(input_path)
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+
+    if slope == 1 and inter == 0:
+        # multiply the values as stored on disk in place, keeps the dtype
+        data = img.dataobj.get_unscaled()
+        if not data.flags.writeable:
+            data = data.copy()
+    else:
+        # fslmaths writes scaled values without the scaling factors
+        data = np.asanyarray(img.dataobj)
+        if np.issubdtype(img.get_data_dtype(), np.integer):
+            data = np.rint(data)
+        data = data.astype(img.get_data_dtype())
+
+    if data.shape[:3] != mask.shape:
+        raise Exception(f'{input_path} has shape {data.shape} but mask has shape {mask.shape}')
+
+    # 4d images are masked volume by volume
+    data *= mask.reshape(mask.shape + (1,) * (data.ndim - mask.ndim))
+
+    brain = nib.Nifti1Image(data, None, header=img.header)
+    save_nifti(brain, output_path)
+
+def apply_brain_mask(subject_name: str, mask_path: str, input_paths: List[str], output_paths: List[str], num_workers: Optional[int] = None) -> List[int]:
+    """Extracts the brain of many niftis using the same mask. The mask is read once and the niftis are masked concurrently
+
+    Args:
+        subject_name (str): Name of subject the niftis belong to
+        mask_path (str): Path to brain mask
+        input_paths (List[str]): Paths to niftis to extract brain for
+        output_paths (List[str]): Paths to save the brains to, one for each input
+        num_workers (int, optional): Number of niftis masked at the same time. Defaults to the cpus of the slurm task.
+
+    Returns:
+        List[int]: Status code of each nifti (0 for success, non-zero for fail)
+    """
+    if len(input_paths) == 0:
+        return []
+
+    try:
+        mask = load_brain_mask(mask_path)
+    except Exception as e:
+        print(f'Error for {subject_name}: could not load brain mask {mask_path}: {e}')
+        return [1] * len(input_paths)
+
+    def apply_mask(paths) -> int:
+        input_path, output_path = paths
+        try:
+            apply_loaded_brain_mask(mask, input_path, output_path)
+        except Exception as e:
+            print(f'Error for {subject_name}: brain extraction from mask failed for {input_path}: {e}')
+            return 1
+        return 0
+
+    num_workers = min(len(input_paths), num_workers or get_available_cpus())
+    with ThreadPoolExecutor(num_workers) as executor:
+        return list(executor.map(apply_mask, zip(input_paths, output_paths)))
@@ -1,7 +1,17 @@
-from .command import run_cmd
+from .linear_transform import compose_transforms, read_itk_affine, resample_images
+from ..base import get_temp_path, publish_output, save_nifti
+
+from typing import List
+import nibabel as nib
+import scipy.io
+
+INTERPOLATION_ORDERS = {
+    'nearest': 0,
+    'linear': 1,
+}
 
 def apply_linear_transform(subject_name: str, file_path: str, transform_path: str, reference_img_path: str, output_path: str) -> int:
-    """Applies linear affine and rigid transform from a matlab file generated by antsRegistration
+    """Applies linear affine and rigid transform from a matlab file generated by antsRegistration, with nearest neighbour interpolation
 
     Args:
         subject_name (str): Name of subject
@@ -13,11 +23,36 @@ def apply_linear_transform(subject_name: str, file_path: str, transform_path: st
     Returns:
         int: o on success, non-zero on fail
     """
-    cmd = f'antsApplyTransforms --dimensionality 3 --float 0 --input {file_path} --output {output_path} --reference-image {reference_img_path} --interpolation NearestNeighbor --transform [{transform_path}, 0]'
+    return apply_linear_transforms(subject_name, [file_path], [transform_path], reference_img_path, [output_path])
+
+def apply_linear_transforms(subject_name: str, file_paths: List[str], transform_paths: List[str], reference_img_path: str, output_paths: List[str], interpolation: str = 'nearest') -> int:
+    """Applies linear transforms from matlab files generated by antsRegistration to many images in one call, in process (like
+    `antsApplyTransforms --dimensionality 3 --interpolation NearestNeighbor|Linear --transform <transform> ...` for each image).
+    Images on the same grid share the mapping of the reference voxels, see resample_images
+
+    Args:
+        subject_name (str): Name of subject
+        file_paths (List[str]): Paths to files which the transforms are being applied to
+        transform_paths (List[str]): Paths to transform .mat files, in the order of antsApplyTransforms (the last one is applied first)
+        reference_img_path (str): Registered reference image, the grid of the outputs
+        output_paths (List[str]): Paths to put the resulting transformed images, one per file
+        interpolation (str, optional): 'nearest' (keeps labels and the data type) or 'linear'. Defaults to 'nearest'.
+
+    Returns:
+        int: 0 on success, non-zero on fail
+    """
+    try:
+        transform = compose_transforms([read_itk_affine(transform_path) for transform_path in transform_paths])
+        reference = nib.load(reference_img_path)
+        imgs = [nib.load(file_path) for file_path in file_paths]
+        resampled = resample_images(imgs, reference.shape, reference.affine, [transform] * len(imgs), [INTERPOLATION_ORDERS[interpolation]] * len(imgs))
+    except (OSError, ValueError, KeyError, scipy.io.matlab.MatReadError) as e:
+        print(f'Error for {subject_name}: could not apply transforms {transform_paths} to {file_paths}:\n{e}')
+        return 1
 
-    _, err, code = run_cmd(cmd)
+    for data, output_path in zip(resampled, output_paths):
+        # written to a hidden path and renamed, so the output appears complete or not at all
+        save_nifti(nib.Nifti1Image(data, reference.affine), get_temp_path(output_path))
+        publish_output(get_temp_path(output_path), output_path)
 
-    if code != 0:
-        print(f'Error for {subject_name}: could not apply transform {transform_path} to {file_path}:\n{err}')
-    
-    return code
\ No newline at end of file
+    return 0
@@ -0,0 +1,41 @@
+import numpy as np
+from typing import List, Sequence, TypeVar
+
+from .model_cache import CachedModel
+
+# number of sessions whose model inputs are held in memory at once in batch mode
+SESSIONS_PER_BATCH = 16
+
+T = TypeVar('T')
+
+def chunk_sessions(items: Sequence[T], chunk_size: int = SESSIONS_PER_BATCH) -> List[Sequence[T]]:
+    """Splits a list of sessions into chunks that are processed together
+
+    Args:
+        items (Sequence[T]): Items to split
+        chunk_size (int): Maximum number of items per chunk (default is SESSIONS_PER_BATCH)
+
+    Returns:
+        List[Sequence[T]]: The chunks in order
+    """
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+def predict_for_sessions(model: CachedModel, inputs: List[np.ndarray], batch_size: int) -> List[np.ndarray]:
+    """Stacks the model inputs of many sessions along the batch axis, runs them through the model in large batches,
+    then splits the predictions back up per session
+
+    Args:
+        model (CachedModel): Model from `get_cached_model`
+        inputs (List[np.ndarray]): One model input per session, each of shape (n_i, ...) where only n_i may differ
+        batch_size (int): Number of samples per forward pass
+
+    Returns:
+        List[np.ndarray]: One prediction per session, in the same order as `inputs`
+    """
+    if len(inputs) == 0:
+        return []
+
+    sizes = [x.shape[0] for x in inputs]
+    predictions = model.predict(np.concatenate(inputs, axis=0), batch_size)
+
+    return np.split(predictions, np.cumsum(sizes)[:-1])
@@ -1,7 +1,7 @@
 import nibabel as nib
 import os
 
-from .command import run_cmd
+from ..base import get_temp_path, publish_output, load_volume, save_nifti
 
 def check_4d(dwi_path: str, output_dir: str):
     """Checks if a nifti file (dwi) is a 4d file. If it is, extract the first volume
@@ -13,14 +13,21 @@ def check_4d(dwi_path: str, output_dir: str):
     Returns:
         bool | None: true if image was 4d, false if it was not 4d. Returns none if the image was 4d but conversion to 3d failed
     """
-    image_dim_0 = nib.load(dwi_path).header['dim'][0]
+    img = nib.load(dwi_path)
+    image_dim_0 = img.header['dim'][0]
     
     if image_dim_0 > 3:
         # dwi is 4d
         dwi_first_vol_name = os.path.split(dwi_path)[1].split('.')[0] + '_first_vol.nii.gz'
         result_path = os.path.join(output_dir, dwi_first_vol_name)
         
-        _, err, code = run_cmd(f'fslroi {dwi_path} {result_path} 0 1')
+        # only the first volume is read, like fslroi <dwi> <first vol> 0 1
+        try:
+            save_nifti(load_volume(img), get_temp_path(result_path))
+            code, err = 0, None
+        except (OSError, ValueError, EOFError) as e:
+            code, err = 1, e
+        publish_output(get_temp_path(result_path), result_path, code == 0)
     
         if code != 0:
             print(f'Error converting {dwi_path}: \n\t is 4-d but could not extract first volume: {err}')
@@ -1,5 +1,274 @@
+import itertools
+import json
+import os
+import shlex
+import signal
 import subprocess
-from typing import Tuple
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from ..base.command_log import log_command, get_command_output_folder, get_tool_name, in_command_context
+
+# runs the commands so their resource usage can be measured
+path_to_launcher = os.path.abspath(__file__ + '/../command_launcher.py')
+
+# timeouts, memory limit and output kept in memory of the commands run with run_command and run_commands
+path_to_command_config = os.path.abspath(__file__ + '/../../../../config/command_config.json')
+with open(path_to_command_config, 'r') as f:
+    command_config = json.load(f)
+
+# a shell command line or the program and its arguments (run without a shell)
+Command = Union[str, List[str]]
+
+def get_command_line(command: Command) -> str:
+    return command if isinstance(command, str) else shlex.join(command)
+
+class AccountedPopen(subprocess.Popen):
+    """Popen of a command that records the command's wall time, CPU time, peak memory and exit code, see utils/base/command_log.py.
+    The command runs through command_launcher.py, which reports the resource usage of the command and the processes it waited for.
+    The record is written by the first wait, poll or communicate that sees the command exited
+
+    Args:
+        command (str | List[str]): A shell command line, or the program and its arguments which are run without a shell
+        memory_limit (int, optional): Limit of the address space of the command in bytes. Defaults to None (no limit).
+        output_path (str, optional): File the output of the command is written to, recorded in the command log. Defaults to None.
+        **kwargs: Popen arguments (except shell)
+    """
+
+    def __init__(self, command: Command, memory_limit: Optional[int] = None, output_path: Optional[str] = None, **kwargs):
+        self.sys_cmd = get_command_line(command)
+        self.output_path = output_path
+        self.start = time.time()
+        self.start_monotonic = time.monotonic()
+        self._record_lock = threading.Lock()
+        self.report_fd, report_write_fd = os.pipe()
+        try:
+            launcher_args = ['-c', command] if isinstance(command, str) else ['--'] + list(command)
+            super().__init__([sys.executable, '-S', path_to_launcher, str(report_write_fd), str(memory_limit or 0)] + launcher_args, pass_fds=[report_write_fd], **kwargs)
+        except BaseException:
+            os.close(self.report_fd)
+            self.report_fd = None
+            raise
+        finally:
+            os.close(report_write_fd)
+
+    # the public methods are overridden (communicate waits with wait), Popen reaps the process in private methods that differ between python versions
+    def poll(self) -> Optional[int]:
+        returncode = super().poll()
+        if returncode is not None:
+            self.record()
+        return returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        returncode = super().wait(timeout)
+        self.record()
+        return returncode
+
+    def record(self) -> None:
+        """Logs the command once it exited, only the first call writes a record"""
+        with self._record_lock:
+            if self.report_fd is None:
+                return
+
+            with os.fdopen(self.report_fd) as report_file:
+                report = report_file.read().split()
+            self.report_fd = None
+
+        # the launcher was killed before the command finished, the wall time is then the time until the command was reaped
+        if len(report) == 4:
+            user_time, sys_time, max_rss_kb, wall_time = float(report[0]), float(report[1]), int(report[2]), float(report[3])
+        else:
+            user_time, sys_time, max_rss_kb, wall_time = 0.0, 0.0, 0, time.monotonic() - self.start_monotonic
+
+        # negative signal number if the command was killed, like the return code of the launcher
+        log_command(self.sys_cmd, self.start, wall_time, user_time, sys_time, max_rss_kb, self.returncode, self.output_path)
+
+    def __del__(self, *args, **kwargs):
+        # a command that was never waited for is not recorded, but the pipe to its launcher is closed
+        with self._record_lock:
+            if self.report_fd is not None:
+                os.close(self.report_fd)
+                self.report_fd = None
+        super().__del__(*args, **kwargs)
+
+class CommandResult(NamedTuple):
+    code: int
+    # the end of the output (stdout and stderr), for error messages
+    output: str
+    output_path: Optional[str]
+    timed_out: bool
+    cancelled: bool
+
+_output_file_ids = itertools.count()
+
+def get_timeout(command: Command) -> Optional[float]:
+    """Gets the timeout of a command from config/command_config.json, by the name of its program
+
+    Args:
+        command (str | List[str]): The command
+
+    Returns:
+        float | None: Timeout in seconds, None for no timeout
+    """
+    return command_config['timeouts'].get(get_tool_name(get_command_line(command)), command_config['default_timeout'])
+
+class RunningCommand:
+    """A command started with start_command. Its output (stdout and stderr) is streamed to a file in the .pipeline/logs folder
+    of the session in the current command context (a temporary file outside of one), only the end of it is read back.
+    The command runs in its own process group, so a timeout or cancel also stops the processes it started
+
+    Args:
+        command (str | List[str]): A shell command line, or the program and its arguments which are run without a shell
+        env (Dict[str, str], optional): Environment variables to set for the command on top of the current environment. Defaults to None.
+        timeout (float, optional): Seconds after which the command is killed, 0 for no timeout. Defaults to None (see config/command_config.json).
+        memory_limit_mb (int, optional): Limit of the address space of the command in MiB, 0 for no limit. Defaults to None (see config/command_config.json).
+    """
+
+    def __init__(self, command: Command, env: Optional[Dict[str, str]] = None, timeout: Optional[float] = None, memory_limit_mb: Optional[int] = None):
+        self.timeout = get_timeout(command) if timeout is None else timeout
+        memory_limit_mb = command_config['memory_limit_mb'] if memory_limit_mb is None else memory_limit_mb
+        self.timed_out = False
+        self.cancelled = False
+        self.kill_timer = None
+
+        output_folder = get_command_output_folder()
+        if output_folder is not None:
+            tool = get_tool_name(get_command_line(command))
+            self.output_path = os.path.join(output_folder, f'{time.strftime("%Y%m%d-%H%M%S")}_{os.getpid()}_{next(_output_file_ids)}_{tool}.log')
+            self.output_file = open(self.output_path, 'w+b')
+        else:
+            self.output_path = None
+            self.output_file = tempfile.TemporaryFile()
+
+        self.process = AccountedPopen(
+            command,
+            memory_limit=memory_limit_mb * 1024 * 1024 if memory_limit_mb else None,
+            output_path=self.output_path,
+            stdin=subprocess.DEVNULL,
+            stdout=self.output_file,
+            stderr=subprocess.STDOUT,
+            env={**os.environ, **env} if env is not None else None,
+            start_new_session=True
+        )
+        self.deadline = time.monotonic() + self.timeout if self.timeout else None
+
+    def send_signal(self, signum: int) -> None:
+        # the launcher forwards the signal to the command, the rest of the group (e.g. processes started by a shell) gets it directly
+        if self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self) -> None:
+        """Asks the command to stop, it is killed if it has not stopped after the grace period of config/command_config.json"""
+        if self.kill_timer is not None:
+            return
+        self.send_signal(signal.SIGTERM)
+        self.kill_timer = threading.Timer(command_config['kill_grace_period'], self.send_signal, [signal.SIGKILL])
+        self.kill_timer.daemon = True
+        self.kill_timer.start()
+
+    def cancel(self) -> None:
+        """Stops the command (e.g. because a command it depends on failed), can be called from any thread"""
+        self.cancelled = True
+        self.terminate()
+
+    def wait(self) -> CommandResult:
+        """Waits for the command to finish, killing it once the timeout has passed
+
+        Returns:
+            CommandResult: The return code and the end of the output of the command
+        """
+        try:
+            self.process.wait(None if self.deadline is None else max(0, self.deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            self.timed_out = True
+            self.terminate()
+            self.process.wait()
+
+        if self.kill_timer is not None:
+            self.kill_timer.cancel()
+
+        tail_bytes = command_config['output_tail_bytes']
+        self.output_file.seek(max(0, self.output_file.seek(0, os.SEEK_END) - tail_bytes))
+        output = self.output_file.read().decode('utf-8', errors='replace')
+        self.output_file.close()
+
+        if self.timed_out or self.cancelled:
+            reason = f'timed out after {self.timeout}s' if self.timed_out else 'was cancelled'
+            output = (output.rstrip('\n') + '\n' if output else '') + f'{self.process.sys_cmd} {reason}'
+
+        return CommandResult(self.process.returncode, output, self.output_path, self.timed_out, self.cancelled)
+
+def start_command(command: Command, env: Optional[Dict[str, str]] = None, timeout: Optional[float] = None, memory_limit_mb: Optional[int] = None) -> RunningCommand:
+    """Starts a command, see RunningCommand. Is not a blocking call
+
+    Args:
+        command (str | List[str]): A shell command line, or the program and its arguments which are run without a shell
+        env (Dict[str, str], optional): Environment variables to set for the command on top of the current environment. Defaults to None.
+        timeout (float, optional): Seconds after which the command is killed, 0 for no timeout. Defaults to None (see config/command_config.json).
+        memory_limit_mb (int, optional): Limit of the address space of the command in MiB, 0 for no limit. Defaults to None (see config/command_config.json).
+
+    Returns:
+        RunningCommand: The running command
+    """
+    return RunningCommand(command, env, timeout, memory_limit_mb)
+
+def run_command(command: Command, env: Optional[Dict[str, str]] = None, timeout: Optional[float] = None, memory_limit_mb: Optional[int] = None) -> CommandResult:
+    """Runs a command, see RunningCommand. Is a blocking call
+
+    Args:
+        command (str | List[str]): A shell command line, or the program and its arguments which are run without a shell
+        env (Dict[str, str], optional): Environment variables to set for the command on top of the current environment. Defaults to None.
+        timeout (float, optional): Seconds after which the command is killed, 0 for no timeout. Defaults to None (see config/command_config.json).
+        memory_limit_mb (int, optional): Limit of the address space of the command in MiB, 0 for no limit. Defaults to None (see config/command_config.json).
+
+    Returns:
+        CommandResult: The return code and the end of the output of the command
+    """
+    return start_command(command, env, timeout, memory_limit_mb).wait()
+
+def run_commands(chains: List[List[Command]], cancel_on_failure: bool = True, env: Optional[Dict[str, str]] = None) -> List[CommandResult]:
+    """Runs chains of commands at the same time, the commands of a chain one after the other until one fails (like `a && b`). Is a blocking call
+
+    Args:
+        chains (List[List[str | List[str]]]): The chains of commands
+        cancel_on_failure (bool, optional): Stop all other chains once a command fails. Defaults to True.
+        env (Dict[str, str], optional): Environment variables to set for the commands on top of the current environment. Defaults to None.
+
+    Returns:
+        List[CommandResult]: Result of the last command run of each chain
+    """
+    lock = threading.Lock()
+    failed = threading.Event()
+    running: Dict[int, RunningCommand] = {}
+
+    def run_chain(index: int, chain: List[Command]) -> CommandResult:
+        result = CommandResult(0, '', None, False, False)
+        for command in chain:
+            with lock:
+                if failed.is_set():
+                    return CommandResult(-signal.SIGTERM, f'{get_command_line(command)} was cancelled', None, False, True)
+                running[index] = start_command(command, env)
+
+            result = running[index].wait()
+            if result.code != 0:
+                if cancel_on_failure:
+                    with lock:
+                        failed.set()
+                        for other_index, other in running.items():
+                            if other_index != index:
+                                other.cancel()
+                return result
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, len(chains))) as executor:
+        return list(executor.map(in_command_context(run_chain), range(len(chains)), chains))
 
 def config_to_command_options(cmd_config: dict, replace: dict):
     """Generates command line options based on configuration file (see config/registration_config for example)
@@ -22,16 +291,17 @@ def config_to_command_options(cmd_config: dict, replace: dict):
         command_options.append(f'--{option.strip()} {value.strip()}')
     return ' '.join(command_options)
 
-def run_cmd(sys_cmd: str) -> Tuple[str, str, int]:
+def run_cmd(sys_cmd: Command, env: Optional[Dict[str, str]] = None) -> Tuple[str, str, int]:
     """Runs a system command. Is a blocking call
 
     Args:
-        sys_cmd (str): The command to execute
+        sys_cmd (str | List[str]): The command to execute, a shell command line or the program and its arguments
+        env (Dict[str, str], optional): Environment variables to set for the command on top of the current environment. Defaults to None.
 
     Returns:
         Tuple[str, str, int]: The stdout and stderr of the command upon completion and the return code
     """
-    p = subprocess.Popen(sys_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    p = AccountedPopen(sys_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env={**os.environ, **env} if env is not None else None)
     stdout, stderr = p.communicate()
     return stdout.decode('utf-8'), stderr.decode('utf-8'), p.returncode
 
@@ -44,4 +314,4 @@ def run_cmd_async(sys_cmd: str) -> subprocess.Popen:
     Returns:
         subprocess.Popen: The process running the command
     """
-    return subprocess.Popen(sys_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
\ No newline at end of file
+    return AccountedPopen(sys_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
\ No newline at end of file
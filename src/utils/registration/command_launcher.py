@@ -0,0 +1,63 @@
+"""Runs a command and writes its resource usage to a file descriptor, see AccountedPopen in command.py.
+
+    python -S command_launcher.py <report fd> <memory limit> -c <shell command>
+    python -S command_launcher.py <report fd> <memory limit> -- <program> [<argument> ...]
+
+A process forked from the pipeline (which holds the models, images, ...) reports the pipeline's peak memory as its own,
+this small process forks the command instead so the peak memory of the command is its own.
+A memory limit (bytes, 0 for none) caps the address space of the command.
+The report is the user and system time, the peak resident memory (KiB) and the wall time of the command.
+Only imports builtin modules to start quickly
+"""
+import os
+import resource
+import signal
+import sys
+import time
+
+report_fd = int(sys.argv[1])
+memory_limit = int(sys.argv[2])
+argv = ['/bin/sh', '-c', sys.argv[4]] if sys.argv[3] == '-c' else sys.argv[4:]
+
+start = time.monotonic()
+pid = os.fork()
+if pid == 0:
+    # the caller reads the report until the descriptor is closed, the command must not keep it open
+    os.close(report_fd)
+    try:
+        if memory_limit > 0:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        os.execvp(argv[0], argv)
+    except OSError as e:
+        # like a shell, 127 for a command that cannot be run
+        os.write(2, f'{argv[0]}: {e.strerror}\n'.encode())
+        os._exit(127)
+
+def forward_signal(signum, frame):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        # the signal was sent to the whole process group, the command already exited
+        pass
+
+# pass termination on to the command
+FORWARDED_SIGNALS = [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]
+for signum in FORWARDED_SIGNALS:
+    signal.signal(signum, forward_signal)
+
+_, status, rusage = os.wait4(pid, 0)
+wall_time = time.monotonic() - start
+
+try:
+    os.write(report_fd, f'{rusage.ru_utime} {rusage.ru_stime} {rusage.ru_maxrss} {wall_time}'.encode())
+    os.close(report_fd)
+except OSError:
+    # the caller stopped waiting for the command and closed its end
+    pass
+
+if os.WIFSIGNALED(status):
+    # die the same way so the caller sees the signal in the return code
+    if os.WTERMSIG(status) in FORWARDED_SIGNALS:
+        signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+    os.kill(os.getpid(), os.WTERMSIG(status))
+os._exit(os.WEXITSTATUS(status))
@@ -1,17 +1,17 @@
 import os
+import shutil
 import pydicom as dcm
-import numpy as np
 import dicom2nifti
+import dicom2nifti.common
 import dicom2nifti.settings as settings
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
 
 settings.disable_validate_slice_increment()
 settings.disable_validate_instance_number()
 
-from .command import run_cmd
-
-AXIAL_ORIENTATION = [1, 0, 0, 0, 1, 0]
-CORONAL_ORIENTATION = [1, 0, 0, 0, 0, -1]
-SAGITTAL_ORIENTATION = [0, 1, 0, 0, 0, -1]
+from .reorient import reorient_to_rpi
+from ..base import get_available_cpus, get_view_for_orientation, save_nifti
 
 def get_view(dicom_folder: str) -> str:
     """Given a dicom folder, determine the view (axial, sagittal, coronal)
@@ -27,21 +27,10 @@ def get_view(dicom_folder: str) -> str:
     if len(files) == 0:
         return 'UK'
     
-    dcm_file = dcm.read_file(os.path.join(dicom_folder, files[0]))
+    # only the header is needed, do not read the pixel data
+    dcm_file = dcm.dcmread(os.path.join(dicom_folder, files[0]), stop_before_pixels=True, specific_tags=['ImageOrientationPatient'])
 
-    try:
-        orientation = np.round(dcm_file.ImageOrientationPatient).astype(int)
-    
-        if np.array_equal(orientation, AXIAL_ORIENTATION):
-            return 'AX'
-        elif np.array_equal(orientation, SAGITTAL_ORIENTATION):
-            return 'SAG'
-        elif np.array_equal(orientation, CORONAL_ORIENTATION):
-            return 'COR'
-    except:
-        pass
-
-    return 'UK'
+    return get_view_for_orientation(getattr(dcm_file, 'ImageOrientationPatient', None))
 
 # def convert_dcm_folder_to_nifti(subject_name: str, output_folder: str, dcm_folder: str, sequence_name: str) -> None:
 #     """Converts a dicom folder to nifti image
@@ -71,6 +60,61 @@ def get_view(dicom_folder: str) -> str:
 #     if err:
 #         print(f'Error for {subject_name}: RPI failed: {err}')
 
+def get_nifti_output_path(subject_name: str, output_folder: str, view: str, sequence_name: str) -> str:
+    """Gets the path to convert a dicom folder to. If a nifti for the sequence and view already exists, the path gets a suffix (e.g. _1, _2)
+
+    Args:
+        subject_name (str): Name of subject
+        output_folder (str): Path to output folder
+        view (str): View of the dicom folder (see get_view)
+        sequence_name (str): Name of sequence being converted (e.g. 'T1', 'T2', 'FL')
+
+    Returns:
+        str: Path to the nifti
+    """
+    output_nifti = os.path.join(output_folder, f'{subject_name}_{view}_{sequence_name}.nii.gz')
+
+    if os.path.exists(output_nifti):
+        count = 1
+        output_nifti = os.path.join(output_folder, f'{subject_name}_{view}_{sequence_name}_{count}.nii.gz')
+        while os.path.exists(output_nifti):
+            count += 1
+            output_nifti = os.path.join(output_folder, f'{subject_name}_{view}_{sequence_name}_{count}.nii.gz')
+
+    return output_nifti
+
+def convert_dcm_folder(subject_name: str, dcm_folder: str, output_nifti: str) -> bool:
+    """Converts a dicom folder to a nifti in RPI orientation
+
+    Args:
+        subject_name (str): Name of subject
+        dcm_folder (str): Path to dicom folder
+        output_nifti (str): Path to save the nifti to
+
+    Returns:
+        bool: True if the dicom folder was converted
+    """
+    try:
+        # convert in memory, the nifti is written (and compressed) once after it is in RPI
+        results = dicom2nifti.dicom_series_to_nifti(dcm_folder, None, reorient_nifti=False)
+
+        # ensure nifti in RPI, same flips as scripts/toRPI.sh
+        nifti = reorient_to_rpi(results['NII'])
+        nifti.header.set_slope_inter(1, 0)
+        nifti.header.set_xyzt_units(2)
+        save_nifti(nifti, output_nifti)
+
+        # diffusion series also have b-values and vectors
+        output_base = output_nifti[:-len('.nii.gz')]
+        if 'BVAL' in results:
+            dicom2nifti.common.write_bval_file(results['BVAL'], f'{output_base}.bval')
+            dicom2nifti.common.write_bvec_file(results['BVEC'], f'{output_base}.bvec')
+    except Exception as e:
+        print(f'Error for {subject_name}: could not convert dicom folder {dcm_folder} to nifti: {e}', flush=True)
+        return False
+
+    return True
+
 def convert_dcm_folder_to_nifti(subject_name: str, output_folder: str, dcm_folder: str, sequence_name: str) -> None:
     """Converts a dicom folder to nifti image
 
@@ -82,25 +126,56 @@ def convert_dcm_folder_to_nifti(subject_name: str, output_folder: str, dcm_folde
     """
 
     view = get_view(dcm_folder)
+    convert_dcm_folder(subject_name, dcm_folder, get_nifti_output_path(subject_name, output_folder, view, sequence_name))
 
-    try:
-        output_nifti = os.path.join(output_folder, f'{subject_name}_{view}_{sequence_name}.nii.gz')
-        
-        if os.path.exists(output_nifti):
-            count = 1
-            output_nifti = os.path.join(output_folder, f'{subject_name}_{view}_{sequence_name}_{count}.nii.gz')
-            while os.path.exists(output_nifti):
-                count += 1
-                output_nifti = os.path.join(output_folder, f'{subject_name}_{view}_{sequence_name}_{count}.nii.gz')
+def convert_dcm_folders_to_nifti(subject_name: str, output_folder: str, dcm_folders: List[Tuple[str, str]], num_workers: Optional[int] = None, views: Optional[List[Optional[str]]] = None) -> List[bool]:
+    """Converts many dicom folders to nifti images at the same time, each in its own process.
+    The niftis are converted into a staging folder and named in the order of the dicom folders once all are done,
+    so the names are the same as when converting the folders one after the other with convert_dcm_folder_to_nifti
 
-        dicom2nifti.dicom_series_to_nifti(dcm_folder, output_nifti)
-    
-        # ensure nifti in RPI
-        rpi_script_location = os.path.join(os.path.dirname(__file__), 'scripts', 'toRPI.sh')
+    Args:
+        subject_name (str): Name of subject
+        output_folder (str): Path to output folder
+        dcm_folders (List[Tuple[str, str]]): Sequence name and path of each dicom folder
+        num_workers (int, optional): Number of folders converted at the same time. Defaults to the cpus of the slurm task.
+        views (List[str | None], optional): View of each dicom folder if already known (e.g. from the dicom index), read from the dicom folder when None. Defaults to None.
+
+    Returns:
+        List[bool]: Whether each dicom folder was converted
+    """
+    if len(dcm_folders) == 0:
+        return []
 
-        _, err, _ = run_cmd(f'{rpi_script_location} {output_nifti}')
+    views = views or [None] * len(dcm_folders)
+    views = [view if view is not None else get_view(dcm_folder) for view, (_, dcm_folder) in zip(views, dcm_folders)]
 
-        if err:
-            print(f'Error for {subject_name}: RPI failed: {err}')
-    except Exception as e:
-        print(f'Error for {subject_name}: could not convert dicom folder {dcm_folder} to nifti: {e}')
\ No newline at end of file
+    staging_folder = os.path.join(output_folder, '.dcm2nii')
+    os.makedirs(staging_folder, exist_ok=True)
+    staged_niftis = [os.path.join(staging_folder, f'{i}.nii.gz') for i in range(len(dcm_folders))]
+
+    num_workers = min(len(dcm_folders), num_workers or get_available_cpus())
+    subject_names = [subject_name] * len(dcm_folders)
+    folders = [dcm_folder for _, dcm_folder in dcm_folders]
+
+    try:
+        if num_workers > 1:
+            with ProcessPoolExecutor(num_workers) as executor:
+                converted = list(executor.map(convert_dcm_folder, subject_names, folders, staged_niftis))
+        else:
+            converted = list(map(convert_dcm_folder, subject_names, folders, staged_niftis))
+
+        for (sequence_name, _), view, staged_nifti, is_converted in zip(dcm_folders, views, staged_niftis, converted):
+            if not is_converted:
+                continue
+
+            output_nifti = get_nifti_output_path(subject_name, output_folder, view, sequence_name)
+            os.replace(staged_nifti, output_nifti)
+
+            for extension in ['.bval', '.bvec']:
+                staged_file = staged_nifti[:-len('.nii.gz')] + extension
+                if os.path.exists(staged_file):
+                    os.replace(staged_file, output_nifti[:-len('.nii.gz')] + extension)
+    finally:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+    return converted
@@ -2,19 +2,21 @@ import sys
 sys.path.insert(0, '/hpf/projects/ndlamini/scratch/wgao/python3.8.0/')
 
 import os
-import keras
 import cv2
 import numpy as np
 import nibabel as nib
 from nibabel import processing
 import scipy
-from skimage import morphology
 from typing_extensions import deprecated
 import nilearn.image
 import albumentations as A
 import skimage.transform
+from typing import NamedTuple, Optional
 
-from .command import run_cmd_async, run_cmd
+from .command import run_command, run_commands
+from .model_cache import get_cached_model, get_model_path
+from .mask_postprocessing import postprocess_mask
+from ..base import save_nifti, load_intensities, load_labels, label_image
 
 TEMPLATE_DIR = '/hpf/projects/ndlamini/scratch/kwalker/templates/NKI10AndUnder'
 
@@ -34,41 +36,40 @@ def generate_brain_mask(subject_name: str, sequence: str, target_file: str, outp
     output_file_prefix = os.path.join(output_dir, f'{subject_name}_{sequence}')
 
     # AFNI skull strip
-    afni_skullstrip_cmd = f'3dSkullStrip -input {target_file} -prefix {output_file_prefix}_mask_3dss.nii.gz -mask_vol'
-    afni_fsl_cmd = f'fslmaths {output_file_prefix}_mask_3dss.nii.gz -thr 2 -bin {output_file_prefix}_mask_3dss_thresh.nii.gz -odt char'
-
-    afni_process = run_cmd_async(f"{afni_skullstrip_cmd} && {afni_fsl_cmd}")
+    afni_skullstrip_cmd = ['3dSkullStrip', '-input', target_file, '-prefix', f'{output_file_prefix}_mask_3dss.nii.gz', '-mask_vol']
+    afni_fsl_cmd = ['fslmaths', f'{output_file_prefix}_mask_3dss.nii.gz', '-thr', '2', '-bin', f'{output_file_prefix}_mask_3dss_thresh.nii.gz', '-odt', 'char']
 
     # FSL bet
-    bet_cmd = f'bet {target_file} {output_file_prefix}_bet -m -n -R -S -B'
-    bet_fsl_cmd = f'fslmaths {output_file_prefix}_bet_mask.nii.gz -bin {output_file_prefix}_bet_mask.nii.gz -odt char'
-
-    bet_process = run_cmd_async(f'{bet_cmd} && {bet_fsl_cmd}')
+    bet_cmd = ['bet', target_file, f'{output_file_prefix}_bet', '-m', '-n', '-R', '-S', '-B']
+    bet_fsl_cmd = ['fslmaths', f'{output_file_prefix}_bet_mask.nii.gz', '-bin', f'{output_file_prefix}_bet_mask.nii.gz', '-odt', 'char']
 
     # ANTs brain extraction
-    ants_cmd = f'antsBrainExtraction.sh -d 3 -a {target_file} -e {TEMPLATE_DIR}/T_template0.nii.gz -m {TEMPLATE_DIR}/T_template0_BrainCerebellumProbabilityMask.nii.gz -o {output_file_prefix}_mask_abe -s nii.gz -q 1'
-    ants_fsl_cmd = f'fslmaths {output_file_prefix}_mask_abeBrainExtractionMask.nii.gz -bin {output_file_prefix}_mask_abeMask.nii.gz -odt char'
+    ants_cmd = ['antsBrainExtraction.sh', '-d', '3', '-a', target_file, '-e', f'{TEMPLATE_DIR}/T_template0.nii.gz', '-m', f'{TEMPLATE_DIR}/T_template0_BrainCerebellumProbabilityMask.nii.gz', '-o', f'{output_file_prefix}_mask_abe', '-s', 'nii.gz', '-q', '1']
+    ants_fsl_cmd = ['fslmaths', f'{output_file_prefix}_mask_abeBrainExtractionMask.nii.gz', '-bin', f'{output_file_prefix}_mask_abeMask.nii.gz', '-odt', 'char']
 
-    ants_process = run_cmd_async(f'{ants_cmd} && {ants_fsl_cmd}')
+    # the concensus needs all three masks, the other tools are stopped as soon as one fails
+    results = run_commands([[afni_skullstrip_cmd, afni_fsl_cmd], [bet_cmd, bet_fsl_cmd], [ants_cmd, ants_fsl_cmd]], cancel_on_failure=True)
 
-    for process in [afni_process, bet_process, ants_process]:
-        _, err = process.communicate()
+    for result in results:
+        if result.code != 0 and not result.cancelled:
+            print(f'Error for {subject_name}: Creation of mask failed, concensus creation will be skipped. \n\tCommand failed: \n\t{result.output}')
+            return result.code
 
-        if process.returncode != 0:
-            print(f'Error for {subject_name}: Creation of mask failed, concensus creation will be skipped. \n\tCommand {process.args} failed: \n\t{err}')
-            return process.returncode
-        
     # generate concensus mask
-    concensus_cmd = f'fslmaths {output_file_prefix}_mask_3dss_thresh.nii.gz -add {output_file_prefix}_bet_mask.nii.gz -add {output_file_prefix}_mask_abeMask.nii.gz {output_file_prefix}_concensusMask.nii.gz -odt float'
-    concensus_fsl_cmd = f'fslmaths {output_file_prefix}_concensusMask.nii.gz -thr 2 -bin {output_file_prefix}_mask.nii.gz -odt char'
-    _, err, code = run_cmd(f'{concensus_cmd} && {concensus_fsl_cmd}')
+    concensus_cmd = ['fslmaths', f'{output_file_prefix}_mask_3dss_thresh.nii.gz', '-add', f'{output_file_prefix}_bet_mask.nii.gz', '-add', f'{output_file_prefix}_mask_abeMask.nii.gz', f'{output_file_prefix}_concensusMask.nii.gz', '-odt', 'float']
+    concensus_fsl_cmd = ['fslmaths', f'{output_file_prefix}_concensusMask.nii.gz', '-thr', '2', '-bin', f'{output_file_prefix}_mask.nii.gz', '-odt', 'char']
+
+    result = run_command(concensus_cmd)
+    if result.code == 0:
+        result = run_command(concensus_fsl_cmd)
+    code = result.code
 
     if code != 0:
-        print(f'Error for {subject_name}: All masks created but concensus mask creation failed: {err}')
+        print(f'Error for {subject_name}: All masks created but concensus mask creation failed: {result.output}')
     return code
 
 IMG_SIZE = 128
-def generate_brain_mask_using_model(subject_name: str, sequence: str, target_file: str, output_dir: str) -> int:
+def generate_brain_mask_using_model(subject_name: str, sequence: str, target_file: str, output_dir: str, exact_postprocessing: bool = True) -> int:
     """Generates a brain mask using a trained CNN for T1s
 
     Args:
@@ -76,22 +77,23 @@ def generate_brain_mask_using_model(subject_name: str, sequence: str, target_fil
         sequence (str): Sequence of file to generate mask for (Currently has to be 'T1')
         target_file (str): Path to file to generate mask for
         output_dir (str): Directory to output mask
+        exact_postprocessing (bool): Keep the post processing identical to slice by slice hole filling and artifact removal, see `postprocess_mask`. Default true
 
     Returns:
         int: Success code (0 for success, non-zero for fail)
     """
     
     # load the model
-    path_to_model = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..', 'models', '2d', f'{sequence.lower()}_brain_extraction.keras'))
-    model = keras.models.load_model(path_to_model, compile=False)
+    path_to_model = get_model_path('2d', f'{sequence.lower()}_brain_extraction.keras')
+    model = get_cached_model(path_to_model)
     
     # read the nifti and prep input to model
     nifti = nib.load(target_file)
     nifti_resampled = processing.conform(nifti)
 
     num_slices = nifti_resampled.shape[2]
-    X = np.empty((num_slices, IMG_SIZE, IMG_SIZE, 1))
-    nifti_voxels = nifti_resampled.get_fdata()
+    X = np.empty((num_slices, IMG_SIZE, IMG_SIZE, 1), dtype=np.float32)
+    nifti_voxels = load_intensities(nifti_resampled)
     
     # resize input data to conform to model expectations
     for i in range(num_slices):
@@ -107,7 +109,7 @@ def generate_brain_mask_using_model(subject_name: str, sequence: str, target_fil
     print(f"Generating mask for {subject_name}, {target_file}...")
 
     # predict
-    prediction = model.predict(X/max_voxel, verbose=0)
+    prediction = model.predict(X/max_voxel)
     
     # convert to axial
     prediction = np.moveaxis(prediction[:, :, :, 1], 0, 2)
@@ -116,63 +118,53 @@ def generate_brain_mask_using_model(subject_name: str, sequence: str, target_fil
     prediction = scipy.ndimage.gaussian_filter(prediction, sigma=(1, 3, 3), order=0)
 
     # resize predictions back to the size of resampled input nifti
-    resized_prediction = np.zeros(nifti_resampled.shape)
+    resized_prediction = np.zeros(nifti_resampled.shape, dtype=np.uint8)
     
     for slice in range(prediction.shape[2]):
         # round the predictions to get a binary mask
-        resized_prediction[:, :, slice] = np.round(cv2.resize(prediction[:, :, slice], (nifti_resampled.shape[0], nifti_resampled.shape[1]))).astype(int)
-
-        # post processing, fill in any holes in mask
-        resized_prediction[:, :, slice] = scipy.ndimage.binary_fill_holes(resized_prediction[:, :, slice])
-        
-        # post processing, remove any stray artifacts
-        resized_prediction[:,:, slice] = morphology.remove_small_objects(resized_prediction[:,:, slice].astype(bool), IMG_SIZE*IMG_SIZE*0.01).astype(int)
-
-    for slice in range(resized_prediction.shape[0]):
-        # post processing, fill in any holes in mask
-        resized_prediction[slice, :, :] = scipy.ndimage.binary_fill_holes(resized_prediction[slice, :, :])
-        
-        # post processing, remove any stray artifacts
-        resized_prediction[slice, :, :] = morphology.remove_small_objects(resized_prediction[slice, :, :].astype(bool), IMG_SIZE*IMG_SIZE*0.01).astype(int)
-    
-    for slice in range(resized_prediction.shape[1]):
-        # post processing, fill in any holes in mask
-        resized_prediction[:, slice, :] = scipy.ndimage.binary_fill_holes(resized_prediction[:, slice, :])
-        
-        # post processing, remove any stray artifacts
-        resized_prediction[:, slice, :] = morphology.remove_small_objects(resized_prediction[:, slice, :].astype(bool), IMG_SIZE*IMG_SIZE*0.01).astype(int)
+        resized_prediction[:, :, slice] = np.round(cv2.resize(prediction[:, :, slice], (nifti_resampled.shape[0], nifti_resampled.shape[1])))
+
+    # post processing, fill in any holes in mask and remove any stray artifacts
+    resized_prediction = postprocess_mask(resized_prediction, IMG_SIZE*IMG_SIZE*0.01, exact_postprocessing)
 
     # save predictions
-    prediction_nifti = nib.Nifti1Image(resized_prediction, nifti_resampled.affine, dtype=np.uint16)
+    prediction_nifti = label_image(resized_prediction, nifti_resampled.affine)
     prediction_nifti = nilearn.image.resample_img(prediction_nifti, nifti.affine, nifti.shape, "nearest")
-    nib.save(prediction_nifti, os.path.join(output_dir, f'{subject_name}_AX_{sequence}_mask.nii.gz'))
+    save_nifti(label_image(load_labels(prediction_nifti), prediction_nifti.affine), os.path.join(output_dir, f'{subject_name}_AX_{sequence}_mask.nii.gz'))
     
     return 0
 
-IMG_SIZE = 128
-def generate_brain_mask_using_3d_model(subject_name: str, sequence: str, target_file: str, output_dir: str) -> int:
-    """Generates a brain mask using a trained 3D CNN for T1s
+class MaskModelInput(NamedTuple):
+    nifti: nib.Nifti1Image
+    nifti_resampled: nib.Nifti1Image
+    X: np.ndarray
+
+def get_3d_mask_model_path(sequence: str) -> str:
+    """Gets the path to the 3D brain extraction model for a sequence
+
+    Args:
+        sequence (str): Sequence of file to generate mask for (e.g. 'T1', 'T2', 'FL')
+
+    Returns:
+        str: Path to .keras model file
+    """
+    return get_model_path('3d', f'{sequence.lower()}_brain_extraction.keras')
+
+def prepare_3d_mask_model_input(subject_name: str, target_file: str) -> Optional[MaskModelInput]:
+    """Reads a nifti and preps the normalized input tensor of the 3D brain extraction model
 
     Args:
         subject_name (str): Name of subject
-        sequence (str): Sequence of file to generate mask for (Currently has to be 'T1')
         target_file (str): Path to file to generate mask for
-        output_dir (str): Directory to output mask
 
     Returns:
-        int: Success code (0 for success, non-zero for fail)
+        MaskModelInput | None: The loaded nifti, the conformed nifti and the model input of shape (1, 128, 128, 128, 1). None if the image is empty
     """
-    
-    # load the model
-    path_to_model = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..', 'models', '3d', f'{sequence.lower()}_brain_extraction.keras'))
-    model = keras.models.load_model(path_to_model, compile=False)
-    
-    # read the nifti and prep input to model
     nifti = nib.load(target_file)
     nifti_resampled = processing.conform(nifti)
 
-    X = np.empty((1, IMG_SIZE, IMG_SIZE, IMG_SIZE, 1))
-    nifti_voxels = nifti_resampled.get_fdata()
+    X = np.empty((1, IMG_SIZE, IMG_SIZE, IMG_SIZE, 1), dtype=np.float32)
+    nifti_voxels = load_intensities(nifti_resampled)
     
     # resize input data to conform to model expectations
     X[0, :, :, :, 0] = A.resize(nifti_voxels, 128, 128)[:, :, ::2]
@@ -182,43 +174,69 @@ def generate_brain_mask_using_3d_model(subject_name: str, sequence: str, target_
     
     if max_voxel == 0:
         print(f"Error for subject {subject_name}: {target_file} is an empty image. Skipping mask generation...")
-        return 1
+        return None
     
-    print(f"Generating mask for {subject_name}, {target_file}...")
+    return MaskModelInput(nifti, nifti_resampled, X/max_voxel)
+
+def save_3d_mask_prediction(subject_name: str, sequence: str, prediction: np.ndarray, model_input: MaskModelInput, output_dir: str, exact_postprocessing: bool = True) -> int:
+    """Post processes a prediction of the 3D brain extraction model and saves it as a mask
+
+    Args:
+        subject_name (str): Name of subject
+        sequence (str): Sequence of file the mask was generated for (e.g. 'T1', 'T2', 'FL')
+        prediction (np.ndarray): Brain probability of shape (128, 128, 128)
+        model_input (MaskModelInput): The model input the prediction was made on
+        output_dir (str): Directory to output mask
+        exact_postprocessing (bool): Keep the post processing identical to slice by slice hole filling and artifact removal, see `postprocess_mask`. Default true
+
+    Returns:
+        int: Success code (0 for success, non-zero for fail)
+    """
+    nifti, nifti_resampled = model_input.nifti, model_input.nifti_resampled
 
-    # predict
-    prediction = model.predict(X/max_voxel, verbose=0)[0, :, :, :, 1]
-    
     # apply a gaussian blur
     prediction = scipy.ndimage.gaussian_filter(prediction, sigma=(3, 3, 3), order=0)
 
     # resize predictions back to the size of resampled input nifti
-    resized_prediction = skimage.transform.resize(np.where(prediction > 0.6, 1.0, 0.0), nifti_resampled.shape, order=0)
-    
-    for slice in range(resized_prediction.shape[2]):
-        # post processing, fill in any holes in mask
-        resized_prediction[:, :, slice] = scipy.ndimage.binary_fill_holes(resized_prediction[:, :, slice])
-        
-        # post processing, remove any stray artifacts
-        resized_prediction[:,:, slice] = morphology.remove_small_objects(resized_prediction[:,:, slice].astype(bool), IMG_SIZE*IMG_SIZE*0.01).astype(int)
-
-    for slice in range(resized_prediction.shape[0]):
-        # post processing, fill in any holes in mask
-        resized_prediction[slice, :, :] = scipy.ndimage.binary_fill_holes(resized_prediction[slice, :, :])
-        
-        # post processing, remove any stray artifacts
-        resized_prediction[slice, :, :] = morphology.remove_small_objects(resized_prediction[slice, :, :].astype(bool), IMG_SIZE*IMG_SIZE*0.01).astype(int)
-    
-    for slice in range(resized_prediction.shape[1]):
-        # post processing, fill in any holes in mask
-        resized_prediction[:, slice, :] = scipy.ndimage.binary_fill_holes(resized_prediction[:, slice, :])
-        
-        # post processing, remove any stray artifacts
-        resized_prediction[:, slice, :] = morphology.remove_small_objects(resized_prediction[:, slice, :].astype(bool), IMG_SIZE*IMG_SIZE*0.01).astype(int)
+    resized_prediction = skimage.transform.resize(prediction > 0.6, nifti_resampled.shape, order=0)
+    
+    # post processing, fill in any holes in mask and remove any stray artifacts
+    resized_prediction = postprocess_mask(resized_prediction, IMG_SIZE*IMG_SIZE*0.01, exact_postprocessing)
 
     # save predictions
-    prediction_nifti = nib.Nifti1Image(resized_prediction, nifti_resampled.affine, dtype=np.uint16)
+    prediction_nifti = label_image(resized_prediction, nifti_resampled.affine)
     prediction_nifti = processing.conform(prediction_nifti, nifti.shape, nifti.header.get_zooms(), order=0)
-    nib.save(prediction_nifti, os.path.join(output_dir, f'{subject_name}_AX_{sequence}_mask.nii.gz'))
+    save_nifti(label_image(load_labels(prediction_nifti), prediction_nifti.affine), os.path.join(output_dir, f'{subject_name}_AX_{sequence}_mask.nii.gz'))
+    
+    return 0
+
+IMG_SIZE = 128
+def generate_brain_mask_using_3d_model(subject_name: str, sequence: str, target_file: str, output_dir: str, exact_postprocessing: bool = True) -> int:
+    """Generates a brain mask using a trained 3D CNN for T1s
+
+    Args:
+        subject_name (str): Name of subject
+        sequence (str): Sequence of file to generate mask for (Currently has to be 'T1')
+        target_file (str): Path to file to generate mask for
+        output_dir (str): Directory to output mask
+        exact_postprocessing (bool): Keep the post processing identical to slice by slice hole filling and artifact removal, see `postprocess_mask`. Default true
+
+    Returns:
+        int: Success code (0 for success, non-zero for fail)
+    """
+    
+    # load the model
+    model = get_cached_model(get_3d_mask_model_path(sequence))
+    
+    # read the nifti and prep input to model
+    model_input = prepare_3d_mask_model_input(subject_name, target_file)
+
+    if model_input is None:
+        return 1
+    
+    print(f"Generating mask for {subject_name}, {target_file}...")
+
+    # predict
+    prediction = model.predict(model_input.X)[0, :, :, :, 1]
     
-    return 0
\ No newline at end of file
+    return save_3d_mask_prediction(subject_name, sequence, prediction, model_input, output_dir, exact_postprocessing)
\ No newline at end of file
@@ -0,0 +1,160 @@
+from typing import Dict, List, Sequence, Tuple
+
+import nibabel as nib
+import numpy as np
+import scipy.io
+import scipy.ndimage
+from nibabel.affines import rescale_affine
+from nibabel.orientations import axcodes2ornt, inv_ornt_aff, io_orientation, ornt_transform
+
+# ITK (and ANTs) use LPS coordinates, nibabel uses RAS. The flip is its own inverse
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+def read_itk_affine(transform_path: str) -> np.ndarray:
+    """Reads a linear transform written by antsRegistration (<prefix>0GenericAffine.mat, an ITK MatrixOffsetTransformBase in matlab format)
+
+    Args:
+        transform_path (str): Path to .mat file
+
+    Returns:
+        np.ndarray: 4x4 matrix mapping points of the fixed image to points of the moving image (RAS, mm), the direction antsApplyTransforms resamples in
+    """
+    mat = scipy.io.loadmat(transform_path)
+    parameters_key = next((key for key in mat.keys() if key.startswith('AffineTransform_') or key.startswith('MatrixOffsetTransformBase_')), None)
+    if parameters_key is None:
+        raise ValueError(f'{transform_path} is not a linear transform')
+    parameters = np.asarray(mat[parameters_key], dtype=np.float64).ravel()
+    center = np.asarray(mat['fixed'], dtype=np.float64).ravel() if 'fixed' in mat else np.zeros(3)
+
+    # T(x) = A (x - center) + center + translation
+    matrix = parameters[:9].reshape(3, 3)
+    lps_transform = np.eye(4)
+    lps_transform[:3, :3] = matrix
+    lps_transform[:3, 3] = parameters[9:12] + center - matrix @ center
+
+    return LPS_TO_RAS @ lps_transform @ LPS_TO_RAS
+
+def get_conform_affine(img: nib.Nifti1Image, out_shape: Sequence[int], voxel_size: Sequence[float] = (1.0, 1.0, 1.0), orientation: str = 'RAS') -> np.ndarray:
+    """Gets the affine of the image `processing.conform` returns for an image, without resampling it
+
+    Args:
+        img (nib.Nifti1Image): The image
+        out_shape (Sequence[int]): Shape given to conform
+        voxel_size (Sequence[float], optional): Voxel size given to conform. Defaults to (1.0, 1.0, 1.0).
+        orientation (str, optional): Orientation given to conform. Defaults to 'RAS'.
+
+    Returns:
+        np.ndarray: The affine of the conformed image
+    """
+    shape = img.shape[:3]
+    transform = ornt_transform(io_orientation(img.affine), axcodes2ornt(orientation))
+
+    # like img.as_reoriented(transform), which would read the data
+    reoriented_shape = [0, 0, 0]
+    for axis, (new_axis, _) in enumerate(transform):
+        reoriented_shape[int(new_axis)] = shape[axis]
+    reoriented_affine = img.affine @ inv_ornt_aff(transform, shape)
+
+    return rescale_affine(reoriented_affine, reoriented_shape, voxel_size, out_shape)
+
+def compose_transforms(transforms: List[np.ndarray]) -> np.ndarray:
+    """Composes linear transforms the way antsApplyTransforms does with several --transform options: the last one is applied to a point first
+
+    Args:
+        transforms (List[np.ndarray]): 4x4 matrices, see read_itk_affine
+
+    Returns:
+        np.ndarray: The composed 4x4 matrix
+    """
+    composed = np.eye(4)
+    for transform in transforms:
+        composed = composed @ transform
+    return composed
+
+def get_source_coordinates(reference_shape: Sequence[int], voxel_map: np.ndarray) -> np.ndarray:
+    """Maps every voxel of a reference grid to (fractional) voxel coordinates of a source image
+
+    Args:
+        reference_shape (Sequence[int]): Shape of the reference grid
+        voxel_map (np.ndarray): 4x4 matrix from reference voxels to source voxels
+
+    Returns:
+        np.ndarray: 3 x N source coordinates (float32), in the order of the flattened reference grid
+    """
+    grid = np.indices(tuple(reference_shape), dtype=np.float32).reshape(3, -1)
+    return voxel_map[:3, :3].astype(np.float32) @ grid + voxel_map[:3, 3:].astype(np.float32)
+
+def get_nearest_indices(coordinates: np.ndarray, source_shape: Sequence[int]) -> np.ndarray:
+    """Finds the nearest source voxel of each coordinate, see get_source_coordinates
+
+    Args:
+        coordinates (np.ndarray): 3 x N source coordinates
+        source_shape (Sequence[int]): Shape of the source image
+
+    Returns:
+        np.ndarray: Flat index of the nearest source voxel of each coordinate, -1 outside of the source image
+    """
+    # rounds halves up like ITK's nearest neighbour interpolator, np.rint would round them to even
+    voxels = np.floor(coordinates + 0.5).astype(np.int64)
+    inside = np.all((voxels >= 0) & (voxels < np.array(source_shape)[:, None]), axis=0)
+    indices = np.full(coordinates.shape[1], -1, dtype=np.int64)
+    indices[inside] = np.ravel_multi_index(tuple(voxels[:, inside]), tuple(source_shape))
+    return indices
+
+def get_inside(coordinates: np.ndarray, source_shape: Sequence[int]) -> np.ndarray:
+    """Finds the coordinates ITK samples an image at: within half a voxel of its voxel centers, i.e. in [-0.5, n - 0.5) along each axis
+
+    Args:
+        coordinates (np.ndarray): 3 x N source coordinates, see get_source_coordinates
+        source_shape (Sequence[int]): Shape of the source image
+
+    Returns:
+        np.ndarray: N booleans, False where the output is zero
+    """
+    return np.all((coordinates >= -0.5) & (coordinates < np.array(source_shape)[:, None] - 0.5), axis=0)
+
+def load_3d_data(img: nib.Nifti1Image) -> np.ndarray:
+    # like antsApplyTransforms with --dimensionality 3, 4d images are read as their first volume
+    return np.asarray(img.dataobj[..., 0]) if len(img.shape) > 3 else np.asarray(img.dataobj)
+
+def resample_images(imgs: List[nib.Nifti1Image], reference_shape: Sequence[int], reference_affine: np.ndarray, transforms: List[np.ndarray], orders: List[int]) -> List[np.ndarray]:
+    """Resamples images onto a reference grid with a single interpolation each: output voxel -> reference point -> transform -> image voxel.
+    The source coordinates of the reference voxels are computed once for all images on the same grid with the same transform,
+    nearest neighbour resampling then only gathers the values (segmentations keep their labels and data type)
+
+    Args:
+        imgs (List[nib.Nifti1Image]): The images
+        reference_shape (Sequence[int]): Shape of the reference grid
+        reference_affine (np.ndarray): Affine of the reference grid
+        transforms (List[np.ndarray]): For each image, 4x4 matrix mapping reference points to points of the image (RAS, mm)
+        orders (List[int]): For each image, 0 for nearest neighbour or 1 for linear interpolation
+
+    Returns:
+        List[np.ndarray]: The resampled images (linear ones as float32), zero outside of the source images (more than half a voxel outside of their edge voxel centers)
+    """
+    reference_shape = tuple(reference_shape[:3])
+    coordinates: Dict[Tuple, np.ndarray] = {}
+    nearest_indices: Dict[Tuple, np.ndarray] = {}
+    inside: Dict[Tuple, np.ndarray] = {}
+
+    resampled = []
+    for img, transform, order in zip(imgs, transforms, orders):
+        source_shape = img.shape[:3]
+        key = (img.affine.tobytes(), source_shape, transform.tobytes())
+        if key not in coordinates:
+            coordinates[key] = get_source_coordinates(reference_shape, np.linalg.inv(img.affine) @ transform @ reference_affine)
+
+        data = load_3d_data(img)
+        if order == 0:
+            if key not in nearest_indices:
+                nearest_indices[key] = get_nearest_indices(coordinates[key], source_shape)
+            indices = nearest_indices[key]
+            values = np.where(indices >= 0, data.ravel()[np.maximum(indices, 0)], 0).astype(data.dtype)
+        else:
+            # like ITK's linear interpolator, coordinates within half a voxel outside of the edge voxel centers take the edge values
+            if key not in inside:
+                inside[key] = get_inside(coordinates[key], source_shape)
+            values = scipy.ndimage.map_coordinates(data.astype(np.float32), coordinates[key], order=order, mode='nearest')
+            values[~inside[key]] = 0
+        resampled.append(values.reshape(reference_shape))
+    return resampled
@@ -0,0 +1,136 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Tuple
+
+import keras
+import numpy as np
+
+# folder with the trained models, PIPELINE_MODELS_FOLDER points the pipeline to other models (e.g. the stand-in models of benchmarks/)
+MODELS_FOLDER = os.environ.get('PIPELINE_MODELS_FOLDER') or os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..', 'models'))
+
+# number of models kept in memory per process, least recently used models are dropped first
+MAX_CACHED_MODELS = 4
+# spatial size used for dummy warm-up tensors when the model input has unknown dimensions
+WARM_UP_SIZE = 128
+# same default batch size as keras `model.predict`, keeps peak memory bounded for 2d models
+PREDICT_BATCH_SIZE = 32
+
+class CachedModel(NamedTuple):
+    model: keras.Model
+    predict: Callable[..., np.ndarray]
+
+_model_cache = OrderedDict()
+_model_cache_lock = threading.Lock()
+
+def _to_numpy(tensor) -> np.ndarray:
+    """Converts a backend tensor to a numpy array
+
+    Args:
+        tensor: Output of a keras model call
+
+    Returns:
+        np.ndarray: The tensor as a numpy array
+    """
+    if hasattr(keras, 'ops'):
+        return keras.ops.convert_to_numpy(tensor)
+    return np.asarray(tensor)
+
+def _get_inference_function(model: keras.Model) -> Callable:
+    """Gets a direct-call inference function for a model. When running on the tensorflow backend
+    the forward pass is traced once into a graph function so repeated calls skip the `model.predict` setup
+
+    Args:
+        model (keras.Model): The loaded model
+
+    Returns:
+        Callable: Function that takes a float32 batch and returns the model output as a numpy array
+    """
+    if keras.backend.backend() == 'tensorflow':
+        import tensorflow as tf
+
+        graph_function = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+        return lambda X: _to_numpy(graph_function(tf.convert_to_tensor(X)))
+
+    return lambda X: _to_numpy(model(X, training=False))
+
+def _warm_up(infer: Callable, model: keras.Model) -> None:
+    """Runs the model once on a dummy tensor so graph tracing and memory allocation happen at load time
+
+    Args:
+        infer (Callable): Inference function returned by `_get_inference_function`
+        model (keras.Model): The loaded model
+    """
+    input_shape = model.input_shape
+    if isinstance(input_shape, list):
+        input_shape = input_shape[0]
+
+    dummy_shape = [1] + [WARM_UP_SIZE if dim is None else dim for dim in input_shape[1:]]
+    infer(np.zeros(dummy_shape, dtype=np.float32))
+
+def _load_model(path_to_model: str) -> CachedModel:
+    """Loads a model from disk, compiles its inference function and warms it up
+
+    Args:
+        path_to_model (str): Path to .keras model file
+
+    Returns:
+        CachedModel: The model and its predict function
+    """
+    model = keras.models.load_model(path_to_model, compile=False)
+    infer = _get_inference_function(model)
+    _warm_up(infer, model)
+
+    def predict(X: np.ndarray, batch_size: int = PREDICT_BATCH_SIZE) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float32)
+        return np.concatenate([infer(X[i:i + batch_size]) for i in range(0, X.shape[0], batch_size)], axis=0)
+
+    return CachedModel(model, predict)
+
+def get_cached_model(path_to_model: str) -> CachedModel:
+    """Gets a model from the process wide model cache, loading it from disk if it has not been loaded yet
+    or if the file changed since it was loaded
+
+    Args:
+        path_to_model (str): Path to .keras model file
+
+    Returns:
+        CachedModel: The model and its predict function
+    """
+    path_to_model = os.path.realpath(path_to_model)
+    key: Tuple[str, int] = (path_to_model, os.stat(path_to_model).st_mtime_ns)
+
+    with _model_cache_lock:
+        if key in _model_cache:
+            _model_cache.move_to_end(key)
+            return _model_cache[key]
+
+        # drop stale versions of the same model file
+        for stale_key in [k for k in _model_cache.keys() if k[0] == path_to_model]:
+            del _model_cache[stale_key]
+
+        cached_model = _load_model(path_to_model)
+        _model_cache[key] = cached_model
+
+        while len(_model_cache) > MAX_CACHED_MODELS:
+            _model_cache.popitem(last=False)
+
+        return cached_model
+
+def get_model_path(dimensions: str, name: str) -> str:
+    """Gets the path to a model in the models folder
+
+    Args:
+        dimensions (str): '2d' or '3d'
+        name (str): File name of the model, e.g. t1_brain_extraction.keras
+
+    Returns:
+        str: Path to .keras model file
+    """
+    return os.path.join(MODELS_FOLDER, dimensions, name)
+
+def clear_model_cache() -> None:
+    """Removes all models from the process wide model cache
+    """
+    with _model_cache_lock:
+        _model_cache.clear()
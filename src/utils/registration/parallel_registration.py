@@ -0,0 +1,74 @@
+from .register_nifti import run_registration
+from ..base import get_available_cpus, in_command_context
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+class RegistrationJob(NamedTuple):
+    moving_nifti: str
+    moving_sequence: str
+    target_sequence: str
+
+class RegistrationResult(NamedTuple):
+    job: RegistrationJob
+    code: int
+    err: str
+
+def get_thread_budget(num_jobs: int, num_cpus: int) -> Tuple[int, int]:
+    """Splits the cpus between concurrent registrations
+
+    Args:
+        num_jobs (int): Number of registrations that can run at the same time
+        num_cpus (int): Number of cpus available
+
+    Returns:
+        Tuple[int, int]: The number of concurrent registrations and the number of threads each one may use
+    """
+    num_workers = max(1, min(num_jobs, num_cpus))
+    return num_workers, max(1, num_cpus // num_workers)
+
+def register_niftis_to_target(subject_name: str, output_folder: str, target_nifti: str, jobs: List[RegistrationJob], num_cpus: Optional[int] = None, config_file: Optional[str] = None) -> List[RegistrationResult]:
+    """Registers many niftis to the same target at the same time. The available cpus are split between the
+    concurrent antsRegistration processes using ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS.
+    Jobs writing the same output files (same moving and target sequence) run one after the other in the given order
+
+    Args:
+        subject_name (str): Name of subject that the niftis belong to
+        output_folder (str): Path to output folder
+        target_nifti (str): Path to target nifti
+        jobs (List[RegistrationJob]): The niftis to register
+        num_cpus (int, optional): Number of cpus to use. Defaults to the cpus of the slurm task (see get_available_cpus).
+        config_file(str, optional): Config file located in /config folder. Defaults to None (the registration profiles, see run_registration)
+
+    Returns:
+        List[RegistrationResult]: Return code and stderr of each job, in the order of the jobs
+    """
+    if len(jobs) == 0:
+        return []
+
+    # group jobs by their output prefix, jobs in the same group would overwrite each other's files
+    job_groups: Dict[Tuple[str, str], List[int]] = {}
+    for i, job in enumerate(jobs):
+        job_groups.setdefault((job.moving_sequence, job.target_sequence), []).append(i)
+
+    num_workers, num_threads = get_thread_budget(len(job_groups), num_cpus or get_available_cpus())
+    env = {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(num_threads)}
+
+    results: List[Optional[RegistrationResult]] = [None] * len(jobs)
+
+    def run_job_group(job_indices: List[int]) -> None:
+        for i in job_indices:
+            job = jobs[i]
+            print(f'Registering {job.moving_sequence} to {job.target_sequence} for subject {subject_name}', flush=True)
+            code, err = run_registration(subject_name, output_folder, target_nifti, job.moving_nifti, job.moving_sequence, job.target_sequence, config_file, env)
+
+            if code != 0:
+                print(f'Error for {subject_name}: Registration of {job.moving_sequence} to {job.target_sequence} failed: {err}', flush=True)
+
+            results[i] = RegistrationResult(job, code, err)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        # list() to raise any exception of the workers
+        list(executor.map(in_command_context(run_job_group), job_groups.values()))
+
+    return results
@@ -1,13 +1,17 @@
 import os
 import json
+import shlex
+from typing import Dict, List, Optional, Tuple
 
-from .command import config_to_command_options, run_cmd
+from .command import config_to_command_options, run_cmd, run_command
+from .registration_quality import get_registration_similarity, get_header_similarity
+from ..base import get_temp_path, publish_prefixed_outputs
 
 config_folder = os.path.abspath(__file__ + '/../../../../config/')
 
 
 
-def register_nifti_to_target(subject_name: str, output_folder: str, target_nifti: str, moving_nifti: str, moving_sequence: str, target_sequence: str, config_file = 'registration_config.json') -> int:
+def register_nifti_to_target(subject_name: str, output_folder: str, target_nifti: str, moving_nifti: str, moving_sequence: str, target_sequence: str, config_file: Optional[str] = None) -> int:
     """Registers one nifti to another
 
     Args:
@@ -17,7 +21,7 @@ def register_nifti_to_target(subject_name: str, output_folder: str, target_nifti
         moving_nifti (str): Path to moving nifti
         moving_sequence (str): Sequence of moving nifti
         target_sequence (str): Sequence of target nifti (e.g. T1, T2, FL, etc.)
-        config_file(str): Config file located in /config folder (default is registration_config.json)
+        config_file(str, optional): Config file located in /config folder. Defaults to None (the registration profiles, see run_registration)
     
     Returns:
         int: Status code (0 for success, non-zero for fail)
@@ -25,16 +29,119 @@ def register_nifti_to_target(subject_name: str, output_folder: str, target_nifti
     
     print(f'Registering {moving_sequence} to {target_sequence} for subject {subject_name}', flush=True)
     
-    sys_cmd = get_registration_command(subject_name, output_folder, target_nifti, moving_nifti, moving_sequence, target_sequence, config_file)
-    
-    _, err, code = run_cmd(sys_cmd)
+    code, err = run_registration(subject_name, output_folder, target_nifti, moving_nifti, moving_sequence, target_sequence, config_file)
 
     if code != 0:
         print(f'Error for {subject_name}: Registration of {moving_sequence} to {target_sequence} failed: {err}', flush=True)
 
     return code
 
-def get_registration_command(subject_name: str, output_folder: str, target_nifti: str, moving_nifti: str, moving_sequence: str, target_sequence: str, config_file: str) -> str:
+def run_registration(subject_name: str, output_folder: str, target_nifti: str, moving_nifti: str, moving_sequence: str, target_sequence: str, config_file: Optional[str] = None, env: Optional[Dict[str, str]] = None) -> Tuple[int, str]:
+    """Runs antsRegistration. Without a config file the profiles of `config/registration_profiles.json` are tried in the order of `escalation`:
+    the result of a profile is kept if the warped image is similar enough to the target (see get_registration_similarity and
+    get_min_similarity) and not much less similar than the moving image placed by its header (see get_header_similarity),
+    otherwise the next (slower) profile is run. The result of the last profile is always kept
+
+    Args:
+        subject_name (str): Name of subject
+        output_folder (str): Path to folder
+        target_nifti (str): Path to registration target
+        moving_nifti (str): Path to moving nifti
+        moving_sequence (str): Sequence of moving nifti (e.g. 'T1', 'T2', 'FL')
+        target_sequence (str): Sequence of target nifti (e.g. 'T1', 'T2', 'FL')
+        config_file (str, optional): Config file located in /config folder, run without a quality check. Defaults to None.
+        env (Dict[str, str], optional): Environment variables to set for antsRegistration. Defaults to None.
+
+    Returns:
+        Tuple[int, str]: The return code and the end of the output of the last antsRegistration run
+    """
+    profiles_config = json.load(open(os.path.join(config_folder, 'registration_profiles.json')))
+    if config_file is None:
+        config_files = [(profile, profiles_config['profiles'][profile]) for profile in profiles_config['escalation']]
+    else:
+        config_files = [(None, config_file)]
+
+    # outputs are written under a hidden prefix and renamed once antsRegistration finished
+    prefix = get_registration_prefix(subject_name, output_folder, moving_sequence, target_sequence)
+    temp_prefix = get_temp_path(prefix)
+    header_similarity = None
+
+    for i, (profile, profile_config_file) in enumerate(config_files):
+        sys_cmd = get_registration_command(subject_name, output_folder, target_nifti, moving_nifti, moving_sequence, target_sequence, profile_config_file, temp_prefix)
+        result = run_command(shlex.split(sys_cmd), env)
+        code, err = result.code, result.output
+
+        if i == len(config_files) - 1:
+            break
+
+        next_profile = config_files[i + 1][0]
+        if code != 0:
+            print(f'Warning for {subject_name}: Registration of {moving_sequence} to {target_sequence} with the {profile} profile failed, trying the {next_profile} profile', flush=True)
+            continue
+
+        # every profile writes the warped moving image, see the output option of the configs
+        warped_nifti = temp_prefix + 'Warped.nii.gz'
+        if not os.path.exists(warped_nifti):
+            break
+
+        similarity = get_registration_similarity(target_nifti, warped_nifti, profiles_config['similarity_bins'])
+        if header_similarity is None:
+            header_similarity = get_header_similarity(target_nifti, moving_nifti, profiles_config['similarity_bins'])
+        # a registration that ends up less similar than the scanner placement of the images found a wrong alignment
+        min_similarity = max(get_min_similarity(profiles_config, moving_sequence, target_sequence), header_similarity - profiles_config['max_similarity_loss'])
+        if similarity >= min_similarity:
+            break
+        print(f'Registration of {moving_sequence} to {target_sequence} for subject {subject_name} with the {profile} profile has similarity {similarity:.3f} '
+              f'(below {min_similarity:.3f}, {header_similarity:.3f} before the registration), trying the {next_profile} profile', flush=True)
+
+    publish_prefixed_outputs(temp_prefix, prefix, code == 0)
+    return code, err
+
+def get_min_similarity(profiles_config: dict, moving_sequence: str, target_sequence: str) -> float:
+    """Gets the similarity a registration needs to keep the result of a profile, see `min_similarity` in `config/registration_profiles.json`.
+    Images of different contrasts are less similar when aligned, so the threshold depends on the moving and target sequence
+
+    Args:
+        profiles_config (dict): The registration profiles config
+        moving_sequence (str): Sequence of moving nifti (e.g. 'T1', 'T2', 'FL')
+        target_sequence (str): Sequence of target nifti (e.g. 'T1', 'T2', 'FL', 'template')
+
+    Returns:
+        float: The threshold for `<moving_sequence>_to_<target_sequence>`, the default threshold for pairs without one
+    """
+    min_similarity = profiles_config['min_similarity']
+    return min_similarity.get(f'{moving_sequence}_to_{target_sequence}', min_similarity['default'])
+
+def get_registration_prefix(subject_name: str, output_folder: str, moving_sequence: str, target_sequence: str) -> str:
+    """Gets the prefix of the files antsRegistration writes, e.g. <subject>_DWI_to_T1_ for <subject>_DWI_to_T1_Warped.nii.gz
+
+    Args:
+        subject_name (str): Name of subject
+        output_folder (str): Path to folder
+        moving_sequence (str): Sequence of moving nifti (e.g. 'T1', 'T2', 'FL')
+        target_sequence (str): Sequence of target nifti (e.g. 'T1', 'T2', 'FL')
+
+    Returns:
+        str: The prefix
+    """
+    return os.path.join(output_folder, f'{subject_name}_{moving_sequence}_to_{target_sequence}_')
+
+def get_registration_outputs(subject_name: str, output_folder: str, moving_sequence: str, target_sequence: str) -> List[str]:
+    """Gets the files a registration writes, see the output option of the registration configs
+
+    Args:
+        subject_name (str): Name of subject
+        output_folder (str): Path to folder
+        moving_sequence (str): Sequence of moving nifti (e.g. 'T1', 'T2', 'FL')
+        target_sequence (str): Sequence of target nifti (e.g. 'T1', 'T2', 'FL')
+
+    Returns:
+        List[str]: Paths to the affine transform and the warped moving image
+    """
+    prefix = get_registration_prefix(subject_name, output_folder, moving_sequence, target_sequence)
+    return [prefix + '0GenericAffine.mat', prefix + 'Warped.nii.gz']
+
+def get_registration_command(subject_name: str, output_folder: str, target_nifti: str, moving_nifti: str, moving_sequence: str, target_sequence: str, config_file: str, prefix: Optional[str] = None) -> str:
     """Gets registration command from config file `config/registration_config.json`
 
     Args:
@@ -45,13 +152,14 @@ def get_registration_command(subject_name: str, output_folder: str, target_nifti
         moving_sequence (str): Sequence of moving nifti (e.g. 'T1', 'T2', 'FL')
         target_sequence (str): Sequence of target nifti (e.g. 'T1', 'T2', 'FL')
         config_file(str): Config file located in /config folder (default is registration_config.json)
+        prefix (str, optional): Prefix of the output files. Defaults to the prefix from get_registration_prefix.
 
     Returns:
         str: The command
     """
     
     registration_config = json.load(open(os.path.join(config_folder, config_file)))
-    registered_files_prefix = os.path.join(output_folder, f'{subject_name}_{moving_sequence}_to_{target_sequence}_')
+    registered_files_prefix = prefix or get_registration_prefix(subject_name, output_folder, moving_sequence, target_sequence)
 
     command_replace_object = {}
     command_replace_object["prefix"] = registered_files_prefix
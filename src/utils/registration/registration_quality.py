@@ -0,0 +1,75 @@
+import nibabel as nib
+import numpy as np
+
+from .linear_transform import resample_images
+
+def get_normalized_mutual_information(target: np.ndarray, moving: np.ndarray, bins: int = 32) -> float:
+    """Computes the normalized mutual information (H(target) + H(moving)) / H(target, moving) of two images of the same shape.
+    It is 1 for independent images and 2 for images that determine each other, and does not depend on the contrast of the images
+
+    Args:
+        target (np.ndarray): Intensities of the target image
+        moving (np.ndarray): Intensities of the moving image at the same voxels
+        bins (int, optional): Number of intensity bins of each image. Defaults to 32.
+
+    Returns:
+        float: The normalized mutual information
+    """
+    joint_histogram, _, _ = np.histogram2d(target.ravel(), moving.ravel(), bins=bins)
+    joint_probabilities = joint_histogram / joint_histogram.sum()
+
+    def entropy(probabilities: np.ndarray) -> float:
+        probabilities = probabilities[probabilities > 0]
+        return float(-np.sum(probabilities * np.log(probabilities)))
+
+    joint_entropy = entropy(joint_probabilities)
+    if joint_entropy == 0:
+        # both images are constant
+        return 1.0
+    return (entropy(joint_probabilities.sum(axis=1)) + entropy(joint_probabilities.sum(axis=0))) / joint_entropy
+
+def get_head_similarity(target_img: nib.Nifti1Image, moving: np.ndarray, bins: int, stride: int) -> float:
+    # the background of the target would match the background the registration fills in outside of the moving image
+    grid = (slice(None, None, stride),) * 3 + (0,) * (len(target_img.shape) - 3)
+    target = np.asarray(target_img.dataobj[grid], dtype=np.float32)
+    head = target > np.percentile(target, 10)
+    if not np.any(head):
+        return 1.0
+    return get_normalized_mutual_information(target[head], moving[head], bins)
+
+def get_registration_similarity(target_nifti: str, warped_nifti: str, bins: int = 32, stride: int = 2) -> float:
+    """Computes how well a registered (warped) image matches its target, see get_normalized_mutual_information.
+    Only voxels inside the head of the target are compared, on a grid of every `stride`th voxel to keep it cheap
+
+    Args:
+        target_nifti (str): Path to the registration target
+        warped_nifti (str): Path to the moving image resampled to the target by the registration
+        bins (int, optional): Number of intensity bins. Defaults to 32.
+        stride (int, optional): Distance between the compared voxels. Defaults to 2.
+
+    Returns:
+        float: The normalized mutual information, between 1 (unrelated) and 2 (identical up to contrast)
+    """
+    warped_img = nib.load(warped_nifti)
+    # the first volume of 4d targets, like antsRegistration with --dimensionality 3
+    warped = np.asarray(warped_img.dataobj[(slice(None, None, stride),) * 3 + (0,) * (len(warped_img.shape) - 3)], dtype=np.float32)
+    return get_head_similarity(nib.load(target_nifti), warped, bins, stride)
+
+def get_header_similarity(target_nifti: str, moving_nifti: str, bins: int = 32, stride: int = 2) -> float:
+    """Computes how well an image matches a registration target before the registration, placed by the affines of their headers
+    (the scanner coordinates), like get_registration_similarity
+
+    Args:
+        target_nifti (str): Path to the registration target
+        moving_nifti (str): Path to the moving image
+        bins (int, optional): Number of intensity bins. Defaults to 32.
+        stride (int, optional): Distance between the compared voxels. Defaults to 2.
+
+    Returns:
+        float: The normalized mutual information, between 1 (unrelated) and 2 (identical up to contrast)
+    """
+    target_img = nib.load(target_nifti)
+    grid_shape = tuple(len(range(0, size, stride)) for size in target_img.shape[:3])
+    grid_affine = target_img.affine @ np.diag([stride, stride, stride, 1])
+    moving = resample_images([nib.load(moving_nifti)], grid_shape, grid_affine, [np.eye(4)], [1])[0]
+    return get_head_similarity(target_img, moving, bins, stride)
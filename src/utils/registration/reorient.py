@@ -0,0 +1,77 @@
+import nibabel as nib
+import numpy as np
+
+# the new axes scripts/toRPI.sh gives fslswapdim for each native orientation. The orientation is the first letter of
+# fslhd's qform_xorient, qform_yorient and qform_zorient, i.e. the side each voxel axis starts from (Left-to-Right is L)
+RPI_SWAPS = {
+    # L PA IS
+    'LPI': '-x y z', 'LPS': '-x y -z', 'LAI': '-x -y z', 'LAS': '-x -y -z',
+    # R PA IS
+    'RPI': 'x y z', 'RPS': 'x y -z', 'RAI': 'x -y z', 'RAS': 'x -y -z',
+    # L IS PA
+    'LIP': '-x z y', 'LIA': '-x -z y', 'LSP': '-x z -y', 'LSA': '-x -z -y',
+    # R IS PA
+    'RIP': 'x z y', 'RIA': 'x -z y', 'RSP': 'x z -y', 'RSA': 'x -z -y',
+    # P IS LR
+    'PIL': '-z x y', 'PIR': 'z x y', 'PSL': '-z x -y', 'PSR': 'z x -y',
+    # A IS LR
+    'AIL': '-z -x y', 'AIR': 'z -x y', 'ASL': '-z -x -y', 'ASR': 'z -x -y',
+    # P LR IS
+    'PLI': '-y x z', 'PLS': '-y x -z', 'PRI': 'y x z', 'PRS': 'y x -z',
+    # A LR IS
+    'ALI': '-y -x z', 'ALS': '-y -x -z', 'ARI': 'y -x z', 'ARS': 'y -x -z',
+    # I LR PA
+    'ILP': '-y z x', 'ILA': '-y -z x', 'IRP': 'y z x', 'IRA': 'y -z x',
+    # S LR PA
+    'SLP': '-y z -x', 'SLA': '-y -z -x', 'SRP': 'y z -x', 'SRA': 'y -z -x',
+    # I PA LR
+    'IPL': '-z y x', 'IPR': 'z y x', 'IAL': '-z -y x', 'IAR': 'z -y x',
+    # S PA LR
+    'SPL': '-z y -x', 'SPR': 'z y -x', 'SAL': '-z -y -x', 'SAR': 'z -y -x',
+}
+
+# nibabel names the side an axis points to, fsl the side it starts from
+FSL_STARTING_SIDE = {'R': 'L', 'L': 'R', 'A': 'P', 'P': 'A', 'S': 'I', 'I': 'S'}
+
+def get_fsl_orientation(affine: np.ndarray) -> str:
+    """Gets the orientation of an affine the way fslhd reports it, e.g. RPI for nibabel's LAS
+
+    Args:
+        affine (np.ndarray): Voxel to world affine
+
+    Returns:
+        str: The three letter orientation
+    """
+    return ''.join(FSL_STARTING_SIDE[code] for code in nib.aff2axcodes(affine))
+
+def get_rpi_ornt(fsl_orientation: str) -> np.ndarray:
+    """Gets the nibabel orientation transform doing what `fslswapdim <image> <new axes> <image>` does in toRPI.sh
+
+    Args:
+        fsl_orientation (str): Native orientation, see get_fsl_orientation
+
+    Returns:
+        np.ndarray: The transform, see nibabel.orientations
+    """
+    ornt = np.zeros((3, 2))
+    for new_axis, axis in enumerate(RPI_SWAPS[fsl_orientation].split()):
+        ornt['xyz'.index(axis[-1])] = [new_axis, -1 if axis.startswith('-') else 1]
+    return ornt
+
+def reorient_to_rpi(img: nib.Nifti1Image) -> nib.Nifti1Image:
+    """Reorients an image in memory to RPI (FSL's MNI152 orientation, LAS in nibabel) like scripts/toRPI.sh.
+    The voxels are moved and the affine updated so every voxel stays at the same world position
+
+    Args:
+        img (nib.Nifti1Image): The image
+
+    Returns:
+        nib.Nifti1Image: The reoriented image, with the qform set so fsl reports it as RPI
+    """
+    reoriented = img.as_reoriented(get_rpi_ornt(get_fsl_orientation(img.affine)))
+
+    if reoriented is img:
+        reoriented = nib.Nifti1Image(img.dataobj, img.affine, header=img.header)
+
+    reoriented.set_qform(reoriented.affine, code=1)
+    return reoriented
@@ -1,81 +1,144 @@
 import os
-import keras
 import cv2
 import numpy as np
 import nibabel as nib
 from nibabel import processing
+from typing import NamedTuple, Optional
+
+from .model_cache import get_cached_model, get_model_path
+from ..base import save_nifti, load_intensities, load_volume, label_image
 
 IMG_SIZE = 128
-def segment_stroke(subject_name: str, dwi_or_b1000: str, adc: str, output_dir: str, segment_on_dwi = False) -> int:
-    """Generates a stroke segmentation from the dwi and adc using a trained CNN
+# cv2.resize resizes at most CV_CN_MAX channels at once, 512 on OpenCV 4 but 128 on OpenCV 5
+MAX_RESIZE_CHANNELS = 128
+
+class StrokeModelInput(NamedTuple):
+    dwi_or_b1000_img: nib.Nifti1Image
+    X: np.ndarray
+
+def get_stroke_model_path(segment_on_dwi = False) -> str:
+    """Gets the path to the stroke segmentation model
+
+    Args:
+        segment_on_dwi(bool): True if we are segmenting on dwi false if segmenting on b1000. Default false
+
+    Returns:
+        str: Path to .keras model file
+    """
+    return get_model_path('2d', f'stroke_segmentation_{"dwi" if segment_on_dwi else "b1000"}.keras')
+
+def resize_slices(stack: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Resizes all slices of a stack at once (bilinear, like cv2.resize of each slice)
+
+    Args:
+        stack (np.ndarray): Slices of shape (rows, columns, num_slices), float32
+        height (int): Rows of the resized slices
+        width (int): Columns of the resized slices
+
+    Returns:
+        np.ndarray: The resized slices of shape (height, width, num_slices)
+    """
+    resized = np.empty((height, width, stack.shape[2]), dtype=stack.dtype)
+    # the slices are the channels of the image cv2 resizes
+    for start in range(0, stack.shape[2], MAX_RESIZE_CHANNELS):
+        chunk = np.ascontiguousarray(stack[:, :, start:start + MAX_RESIZE_CHANNELS])
+        resized[:, :, start:start + MAX_RESIZE_CHANNELS] = cv2.resize(chunk, (width, height)).reshape(height, width, -1)
+    return resized
+
+def prepare_stroke_model_input(subject_name: str, dwi_or_b1000: str, adc: str) -> Optional[StrokeModelInput]:
+    """Reads the dwi and adc and preps the normalized input tensor of the stroke segmentation model
 
     Args:
         subject_name (str): Name of subject
         dwi_or_b1000 (str): Path to b1000 or dwi
         adc (str): Path to adc
-        output_dir (str): Directory to output segmentation
-        registered_to (str): Name of sequence that dwi and adc are registered to
-        segment_on_dwi(bool): True if we are segmenting on dwi false if segmenting on b1000. Default false
-        
+
     Returns:
-        int: Success code (0 for success, non-zero for fail)
+        StrokeModelInput | None: The (3d) dwi or b1000 image and the float32 model input of shape (num_slices, 128, 128, 2). None if both images are empty
     """
-    # load the model
-    path_to_model = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..', 'models', '2d', f'stroke_segmentation_{"dwi" if segment_on_dwi else "b1000"}.keras'))
-    model = keras.models.load_model(path_to_model, compile=False)
-    
-    # read the dwi and adc and prep input to model
     adc_img = nib.load(adc)
-    dwi_or_b1000_img = nib.load(dwi_or_b1000)
-
-    # if dwi is 3d, take first volume
-    if dwi_or_b1000_img.ndim == 4:
-        dwi_or_b1000_img = nib.funcs.four_to_three(dwi_or_b1000_img)[0]
+    # if dwi is 4d, take first volume
+    dwi_or_b1000_img = load_volume(dwi_or_b1000)
 
     # make sure adc is the same dimensions as dwi
     adc_img = processing.conform(adc_img, dwi_or_b1000_img.shape, dwi_or_b1000_img.header.get_zooms())
     
-    num_slices = dwi_or_b1000_img.shape[2]
-    X = np.empty((num_slices, IMG_SIZE, IMG_SIZE, 2))
-    
-    adc_voxels = adc_img.get_fdata()
-    dwi_voxels = dwi_or_b1000_img.get_fdata()
+    adc_voxels = load_intensities(adc_img)
+    dwi_voxels = load_intensities(dwi_or_b1000_img)
 
-    assert adc_voxels.shape[2] == dwi_voxels.shape[2], (adc, adc_voxels.shape, dwi_voxels.shape)
+    if adc_voxels.shape[2] != dwi_voxels.shape[2]:
+        print(f"Error for subject {subject_name}: {adc} has {adc_voxels.shape[2]} slices but {dwi_or_b1000} has {dwi_voxels.shape[2]}. Skipping stroke segmentation...")
+        return None
     
-    # resize input data to conform to model expectations
-    for i in range(num_slices):
-        X[i,:,:,0] = cv2.resize(dwi_voxels[:,:,i], (IMG_SIZE,IMG_SIZE))
-        X[i,:,:,1] = cv2.resize(adc_voxels[:,:,i], (IMG_SIZE,IMG_SIZE))
+    # resize input data to conform to model expectations, (num_slices, 128, 128, 2)
+    X = np.stack([resize_slices(dwi_voxels, IMG_SIZE, IMG_SIZE), resize_slices(adc_voxels, IMG_SIZE, IMG_SIZE)], axis=-1)
+    X = np.ascontiguousarray(np.moveaxis(X, 2, 0))
 
     # normalize
     max_voxel = np.max(X)
     
     if max_voxel == 0:
-        print(f"Error for subject {subject_name}: both {dwi_or_b1000_img} and {adc} are empty images. Skipping stroke segmentation...")
-        return 1
+        print(f"Error for subject {subject_name}: both {dwi_or_b1000} and {adc} are empty images. Skipping stroke segmentation...")
+        return None
     
-    print(f"Generating stroke segmentation for {subject_name} using {dwi_or_b1000_img}, {adc}...")
+    X /= max_voxel
+    return StrokeModelInput(dwi_or_b1000_img, X)
 
-    # predict
-    prediction = model.predict(X/max_voxel, verbose=0)
-    
-    # convert to axial
-    prediction = np.moveaxis(prediction[:, :, :, 1], 0, 2)
+def save_stroke_prediction(subject_name: str, prediction: np.ndarray, model_input: StrokeModelInput, output_dir: str) -> int:
+    """Thresholds a prediction of the stroke segmentation model and saves it as a segmentation
+
+    Args:
+        subject_name (str): Name of subject
+        prediction (np.ndarray): Model output of shape (num_slices, 128, 128, 2)
+        model_input (StrokeModelInput): The model input the prediction was made on
+        output_dir (str): Directory to output segmentation
+
+    Returns:
+        int: Success code (0 for success, non-zero for fail)
+    """
+    dwi_or_b1000_img = model_input.dwi_or_b1000_img
+
+    # convert to axial, (128, 128, num_slices)
+    prediction = np.moveaxis(prediction[:, :, :, 1].astype(np.float32, copy=False), 0, 2)
     
     # resize predictions back to the size of input nifti
-    resized_prediction = np.zeros(dwi_or_b1000_img.shape)
-    
-    for slice in range(prediction.shape[2]):
-        # round the predictions to get a binary mask
-        resized_prediction[:, :, slice] = cv2.resize(prediction[:, :, slice], (dwi_or_b1000_img.shape[0], dwi_or_b1000_img.shape[1]))
+    resized_prediction = resize_slices(prediction, dwi_or_b1000_img.shape[0], dwi_or_b1000_img.shape[1])
 
     # only take high probability predictions
-    resized_prediction = np.where(resized_prediction > 0.7, 1.0, 0.0).astype(int)
+    segmentation = resized_prediction > 0.7
 
     # save predictions
-    prediction_nifti = nib.Nifti1Image(resized_prediction.astype(float), dwi_or_b1000_img.affine)
+    prediction_nifti = label_image(segmentation, dwi_or_b1000_img.affine)
+    
+    save_nifti(prediction_nifti, os.path.join(output_dir, f'{subject_name}_stroke_segmentation.nii.gz'))
+    
+    return 0
+
+def segment_stroke(subject_name: str, dwi_or_b1000: str, adc: str, output_dir: str, segment_on_dwi = False) -> int:
+    """Generates a stroke segmentation from the dwi and adc using a trained CNN
+
+    Args:
+        subject_name (str): Name of subject
+        dwi_or_b1000 (str): Path to b1000 or dwi
+        adc (str): Path to adc
+        output_dir (str): Directory to output segmentation
+        segment_on_dwi(bool): True if we are segmenting on dwi false if segmenting on b1000. Default false
+        
+    Returns:
+        int: Success code (0 for success, non-zero for fail)
+    """
+    # load the model
+    model = get_cached_model(get_stroke_model_path(segment_on_dwi))
+    
+    # read the dwi and adc and prep input to model
+    model_input = prepare_stroke_model_input(subject_name, dwi_or_b1000, adc)
+
+    if model_input is None:
+        return 1
     
-    nib.save(prediction_nifti, os.path.join(output_dir, f'{subject_name}_stroke_segmentation.nii.gz'))
+    print(f"Generating stroke segmentation for {subject_name} using {dwi_or_b1000}, {adc}...")
+
+    # predict
+    prediction = model.predict(model_input.X)
     
-    return 0
\ No newline at end of file
+    return save_stroke_prediction(subject_name, prediction, model_input, output_dir)
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, Tuple
+
+# node-local folder the templates are staged to, tempfile honours TMPDIR (node-local scratch on most slurm clusters)
+# PIPELINE_TEMPLATE_CACHE_FOLDER points the pipeline to another folder
+TEMPLATE_CACHE_FOLDER = os.environ.get('PIPELINE_TEMPLATE_CACHE_FOLDER') or os.path.join(tempfile.gettempdir(), f'mri_pipeline_templates_{os.getuid()}')
+CHECKSUM_FILE = 'sha256'
+
+# staged copies verified by this process, by the path, size and modification time of the original
+_staged_templates: Dict[Tuple[str, int, int], str] = {}
+_staged_templates_lock = threading.Lock()
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def is_staged(staged_folder: str, staged_path: str) -> bool:
+    """Checks that a staged template is complete and unchanged
+
+    Args:
+        staged_folder (str): Folder of the staged template
+        staged_path (str): Path to the staged copy
+
+    Returns:
+        bool: Whether the copy matches the checksum written when it was staged
+    """
+    checksum_path = os.path.join(staged_folder, CHECKSUM_FILE)
+    if not os.path.exists(staged_path) or not os.path.exists(checksum_path):
+        return False
+    with open(checksum_path, 'r') as f:
+        return f.read().strip() == hash_file(staged_path)
+
+def copy_to_cache(path: str, staged_folder: str) -> None:
+    """Copies a template to its folder in the cache. The copy is made in a temporary folder which is renamed once complete,
+    when several processes of a node stage the same template at the same time the first rename wins
+
+    Args:
+        path (str): Path to the template
+        staged_folder (str): Folder of the staged template
+    """
+    os.makedirs(TEMPLATE_CACHE_FOLDER, exist_ok=True)
+    temp_folder = tempfile.mkdtemp(dir=TEMPLATE_CACHE_FOLDER, prefix='.staging_')
+    try:
+        temp_path = os.path.join(temp_folder, os.path.basename(path))
+        shutil.copyfile(path, temp_path)
+        with open(os.path.join(temp_folder, CHECKSUM_FILE), 'w') as f:
+            f.write(hash_file(temp_path))
+        os.rename(temp_folder, staged_folder)
+    except OSError:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        if not os.path.isdir(staged_folder):
+            raise
+
+def stage_template(path: str) -> str:
+    """Gets a node-local copy of a template, see TEMPLATE_CACHE_FOLDER. The template is copied once per node (and again when the
+    original changes), the sessions processed on the node read the copy instead of the shared storage.
+    Falls back to the original if the template cannot be staged
+
+    Args:
+        path (str): Path to the template
+
+    Returns:
+        str: Path to the staged copy
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    with _staged_templates_lock:
+        if key in _staged_templates:
+            return _staged_templates[key]
+
+        staged_folder = os.path.join(TEMPLATE_CACHE_FOLDER, hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+        staged_path = os.path.join(staged_folder, os.path.basename(path))
+        try:
+            if not is_staged(staged_folder, staged_path):
+                # incomplete or corrupted copies are replaced
+                shutil.rmtree(staged_folder, ignore_errors=True)
+                copy_to_cache(path, staged_folder)
+                if not is_staged(staged_folder, staged_path):
+                    raise OSError(f'staged copy {staged_path} does not match its checksum')
+        except OSError as e:
+            print(f'Warning: Could not stage template {path} to {TEMPLATE_CACHE_FOLDER}, reading it from shared storage: {e}', flush=True)
+            return path
+
+        _staged_templates[key] = staged_path
+        return staged_path
@@ -0,0 +1,72 @@
+import argparse
+from collections import defaultdict
+
+from src.utils.base import read_command_logs, percentile
+
+
+parser = argparse.ArgumentParser(
+    prog='Command Statistics',
+    description='Summarizes the time and memory of the external commands run by the pipeline, recorded in .pipeline/commands.jsonl of each session'
+)
+
+parser.add_argument('-o', '--output-dir', required=True, help='The output folder the pipeline was run with')
+parser.add_argument('-g', '--group-by', choices=['step', 'tool', 'step-tool'], default='step-tool')
+parser.add_argument('-s', '--step', help='Only include commands run by this step')
+parser.add_argument('-p', '--percentiles', type=float, nargs='+', default=[50, 90, 99])
+
+args = parser.parse_args()
+
+records = read_command_logs(args.output_dir)
+if args.step:
+    records = [record for record in records if record['step'] == args.step]
+
+if len(records) == 0:
+    print(f'No commands recorded in {args.output_dir}')
+    exit(1)
+
+def get_group(record: dict) -> str:
+    if args.group_by == 'step':
+        return record['step']
+    elif args.group_by == 'tool':
+        return record['tool']
+    return f"{record['step']}/{record['tool']}"
+
+groups = defaultdict(list)
+for record in records:
+    groups[get_group(record)].append(record)
+
+columns = ['group', 'runs', 'failed', 'sessions', 'total_h']
+for metric in ['wall_s', 'cpu_s', 'rss_mb']:
+    columns += [f'{metric}_p{q:g}' for q in args.percentiles] + [f'{metric}_max']
+
+rows = []
+for group, group_records in groups.items():
+    metrics = {
+        'wall_s': [record['wall_time'] for record in group_records],
+        'cpu_s': [record['user_time'] + record['sys_time'] for record in group_records],
+        'rss_mb': [record['max_rss_mb'] for record in group_records],
+    }
+
+    row = [
+        group,
+        len(group_records),
+        sum(1 for record in group_records if record['exit_code'] != 0),
+        len(set((record['subject'], record['session']) for record in group_records)),
+        sum(metrics['wall_s']) / 3600,
+    ]
+    for values in metrics.values():
+        row += [percentile(values, q) for q in args.percentiles] + [max(values)]
+    rows.append(row)
+
+# where most of the time goes first
+rows.sort(key=lambda row: row[4], reverse=True)
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return f'{value:.2f}'
+    return str(value)
+
+table = [columns] + [[format_value(value) for value in row] for row in rows]
+widths = [max(len(row[i]) for row in table) for i in range(len(columns))]
+for row in table:
+    print('  '.join(value.ljust(width) if i == 0 else value.rjust(width) for i, (value, width) in enumerate(zip(row, widths))))